@@ -0,0 +1,73 @@
+#
+# Compares the incremental HTTPHeader parser with the previous implementation, which re-joined and re-scanned
+# the whole buffer for each received chunk.
+#
+# Usage: python header_parser.py [<chunk size>]
+#
+
+import sys, re, time
+from webpie.HTTPServer import HTTPHeader
+from webpie.py3 import to_str
+
+class LegacyHTTPHeader(HTTPHeader):
+    
+    # HTTPHeader.consume() as of webpie 5.16
+    
+    def __init__(self):
+        HTTPHeader.__init__(self)
+        self.Buffer = b""
+        self.Headers = {}
+    
+    def consume(self, inp):
+        header_buffer = self.Buffer + inp
+        match = self.EOH_RE.search(header_buffer)
+        if not match:   
+            self.Buffer = header_buffer
+            return False, False, b''
+        i1, i2 = match.span()            
+        header = header_buffer[:i1]
+        rest = header_buffer[i2:]
+        headers = {}
+        header = to_str(header)
+        lines = [l.strip() for l in header.split("\n")]
+        self.Headline = lines[0]
+        words = self.Headline.split(" ", 2)
+        self.Method, self.URI, self.Protocol = words
+        for l in lines[1:]:
+            if not l:   continue
+            try:   
+                h, b = tuple(l.split(':', 1))
+                headers[h.strip()] = b.strip()
+            except: pass
+        self.Headers = headers
+        self.Buffer = b""
+        return True, False, rest
+
+def make_request(nheaders):
+    lines = ["GET /some/path?x=1 HTTP/1.1", "Host: localhost:8080"] + \
+        ["X-Header-%d: %s" % (i, "v"*40) for i in range(nheaders)]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+def run(cls, chunks, n):
+    t0 = time.perf_counter()
+    for _ in range(n):
+        h = cls()
+        for c in chunks:
+            if h.consume(c)[0]:
+                break
+    return (time.perf_counter() - t0)/n
+
+def main():
+    chunk_size = int(sys.argv[1]) if sys.argv[1:] else 1024
+    print("chunk size:", chunk_size)
+    print("%8s %8s %15s %15s %8s" % ("headers", "bytes", "legacy, us", "new, us", "ratio"))
+    for nheaders in (5, 20, 100, 500, 1500):
+        data = make_request(nheaders)
+        chunks = [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+        n = max(10, 200000//(nheaders+10))
+        t_old = run(LegacyHTTPHeader, chunks, n)
+        t_new = run(HTTPHeader, [memoryview(c) for c in chunks], n)
+        print("%8d %8d %15.1f %15.1f %8.2f" % (nheaders, len(data), t_old*1e6, t_new*1e6, t_old/t_new))
+
+if __name__ == "__main__":
+    main()
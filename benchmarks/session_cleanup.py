@@ -0,0 +1,86 @@
+#
+# Compares the session clean-up, which walked the whole session directory tree while holding the storage lock,
+# with the clean-up driven by the expiration index. 10% of the sessions are expired.
+# "stall" is the longest time a storage lock was held, i.e. the longest time session reads and writes were blocked
+#
+# Usage: python session_cleanup.py [<max number of sessions>]
+#
+
+import sys, os, time, tempfile, shutil, uuid
+from threading import RLock
+from webpie.WPSessionApp import SessionStorage
+
+class TimedLock(object):
+    
+    def __init__(self):
+        self.Lock = RLock()
+        self.MaxHeld = 0.0
+        self.Depth = 0
+        
+    def __enter__(self):
+        self.Lock.acquire()
+        self.Depth += 1
+        if self.Depth == 1:
+            self.T0 = time.perf_counter()
+        
+    def __exit__(self, *params):
+        self.Depth -= 1
+        if self.Depth == 0:
+            self.MaxHeld = max(self.MaxHeld, time.perf_counter() - self.T0)
+        self.Lock.release()
+
+def legacy_cleanup(root, session_timeout, lock):
+    # CleanerThread.run() loop body as of webpie 5.16
+    with lock:
+        for path, subdirs, files in os.walk(root):
+            for f in files:
+                f = path + '/' + f
+                st = os.stat(f)
+                if st.st_atime < time.time() - session_timeout:
+                    os.unlink(f)
+
+def populate(root, n, timeout):
+    os.makedirs(root + "/.expiry")
+    open(root + "/.expiry/.built", "w").close()       # no need to index existing files
+    storage = SessionStorage(root, 60, timeout)
+    now = time.time()
+    for i in range(n):
+        sid = uuid.uuid4().hex
+        storage.save(sid, {"i": i})
+        if i % 10 == 0:
+            t = now - timeout - 120
+            os.utime(storage.dataFilePath(sid), (t, t))
+            storage.indexSession(sid, t, force=True)
+    return storage
+
+def main():
+    max_n = int(sys.argv[1]) if sys.argv[1:] else 30000
+    timeout = 3600
+    print("%10s %15s %15s %15s %15s" % ("sessions", "legacy stall,ms", "legacy total,ms", "index stall,ms", "index total,ms"))
+    n = 1000
+    while n <= max_n:
+        root = tempfile.mkdtemp()
+        try:
+            populate(root, n, timeout)
+            lock = TimedLock()
+            t0 = time.perf_counter()
+            legacy_cleanup(root, timeout, lock)
+            t_legacy = time.perf_counter() - t0
+            stall_legacy = lock.MaxHeld
+        finally:
+            shutil.rmtree(root)
+        root = tempfile.mkdtemp()
+        try:
+            storage = populate(root, n, timeout)
+            storage.Locks = [TimedLock() for _ in storage.Locks]
+            t0 = time.perf_counter()
+            storage.cleanup()
+            t_index = time.perf_counter() - t0
+            stall_index = max(lock.MaxHeld for lock in storage.Locks)
+        finally:
+            shutil.rmtree(root)
+        print("%10d %15.1f %15.1f %15.1f %15.1f" % (n, stall_legacy*1000, t_legacy*1000, stall_index*1000, t_index*1000))
+        n *= 3
+
+if __name__ == "__main__":
+    main()
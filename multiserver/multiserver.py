@@ -1,6 +1,9 @@
-import traceback, sys, time, signal, importlib, yaml, os, os.path, datetime, threading, pprint
-from pythreader import Task, TaskQueue, Primitive, synchronized, PyThread, LogFile
+import traceback, sys, time, signal, importlib, yaml, os, os.path, datetime, threading, pprint, selectors, gc, functools
+from pythreader import Task, TaskQueue, Primitive, synchronized, PyThread, LogFile, Scheduler
 from webpie import HTTPServer, RequestProcessor, yaml_expand as expand, init_uid
+from webpie.HTTPServer import listening_socket
+from webpie.filewatch import file_watcher
+from webpie.compression import Compressor
 from multiprocessing import Process, Pipe
 from webpie.logs import Logger, Logged
 
@@ -42,6 +45,21 @@ def services_from_config(config):
         else:
             yield expand(svc_cfg)
             
+def load_services(config, current, logger, log):
+    # creates services. If a service fails to initialize, its current version is used, if any
+    current = {svc.ServiceName: svc for svc in current}
+    service_list = []
+    for svc_cfg in services_from_config(config):
+        svc = Service(svc_cfg, logger)
+        if svc.Initialized:
+            service_list.append(svc)
+        elif svc.ServiceName in current:
+            log.log(f'service "{svc.ServiceName}" failed to initialize - the previous version continues running')
+            service_list.append(current[svc.ServiceName])
+        else:
+            log.log(f'service "{svc.ServiceName}" failed to initialize - removing from service list')
+    return service_list
+
 class RequestTask(RequestProcessor):
     pass
 
@@ -54,6 +72,8 @@ class Service(Primitive, Logged):
         Logged.__init__(self, name, logger=logger, debug=config.get("debug", False))
         Primitive.__init__(self, name=f"[service {name}]")        
         self.Config = None
+        self.Watcher = None
+        self.PostFork = None
         self.Initialized = self.initialize(config)
 
     def log_request(self, *message):
@@ -137,10 +157,24 @@ class Service(Primitive, Logged):
                 if app is None:
                     self.error(f'Application object "{application}" not found in {fname}')
                     return False
-                    
+
+            post_fork = None
+            if "post_fork" in config:
+                # function(application), called in each subprocess after fork if the service was preloaded
+                post_fork = g.get(config["post_fork"])
+                if post_fork is None:
+                    self.error(f'Post-fork function {config["post_fork"]} not found in {fname}')
+                    return False
+                post_fork = functools.partial(post_fork, app)
             
+            compress = config.get("compress")
+            if compress:
+                # compress: true or dictionary of Compressor options
+                app = Compressor(app, **(compress if isinstance(compress, dict) else {}))
+
             self.AppArgs = args
             self.WSGIApp = app
+            self.PostFork = post_fork
 
             max_workers = config.get("max_workers", 5)
             queue_capacity = config.get("queue_capacity", 10)
@@ -153,6 +187,7 @@ class Service(Primitive, Logged):
                 queue capacity:       {queue_capacity}
                 queue timeout:        {self.QueueTimeout}
                 timeout:              {self.Timeout}
+                compress:             {compress}
                 wsgi app:             {app}
                   args:               {args}
             """
@@ -246,6 +281,21 @@ class Service(Primitive, Logged):
         try:    return os.path.getmtime(path)
         except: return None
 
+    def watch(self, watcher):
+        # reload the service when one of touch_reload files changes
+        self.Watcher = watcher
+        for path in self.ReloadFileTimestamps:
+            watcher.watch(path, self.fileChanged)
+
+    def unwatch(self):
+        if self.Watcher is not None:
+            for path in self.ReloadFileTimestamps:
+                self.Watcher.unwatch(path, self.fileChanged)
+            self.Watcher = None
+
+    def fileChanged(self, path):
+        self.reloadIfNeeded()
+
     def reloadIfNeeded(self):
         for path, old_timestamp in self.ReloadFileTimestamps.items():
             mt = self.mtime(path)
@@ -255,7 +305,27 @@ class Service(Primitive, Logged):
                 break
         else:
             return False
-        self.Initialized = self.initialize()
+        # the new version of the application is loaded while the old one keeps serving requests. Requests already
+        # queued for the old version are processed by the old request queue
+        if self.initialize():
+            self.Initialized = True
+            return True
+        elif self.Initialized:
+            self.log("reload failed - the previous version of the application continues running")
+        return False
+
+    def postFork(self):
+        # called in the subprocess if the service was initialized by the master before fork
+        if self.PostFork is not None:
+            try:    self.PostFork()
+            except:
+                self.error(f"Error in post-fork function:\n{traceback.format_exc()}")
+
+    def drain(self, deadline):
+        # waits until the requests queued for the service are processed. Returns number of requests left
+        while len(self.RequestQueue) and time.time() < deadline:
+            time.sleep(0.05)
+        return len(self.RequestQueue)
         
 class MPLogger(PyThread, Logged):
     
@@ -373,10 +443,15 @@ class Monitor(PyThread, Logged):
 
 class MultiServerSubprocess(Process, Logged):
     
-    def __init__(self, port, sock, config_file, logger=None):
+    def __init__(self, port, sock, config_file, logger=None, other_sockets=[], preloaded=None):
         Process.__init__(self, daemon=True)
         #print("MultiServerSubprocess.__init__: logger:", logger)
-        self.Sock = sock
+        self.Sock = sock                # shared or SO_REUSEPORT listening socket, owned by the master
+        self.OtherSockets = other_sockets   # listening sockets of other subprocesses, inherited from the master
+        self.Preloaded = preloaded          # services initialized by the master
+        self.AcceptCount = 0
+        self.StatsCount = 0             # AcceptCount and time when the stats were last logged
+        self.StatsTime = time.time()
         self.Logger = logger
         self.Port = port
         self.Server = None
@@ -387,31 +462,64 @@ class MultiServerSubprocess(Process, Logged):
         self.MasterSide = True
         self.Stop = False
         self.MasterPID = os.getpid()
+        self.Watcher = None
+        self.WakeUpIn = self.WakeUpOut = None
+        self.DrainTimeout = 30.0
+        self.ReconfigureLock = threading.Lock()     # reconfigurations run in background threads one at a time
         Logged.__init__(self, f"[Subprocess {self.MasterPID}]", logger=logger)
         #for key, value in sorted(self.__dict__.items()):
         #    print(key, type(value), value)
         
     def reconfigure(self):
+        #
+        # New services are created and their applications loaded while the current ones keep serving requests.
+        # Then the server switches to the new services and the replaced ones finish the requests already queued
+        #
         #print("MultiServerSubprocess.reconfigure()...")
         self.ReconfiguredTime = os.path.getmtime(self.ConfigFile)
         self.Config = config = expand(yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader))
-        service_list = []
-        for svc_cfg in services_from_config(config):
-            svc = Service(svc_cfg, self.Logger)
-            if svc.Initialized:
-                service_list.append(svc)
-            else:
-                self.log(f'service "{svc.ServiceName}" failed to initialize - removing from service list')
+        self.DrainTimeout = config.get("drain_timeout", 30.0)
+        if self.Preloaded is not None:
+            # preloaded services are reloaded by the master, which then restarts the subprocesses
+            service_list, self.Preloaded = self.Preloaded, None
+            for svc in service_list:
+                svc.postFork()
+        else:
+            if self.Watcher is None:
+                self.Watcher = file_watcher(self.CheckConfigInterval)
+            service_list = load_services(config, self.Services, self.Logger, self)
         if self.Server is None:
             self.Server = HTTPServer.from_config(self.Config, service_list, logger=self.Logger)
         else:
             self.Server.setServices(service_list)
         self.log(f"Server configured with services:", ",\n".join([s.ServiceName for s in service_list]))
+        retired = [svc for svc in self.Services if svc not in service_list]
+        if self.Watcher is not None:
+            for svc in retired:
+                svc.unwatch()
+            for svc in service_list:
+                svc.watch(self.Watcher)
         self.Services = service_list
+        deadline = time.time() + self.DrainTimeout
+        for svc in retired:
+            left = svc.drain(deadline)
+            if left:
+                self.log(f'service "{svc.ServiceName}": {left} requests not completed in {self.DrainTimeout} seconds')
         #print("MultiServerSubprocess.reconfigure() done")
 
+    def reconfigure_in_background(self):
+        def reconfigure():
+            with self.ReconfigureLock:
+                try:    self.reconfigure()
+                except:
+                    self.error("Exception in reconfigure:\n", traceback.format_exc())
+        threading.Thread(target=reconfigure, name="reconfigure", daemon=True).start()
+
     CheckConfigInterval = 5.0
+    CheckMasterInterval = 1.0
     MonitorInterval = 60.0
+    StatsInterval = 60.0
+    AcceptBatch = 64            # max connections accepted in a row before checking the control pipe
         
     def run(self):
         self.Monitor = Monitor(self.Logger)
@@ -424,55 +532,112 @@ class MultiServerSubprocess(Process, Logged):
         self.LogName = f"MultiServerSubprocess({pid})"
         self.reconfigure()
         self.MasterSide = False
-        self.Sock.settimeout(5.0)
+        for sock in self.OtherSockets:
+            # otherwise the socket would stay open after its subprocess is stopped and its connections never accepted
+            if sock is not self.Sock:
+                sock.close()
+        self.Sock.setblocking(False)
+        self.StatsTime = time.time()
 
-        #self.Scheduler = Scheduler(max_concurrent = 2, daemon = True)
-        #self.Scheduler.add(self.check_config, interval = self.CheckConfigInterval, t0 = time.time() + self.CheckConfigInterval)
+        #
+        # The main thread only accepts connections and receives messages from the master, which watches the
+        # config file and sends "reconfigure". touch_reload files are watched by the file watcher, the master
+        # process is checked by the scheduler
+        #
+        self.WakeUpIn, self.WakeUpOut = socket.socketpair()
+        self.WakeUpIn.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self.Sock, selectors.EVENT_READ, "accept")
+        selector.register(self.ConnectionToMaster, selectors.EVENT_READ, "control")
+        selector.register(self.WakeUpIn, selectors.EVENT_READ, "wakeup")
+
+        self.Scheduler = Scheduler(max_concurrent = 2, daemon = True)
+        self.Scheduler.add(self.check_master, interval = self.CheckMasterInterval)
+        self.Scheduler.add(self.check_stats, interval = self.StatsInterval)
         #self.Scheduler.add(self.run_monitor, interval = self.MonitorInterval)
 
+        self.ConnectionToMaster.send("ready")
         while not self.Stop:
-            
-            self.check_config()
-            
-            # see if the parent process is still alive
-            try:    os.kill(self.MasterPID, 0)
-            except:
-                print("master process died")
-                break
+            for key, events in selector.select():
+                if key.data == "accept":
+                    self.accept_connections(self.AcceptBatch)
+                elif key.data == "control":
+                    self.control_message()
+                else:
+                    try:    self.WakeUpIn.recv(4096)
+                    except BlockingIOError: pass
 
-            try:    csock, caddr = self.Sock.accept()
-            except socket.timeout:
-                pass
-            else:
-                #print("run(): services:", [str(s) for s in self.Services])
-                self.Server.connection_accepted(csock, caddr)
-
-            if self.ConnectionToMaster.poll(0):
-                msg = self.ConnectionToMaster.recv()
-                self.log("message from master:", msg)
-                if msg == "stop":
-                    self.Stop = True
-                elif msg == "reconfigure":
-                    self.reconfigure()
-
-        #self.Scheduler.stop()
-        self.Server.close()
-        self.Server.join()
+        #
+        # Graceful stop: accept the connections waiting in the listen queue, stop listening and process the requests
+        # already received. The master keeps the listening socket open, so that its replacement can accept new
+        # connections from the same queue
+        #
+        self.Scheduler.stop()
+        selector.close()
+        self.accept_connections(None)
+        self.Sock.close()
+        self.log_stats()
+        deadline = time.time() + self.DrainTimeout
+        left = self.Server.drain(self.DrainTimeout)      # the server thread is not started, connections are accepted here
         for svc in self.Services:
-            svc.close()
-            svc.join()
-    
-    def check_config(self):
-        try:
-            if os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
-                self.reconfigure()
-            else:
-                for svc in self.Services:
-                    if isinstance(svc, Service):
-                        svc.reloadIfNeeded()
-        except Exception as e:
-            self.error("Exception in check_config:\n", traceback.format_exc())
-        return self.CheckConfigInterval
+            svc.unwatch()
+            left += svc.drain(deadline)
+        self.log("stopped" + (f", {left} connections or requests not completed in {self.DrainTimeout} seconds" if left else ""))
+
+    def accept_connections(self, limit):
+        # accepts up to limit or, if limit is None, all waiting connections
+        n = 0
+        while limit is None or n < limit:
+            n += 1
+            try:    csock, caddr = self.Sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # e.g. ECONNABORTED or EMFILE
+                self.error("accept error:", e)
+                break
+            self.AcceptCount += 1
+            self.Server.connection_accepted(csock, caddr)
+
+    def wait_ready(self, timeout):
+        # master side: waits until the subprocess has loaded the services and started accepting connections
+        try:    return self.ConnectionToSubprocess.poll(timeout) and self.ConnectionToSubprocess.recv() == "ready"
+        except (EOFError, OSError):
+            return False
+
+    def control_message(self):
+        try:    msg = self.ConnectionToMaster.recv()
+        except EOFError:
+            msg = "stop"            # master process closed the pipe
+        self.log("message from master:", msg)
+        if msg == "stop":
+            self.Stop = True
+        elif msg == "reconfigure":
+            self.reconfigure_in_background()
+        elif msg == "stats":
+            self.log_stats()
+
+    def check_master(self):
+        # see if the parent process is still alive
+        try:    os.kill(self.MasterPID, 0)
+        except:
+            print("master process died")
+            self.stop()
+            return "stop"
+        return self.CheckMasterInterval
+
+    def check_stats(self):
+        if self.AcceptCount > self.StatsCount:
+            self.log_stats()
+        return self.StatsInterval
+
+    def log_stats(self):
+        now = time.time()
+        n = self.AcceptCount - self.StatsCount
+        rate = n/(now - self.StatsTime) if now > self.StatsTime else 0.0
+        self.log("accepted connections: %d total, %d in last %.1f seconds (%.1f/second)" % (self.AcceptCount, n, now - self.StatsTime, rate))
+        self.StatsCount = self.AcceptCount
+        self.StatsTime = now
 
     def run_monitor(self):
         try:
@@ -486,9 +651,14 @@ class MultiServerSubprocess(Process, Logged):
             self.ConnectionToSubprocess.send("stop")
         else:
             self.Stop = True
+            try:    self.WakeUpOut.send(b'x')
+            except: pass
             
     def request_reconfigure(self):
         self.ConnectionToSubprocess.send("reconfigure")
+
+    def request_stats(self):
+        self.ConnectionToSubprocess.send("stats")
             
 class MPMultiServer(PyThread, Logged):
             
@@ -501,7 +671,14 @@ class MPMultiServer(PyThread, Logged):
         self.ReconfiguredTime = 0
         self.Subprocesses = []
         self.Sock = None
+        self.ReusePort = False
+        self.Backlog = 1024
+        self.DrainTimeout = 30.0
         self.Stop = False
+        self.Restarting = False
+        self.RestartPending = False
+        self.Preload = False
+        self.PreloadedServices = []
         #print(f"MPMultiServer: log_path:", log_path, "requests_path:", requests_path)
         self.MPLogger = MPLogger(config_file, log_path = log_path, debug = debug_enabled, requests_path = requests_path)
         self.MPLogger.start()
@@ -515,67 +692,187 @@ class MPMultiServer(PyThread, Logged):
         port = self.Config["port"]
         if self.Port is None:
             self.Port = port
-            self.Sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.Sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.Sock.bind(('', self.Port))
-            self.Sock.listen(10)
+            self.Backlog = self.Config.get("backlog", 1024)
+            # reuse_port: each subprocess listens on its own socket, otherwise all of them accept from one shared socket.
+            # The sockets are created here and passed to the replacements of stopped or failed subprocesses
+            self.ReusePort = self.Config.get("reuse_port", False)
+            if not self.ReusePort:
+                self.Sock = listening_socket(self.Port, self.Backlog)
+            self.log("listening on port:", self.Port, " backlog:", self.Backlog, " reuse_port:", self.ReusePort)
         elif port != self.Port:
             print("Can not change port number")
             sys.exit(1)
+        elif self.Config.get("reuse_port", False) != self.ReusePort or self.Config.get("backlog", 1024) != self.Backlog:
+            self.log("changes of backlog and reuse_port require restart - ignored")
+        self.DrainTimeout = self.Config.get("drain_timeout", 30.0)
+        self.Preload = self.Config.get("preload", False)
+        self.preload()
         
         new_nprocesses = self.Config.get("processes", 1)
+        running = self.Subprocesses[:new_nprocesses]
         if new_nprocesses > len(self.Subprocesses):
-            for p in self.Subprocesses:
-                p.request_reconfigure()
             for _ in range(new_nprocesses - len(self.Subprocesses)):
-                p = MultiServerSubprocess(self.Port, self.Sock, self.ConfigFile, logger=self.MPLogger)
-                p.start()
-                self.Subprocesses.append(p)
+                self.Subprocesses.append(self.start_subprocess())
                 #self.log("started new subprocess")
         elif new_nprocesses < len(self.Subprocesses):
             while new_nprocesses < len(self.Subprocesses):
                 p = self.Subprocesses.pop()
                 p.stop()
+                if self.ReusePort:
+                    p.Sock.close()      # the subprocess accepts remaining connections from the queue before closing it
                 #self.log("stopped a subprocess")
-            for p in self.Subprocesses:
-                p.request_reconfigure()
+        if self.Preload:
+            if running:
+                # the new services are passed to the subprocesses when they are forked, so the subprocesses
+                # started above already have them
+                self.restart(targets=running)
         else:
-            for p in self.Subprocesses:
+            for p in running:
                 p.request_reconfigure()
         #self.log("subprocesses running now:", len(self.Subprocesses))
+
+    def preload(self):
+        #
+        # preload: true - the services are initialized once, by the master, and the subprocesses get them when forked.
+        # Memory pages of the applications stay shared between the subprocesses until modified. The objects existing
+        # before the fork are moved to the permanent generation by gc.freeze(), otherwise garbage collection
+        # in the subprocesses would touch, and copy, all the pages
+        #
+        watcher = file_watcher()
+        for svc in self.PreloadedServices:
+            for path in svc.ReloadFileTimestamps:
+                watcher.unwatch(path, self.preloaded_file_changed)
+        if hasattr(gc, "freeze"):
+            gc.unfreeze()           # previous versions of the services can be collected now
+        if not self.Preload:
+            self.PreloadedServices = []
+            return
+        self.PreloadedServices = load_services(self.Config, self.PreloadedServices, self.MPLogger, self)
+        for svc in self.PreloadedServices:
+            for path in svc.ReloadFileTimestamps:
+                watcher.watch(path, self.preloaded_file_changed)
+        self.freeze()
+
+    def freeze(self):
+        gc.collect()
+        if hasattr(gc, "freeze"):
+            gc.freeze()
+
+    def preloaded_file_changed(self, path):
+        # touch_reload file of a preloaded service changed: reload the service and restart the subprocesses
+        with self:
+            if hasattr(gc, "freeze"):
+                gc.unfreeze()
+            reloaded = [svc.reloadIfNeeded() for svc in self.PreloadedServices]
+            self.freeze()
+        if any(reloaded):
+            self.restart()
+
+    def start_subprocess(self, sock=None):
+        # sock: listening socket of the subprocess being replaced
+        if sock is None:
+            sock = listening_socket(self.Port, self.Backlog, reuse_port=True) if self.ReusePort else self.Sock
+        other_sockets = [p.Sock for p in self.Subprocesses] if self.ReusePort else []
+        preloaded = self.PreloadedServices if self.Preload else None
+        p = MultiServerSubprocess(self.Port, sock, self.ConfigFile, logger=self.MPLogger, other_sockets=other_sockets,
+                preloaded=preloaded)
+        p.start()
+        return p
+
+    StartTimeout = 60.0
         
     def run(self):
         if setproctitle is not None:
             setproctitle("multiserver %s master" % (self.Port,))
+        file_watcher().watch(self.ConfigFile, self.config_changed)
         while not self.Stop:
             time.sleep(5)
+            self.check_children()
+        # let the subprocesses finish the requests, daemon processes are terminated when the master exits
+        deadline = time.time() + self.DrainTimeout + 5.0
+        for p in self.Subprocesses:
+            p.join(max(0.0, deadline - time.time()))
+
+    def restart(self, *ignore, targets=None):
+        # rolling restart in a separate thread, so that it can be started by a signal handler
+        # targets: subprocesses to replace, all by default
+        with self:
+            if self.Restarting:
+                self.RestartPending = True      # restart all again when the current restart is complete
+                return
+            self.Restarting = True
+        threading.Thread(target=self.rolling_restart, args=(targets,), name="rolling restart", daemon=True).start()
+
+    def rolling_restart(self, targets=None):
+        #
+        # Replaces the subprocesses one at a time. The new subprocess loads the applications and starts accepting
+        # connections from the listening socket of the old one. Then the old subprocess is stopped gracefully.
+        # The number of subprocesses accepting connections never goes below the configured number
+        #
+        self.log("rolling restart started")
+        try:
+            for old in list(self.Subprocesses if targets is None else targets):
+                if self.Stop:
+                    break
+                if old not in self.Subprocesses:
+                    continue
+                with self:
+                    new = self.start_subprocess(old.Sock)
+                if not new.wait_ready(self.StartTimeout):
+                    self.log(f"new subprocess did not start in {self.StartTimeout} seconds. Rolling restart aborted")
+                    new.stop()
+                    break
+                with self:
+                    if old not in self.Subprocesses:
+                        # stopped or died in the meantime
+                        new.stop()
+                        continue
+                    self.Subprocesses[self.Subprocesses.index(old)] = new
+                old.stop()
+                old.join(self.DrainTimeout + 5.0)
+                self.log(f"subprocess {old.pid} replaced with {new.pid}")
+            else:
+                self.log("rolling restart complete")
+        finally:
+            with self:
+                self.Restarting = False
+                if self.RestartPending and not self.Stop:
+                    self.RestartPending = False
+                    self.restart()
+
+    def config_changed(self, path):
+        try:
             if os.path.getmtime(self.ConfigFile) > self.ReconfiguredTime:
                 self.reconfigure()
-            self.check_children()
+        except:
+            self.error("Exception in config_changed:\n", traceback.format_exc())
                 
     @synchronized
     def check_children(self, *ignore):
         #print("child died")
-        n_died = 0
+        dead_sockets = []
         alive = []
         for p in self.Subprocesses:
             if not p.is_alive():
                 print("subprocess died with status", p.exitcode, file=sys.stderr)
                 self.log("subprocess died with status", p.exitcode)
-                n_died += 1
+                dead_sockets.append(p.Sock)     # the replacement accepts connections queued for the dead one
             else:
                 alive.append(p)
         self.Subprocesses = alive
-        if n_died and not self.Stop:
+        if dead_sockets and not self.Stop:
             #time.sleep(5)   # do not restart subprocesses too often
-            for _ in range(n_died):
+            for sock in dead_sockets:
                 time.sleep(1)   # do not restart subprocesses too often
-                p = MultiServerSubprocess(self.Port, self.Sock, self.ConfigFile, logger=self.MPLogger)
-                p.start()
-                self.Subprocesses.append(p)
-                print("subprocess died with status", p.exitcode, file=sys.stderr)
+                self.Subprocesses.append(self.start_subprocess(sock))
                 self.log("started new subprocess")
                 
+    @synchronized
+    def request_stats(self, *ignore):
+        # subprocesses log their accepted connection counts
+        for p in self.Subprocesses:
+            p.request_stats()
+
     @synchronized
     def killme(self, *ignore):
         self.log("INT signal received. Stopping subprocesses...")
@@ -588,6 +885,12 @@ python multiserver.py [options] <config.yaml>
     -d                          - enable debugging
     -l (<log file>|-)           - common log file
     -r (<requests log file>|-)  - common requests file
+
+Signals:
+    HUP                         - reload the configuration
+    USR1                        - log accepted connection counts
+    USR2                        - rolling restart of the worker processes
+    INT                         - graceful stop
 """
 
 class   SignalHandler:
@@ -633,6 +936,8 @@ def main():
     signal.signal(signal.SIGHUP, ms.reconfigure)
     #signal.signal(signal.SIGCHLD, ms.child_died)
     signal.signal(signal.SIGINT, ms.killme)
+    signal.signal(signal.SIGUSR1, ms.request_stats)
+    signal.signal(signal.SIGUSR2, ms.restart)
     ms.start()
     ms.join()
 
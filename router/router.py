@@ -1,4 +1,5 @@
 from webpie import Logged, Logger, yaml_expand as expand
+from webpie.filewatch import file_watcher
 from pythreader import PyThread, synchronized
 import os, yaml, sys, time
 
@@ -13,13 +14,15 @@ class App(Logged, PyThread):
         name = config["name"]
         self.AppName = name
         PyThread.__init__(self, name=f"[app {name}]", daemon=True)
-        Logged.__init__(self, f"[app {name}]", logger, debug=True)
+        Logged.__init__(self, f"[app {name}]", logger=logger, debug=True)
         self.Config = None
         self.configure(config)
         self.Stop = False
         
     def stop(self):
-        self.Stop = True
+        with self:
+            self.Stop = True
+            self.wakeup()
 
     @synchronized
     def configure(self, config=None):
@@ -97,10 +100,19 @@ class App(Logged, PyThread):
         environ["WebPie.original_path"] = path
         return self.WSGIApp(environ, start_response)
         
+    def fileChanged(self, path):
+        self.reloadIfNeeded()
+
     def run(self):
-        while not self.Stop:
-            time.sleep(5)
-            self.reloadIfNeeded()
+        watcher = file_watcher()
+        reload_files = list(self.ReloadFileTimestamps)
+        for path in reload_files:
+            watcher.watch(path, self.fileChanged)
+        with self:
+            while not self.Stop:
+                self.sleep()
+        for path in reload_files:
+            watcher.unwatch(path, self.fileChanged)
     
 
 class Router(PyThread, Logged):
@@ -111,7 +123,7 @@ class Router(PyThread, Logged):
         #self.Config = config = yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader)
         log_file = config.get("log", "-")
         self.Logger = Logger(log_file)
-        Logged.__init__(self, "[router]", self.Logger)
+        Logged.__init__(self, "[router]", logger=self.Logger)
         PyThread.__init__(self, name="[router]", daemon=True)
         self.ConfigMTime = mtime(self.ConfigFile)
         self.Apps = None
@@ -155,18 +167,23 @@ class Router(PyThread, Logged):
             start_response("403 Application not found", [])
             return []
             
+    def configChanged(self, path):
+        mt = mtime(self.ConfigFile)
+        if mt is not None and mt > self.ConfigMTime:
+            self.log("config file modified. reloading.")
+            self.ConfigMTime = mt
+            self.Config = expand(yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader))
+            for app in self.Apps:
+                app.stop()
+            self.configure(self.Config)
+
     def run(self):
         self.log("thread started")
-        while not self.Stop:
-            time.sleep(5)
-            mt = mtime(self.ConfigFile)
-            if mt is not None and mt > self.ConfigMTime:
-                self.log("config file modified. reloading.")
-                self.ConfigMTime = mt
-                self.Config = expand(yaml.load(open(self.ConfigFile, 'r'), Loader=yaml.SafeLoader))
-                for app in self.Apps:
-                    app.stop()
-                self.configure(self.Config)
+        file_watcher().watch(self.ConfigFile, self.configChanged)
+        with self:
+            while not self.Stop:
+                self.sleep()
+        file_watcher().unwatch(self.ConfigFile, self.configChanged)
         self.log("thread ended")
     
             
@@ -0,0 +1,21 @@
+import asyncio
+from webpie import WPApp, WPHandler
+from webpie.aio import run_async_server
+
+class H(WPHandler):
+    
+    async def wait(self, request, relpath, t="1", **args):
+        await asyncio.sleep(float(t))
+        return "waited %s seconds\n" % (t,)
+        
+    async def ticks(self, request, relpath, n="5", **args):
+        async def generate():
+            for i in range(int(n)):
+                await asyncio.sleep(1)
+                yield "tick %d\n" % (i,)
+        return generate()
+        
+    def hello(self, request, relpath, **args):         # synchronous methods run in a thread pool
+        return "Hello, World!\n"
+
+run_async_server(8080, WPApp(H), max_workers=5)
@@ -45,6 +45,7 @@ setup(
             "console_scripts": [
                 "webpie_multiserver = multiserver.multiserver:main",
                 "webpie_router = router.router:main",
+                "webpie = webpie.__main__:main",
             ]
         }
     
@@ -1,6 +1,8 @@
-import fnmatch, traceback, sys, time, os.path, stat, pprint, re, signal, importlib, platform, os
+import fnmatch, traceback, sys, time, os.path, stat, pprint, re, signal, importlib, platform, os, selectors, ssl, io, select, threading
+import socket as socket_module
 
 from socket import *
+from selectors import EVENT_READ, EVENT_WRITE
 from pythreader import PyThread, synchronized, Task, TaskQueue, Primitive
 from webpie import Response
 from .uid import uid
@@ -13,46 +15,266 @@ import pythreader
 
 macos = sys.platform.lower().startswith("darwin")
 
-class BodyFile(object):
+def is_chunked(transfer_encoding):
+    # chunked must be the last transfer coding applied to the body
+    return transfer_encoding is not None and transfer_encoding.split(",")[-1].strip().lower() == "chunked"
+
+class BodyFile(io.RawIOBase):
+    
+    #
+    # Request body stream (wsgi.input): the bytes received together with the header, then the socket.
+    # Never reads past Content-Length. Chunked bodies (Transfer-Encoding: chunked) are decoded, the trailer is skipped.
+    # readinto() receives directly into the caller's buffer when nothing is buffered
+    #
     
-    def __init__(self, buf, sock, length):
+    length_limited = True       # tells webob that the stream does not need to be wrapped to enforce Content-Length
+
+    MAXMSG = 65536
+    MAXLINE = 65536
+    MAXDRAIN = 1024*1024
+
+    def __init__(self, buf, sock, length, chunked=False):
+        io.RawIOBase.__init__(self)
         #print("BodyFile: buf:", buf)
-        self.Buffer = buf
+        self.Buffer = bytearray(buf)    # received, not consumed bytes are self.Buffer[self.Pos:]
+        self.Pos = 0
         self.Sock = sock
-        self.Remaining = length
-        
-    def get_chunk(self, n):
-        #print("get_chunk: Buffer:", self.Buffer)
-        if self.Buffer:
-            out = self.Buffer[:n]
-            self.Buffer = self.Buffer[n:]
-        elif self.Sock is not None:
-            out = self.Sock.recv(n)
-            if not out: self.Sock = None
-        return out
-        
-    MAXMSG = 8192
-    
-    def read(self, N = None):
-        #print ("read({})".format(N))
-        #print ("Buffer:", self.Buffer)
-        if N is None:   N = self.Remaining
+        self.Remaining = None if chunked else length         # None - read until EOF
+        self.Chunked = chunked
+        self.ChunkRemaining = 0         # unread bytes of the current chunk
+        self.ChunkEnd = False           # CRLF after the current chunk data is not read yet
+        self.Done = False               # the last chunk and the trailer were read
+
+    def readable(self):
+        return True
+
+    #
+    # raw connection data
+    #
+
+    def buffered(self):
+        return len(self.Buffer) - self.Pos
+
+    def fill(self):
+        # receives more data into the buffer. Returns False on EOF
+        if self.Sock is None:
+            return False
+        if self.Pos:
+            del self.Buffer[:self.Pos]
+            self.Pos = 0
+        data = self.Sock.recv(self.MAXMSG)
+        if not data:
+            self.Sock = None
+            return False
+        self.Buffer += data
+        return True
+
+    def recv_into(self, view):
+        if self.Pos < len(self.Buffer):
+            n = min(len(view), len(self.Buffer) - self.Pos)
+            view[:n] = self.Buffer[self.Pos:self.Pos+n]
+            self.Pos += n
+            return n
+        if self.Sock is None:
+            return 0
+        n = self.Sock.recv_into(view)
+        if not n:
+            self.Sock = None
+        return n
+
+    def recv_line(self):
+        while self.Buffer.find(b"\n", self.Pos) < 0:
+            if self.buffered() > self.MAXLINE or not self.fill():
+                raise IOError("invalid chunked request body")
+        i = self.Buffer.index(b"\n", self.Pos) + 1
+        line = bytes(self.Buffer[self.Pos:i])
+        self.Pos = i
+        return line
+
+    #
+    # body framing
+    #
+
+    def next_chunk(self):
+        # reads the chunk size line. Returns False after the last chunk
+        if self.ChunkEnd:
+            if self.recv_line().strip():
+                raise IOError("invalid chunked request body")
+            self.ChunkEnd = False
+        try:    size = int(self.recv_line().split(b";", 1)[0].strip(), 16)
+        except ValueError:
+            raise IOError("invalid chunk size in request body")
+        if size <= 0:
+            while self.recv_line().strip():         # trailer
+                pass
+            self.Done = True
+            self.Remaining = 0
+            return False
+        self.ChunkRemaining = size
+        self.ChunkEnd = True
+        return True
+
+    def available(self, n):
+        # how many of n bytes can be read before the end of the body or the current chunk
+        if self.Chunked:
+            if self.Done or self.ChunkRemaining == 0 and not self.next_chunk():
+                return 0
+            return min(n, self.ChunkRemaining)
+        return n if self.Remaining is None else min(n, self.Remaining)
+
+    def consumed(self, n):
+        if self.Chunked:
+            if not n:
+                raise IOError("connection closed while reading chunked request body")
+            self.ChunkRemaining -= n
+        elif self.Remaining is not None:
+            self.Remaining -= n
+
+    #
+    # io.RawIOBase interface
+    #
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        n = self.available(len(view))
+        if n <= 0:
+            return 0
+        n = self.recv_into(view[:n])
+        self.consumed(n)
+        return n
+
+    def read(self, n=-1):
+        # unlike the raw read(), reads exactly n bytes unless the body ends
+        if n is None or n < 0:
+            return self.readall()
+        out = bytearray(n)
+        view = memoryview(out)
+        got = 0
+        while got < n:
+            k = self.readinto(view[got:])
+            if not k:
+                break
+            got += k
+        view.release()
+        del out[got:]
+        return bytes(out)
+
+    def readall(self):
+        if self.Remaining is not None:
+            return self.read(self.Remaining)
+        out = []
+        data = self.read(self.MAXMSG)
+        while data:
+            out.append(data)
+            data = self.read(self.MAXMSG)
+        return b''.join(out)
+
+    def readline(self, limit=-1):
         out = []
+        while limit != 0:
+            n = self.available(limit if limit > 0 else self.MAXLINE)
+            if n <= 0 or not self.buffered() and not self.fill():
+                break
+            end = self.Pos + min(n, self.buffered())
+            i = self.Buffer.find(b"\n", self.Pos, end)
+            if i >= 0:
+                end = i + 1
+            line = bytes(self.Buffer[self.Pos:end])
+            self.Pos = end
+            self.consumed(len(line))
+            out.append(line)
+            if i >= 0:
+                break
+            if limit > 0:
+                limit -= len(line)
+        return b''.join(out)
+
+    def drain(self):
+        # skip the unread part of the body so that the next request on the same connection can be read
+        # returns True if the body was consumed completely
+        if not self.Chunked and (self.Remaining is None or self.Remaining > self.MAXDRAIN):
+            return False
+        scratch = bytearray(self.MAXMSG)
         n = 0
-        eof = False
-        while not eof and (N is None or n < N):
-            ntoread = self.MAXMSG if N is None else N - n
-            chunk = self.get_chunk(ntoread)
-            if not chunk:
-                eof = True
-            else:
-                n += len(chunk)
-                out.append(chunk)
-        out = b''.join(out)
-        if self.Remaining is not None:
-            self.Remaining -= len(out)
-        #print ("returning:[{}]".format(out))
-        return out
+        try:
+            while n <= self.MAXDRAIN:
+                k = self.readinto(scratch)
+                if not k:
+                    break
+                n += k
+        except IOError:
+            return False
+        return self.Done if self.Chunked else self.Remaining == 0
+        
+    def leftover(self):
+        # bytes received after the end of the body, e.g. next pipelined request
+        return bytes(self.Buffer[self.Pos:]) if self.Remaining == 0 else b''
+
+class HTTPHeaders(object):
+    
+    #
+    # Case-insensitive multi-valued header map.
+    # The mapping interface returns all values of a header combined into one string, as RFC 7230 allows,
+    # getall() and allitems() return individual values
+    #
+    
+    def __init__(self):
+        self.Map = {}           # lower case name -> (name, [values])
+        
+    def add(self, name, value):
+        key = name.lower()
+        entry = self.Map.get(key)
+        if entry is None:
+            self.Map[key] = (name, [value])
+        else:
+            entry[1].append(value)
+            
+    @staticmethod
+    def combine(key, values):
+        if len(values) == 1:
+            return values[0]
+        return ("; " if key == "cookie" else ", ").join(values)
+
+    def getall(self, name):
+        entry = self.Map.get(name.lower())
+        return list(entry[1]) if entry is not None else []
+
+    def get(self, name, default=None):
+        key = name.lower()
+        entry = self.Map.get(key)
+        return default if entry is None else self.combine(key, entry[1])
+        
+    def __getitem__(self, name):
+        key = name.lower()
+        return self.combine(key, self.Map[key][1])
+        
+    def __setitem__(self, name, value):
+        self.Map[name.lower()] = (name, list(value) if isinstance(value, list) else [value])
+        
+    def __delitem__(self, name):
+        del self.Map[name.lower()]
+
+    def __contains__(self, name):
+        return name.lower() in self.Map
+        
+    def __len__(self):
+        return len(self.Map)
+        
+    def __iter__(self):
+        return (name for name, _ in self.Map.values())
+        
+    keys = __iter__
+
+    def items(self):
+        return [(name, self.combine(key, values)) for key, (name, values) in self.Map.items()]
+        
+    def allitems(self):
+        return [(name, v) for name, values in self.Map.values() for v in values]
+        
+    def __str__(self):
+        return "HTTPHeaders(%s)" % (self.allitems(),)
+        
+    __repr__ = __str__
 
 class HTTPHeader(object):
 
@@ -64,9 +286,9 @@ class HTTPHeader(object):
         self.Protocol = None
         self.URI = None
         self.OriginalURI = None
-        self.Headers = {}
+        self.Headers = HTTPHeaders()
         self.Raw = b""
-        self.Buffer = b""
+        self.Buffer = bytearray()
         self.Complete = False
         self.Error = None
         
@@ -75,21 +297,28 @@ class HTTPHeader(object):
         
     __repr__ = __str__
 
-    def recv(self, sock):
+    RECV_SIZE = 16384
+
+    def recv(self, sock, timeout=15.0, buffered=b''):
         tmo = sock.gettimeout()
-        sock.settimeout(15.0)
+        sock.settimeout(timeout)
         received = eof = False
         self.Error = None
         try:
             body = b''
+            if buffered:
+                # bytes already read from the connection, e.g. pipelined after previous request
+                received, error, body = self.consume(buffered)
+            chunk = bytearray(self.RECV_SIZE)
+            view = memoryview(chunk)
             while not received and not self.Error and not eof:       # shutdown() will set it to None
                 try:    
-                    data = sock.recv(1024)
+                    n = sock.recv_into(view)
                 except Exception as e:
                     self.Error = "Error in recv(): %s" % (e,)
-                    data = b''
-                if data:
-                    received, error, body = self.consume(data)
+                    n = 0
+                if n:
+                    received, error, body = self.consume(view[:n])
                 else:
                     eof = True
         finally:
@@ -115,11 +344,20 @@ class HTTPHeader(object):
     MAXREAD = 100000
 
     def consume(self, inp):
+        # inp: bytes, bytearray or memoryview
+        # only the newly received bytes, plus 3 preceding ones, are searched for the end of the header
         #print(self, ".consume(): inp:", inp)
-        header_buffer = self.Buffer + inp
-        match = self.EOH_RE.search(header_buffer)
+        if self.Buffer:
+            header_buffer = self.Buffer
+            start = max(0, len(header_buffer) - 3)
+            header_buffer += inp
+        else:
+            header_buffer = inp         # common case: whole header in one chunk, no copying
+            start = 0
+        match = self.EOH_RE.search(header_buffer, start)
         if not match:   
-            self.Buffer = header_buffer
+            if header_buffer is inp:
+                self.Buffer = header_buffer = bytearray(inp)
             error = False
             if len(header_buffer) > self.MAXREAD:
                 self.Error = "Request is too long: %d" % (len(header_buffer),)
@@ -127,13 +365,12 @@ class HTTPHeader(object):
             return False, error, b''
         i1, i2 = match.span()            
         self.Complete = True
-        self.Raw = header = header_buffer[:i1]
-        rest = header_buffer[i2:]
-        headers = {}
-        header = to_str(header)
-        lines = [l.strip() for l in header.split("\n")]
+        self.Raw = header = bytes(header_buffer[:i1])
+        rest = bytes(header_buffer[i2:])
+        self.Buffer = bytearray()
+        lines = to_str(header).split("\n")
         if lines:
-            self.Headline = headline = lines[0]
+            self.Headline = headline = lines[0].strip()
             
             words = headline.split(" ", 2)
             #print ("HTTPHeader: headline:", headline, "    words:", words)
@@ -149,16 +386,30 @@ class HTTPHeader(object):
                 self.Protocol = words[2].upper()
                 self.URI = self.OriginalURI = words[1]
                     
+            header_map = self.Headers.Map
+            values = None
             for l in lines[1:]:
-                if not l:   continue
-                try:   
-                    h, b = tuple(l.split(':', 1))
-                    headers[h.strip()] = b.strip()
-                except: pass
-            self.Headers = headers
-        self.Buffer = b""
+                if l[:1] in (" ", "\t") and values is not None:
+                    # obsolete line folding
+                    values[-1] = values[-1] + " " + l.strip()
+                    continue
+                h, colon, b = l.partition(':')
+                if colon:
+                    h = h.strip()
+                    key = h.lower()
+                    entry = header_map.get(key)
+                    if entry is None:
+                        values = [b.strip()]
+                        header_map[key] = (h, values)
+                    else:
+                        values = entry[1]
+                        values.append(b.strip())
         return True, False, rest
 
+    def get(self, name, default=None):
+        # case-insensitive header lookup
+        return self.Headers.get(name, default)
+
     def path(self):
         return self.URI.split("?",1)[0]
 
@@ -168,6 +419,13 @@ class HTTPHeader(object):
         else:
              return ""
 
+    def keep_alive(self):
+        # whether the client wants the connection to persist, RFC 7230, section 6.3
+        tokens = [t.strip() for t in self.get("Connection", "").lower().split(",")]
+        if "close" in tokens:
+            return False
+        return self.Protocol == "HTTP/1.1" or "keep-alive" in tokens
+
     def removeKeepAlive(self):
         if "Connection" in self.Headers:
             self.Headers["Connection"] = "close"
@@ -176,13 +434,7 @@ class HTTPHeader(object):
         self.Headers["Connection"] = "close"
 
     def headersAsText(self):
-        headers = []
-        for k, v in self.Headers.items():
-            if isinstance(v, list):
-                for vv in v:
-                    headers.append("%s: %s" % (k, vv))
-            else:
-                headers.append("%s: %s" % (k, v))
+        headers = ["%s: %s" % (k, v) for k, v in self.Headers.allitems()]
         return "\r\n".join(headers) + "\r\n"
 
     def headline(self, original=False):
@@ -197,6 +449,219 @@ class HTTPHeader(object):
     def as_bytes(self, original=False):
         return to_bytes(self.as_text(original))
 
+def writable(sock):
+    # whether the socket can accept more data now
+    if hasattr(select, "poll"):
+        p = select.poll()
+        p.register(sock, select.POLLOUT)
+        return bool(p.poll(0))
+    return bool(select.select([], [sock], [], 0)[1])
+
+class ResponseWriter(object):
+    
+    #
+    # Gathers the response header and body chunks and sends them with a single sendmsg() call
+    # per up to HighWater bytes. Data buffered for longer than the flusher's interval is sent by the WriteFlusher
+    # thread, so streaming responses are not delayed while the application is producing the next chunk.
+    # The flusher sends only as much as the socket accepts without blocking, so a slow client does not delay
+    # other responses. Writing an empty chunk flushes the buffer immediately.
+    #
+    
+    IOV_MAX = 1024
+    
+    def __init__(self, sock, high_water=0, flusher=None):
+        self.Sock = sock
+        self.HighWater = high_water             # 0 - no coalescing
+        self.Flusher = flusher
+        self.Parts = []
+        self.Size = 0
+        self.Since = None                       # time when the oldest buffered part was added
+        self.Error = None
+        self.Lock = threading.Lock()
+        self.Vectored = hasattr(sock, "sendmsg") and not isinstance(sock, ssl.SSLSocket)
+        if not self.Vectored:
+            # the WriteFlusher can not send to TLS sockets without blocking, so nothing is held back
+            self.HighWater = 0
+            self.Flusher = None
+        
+    def write(self, *parts):
+        # the parts, e.g. chunk size line, chunk data and CRLF, are sent together
+        with self.Lock:
+            if self.Error is not None:
+                raise self.Error
+            flush = False
+            for data in parts:
+                if data:
+                    self.Parts.append(data)
+                    self.Size += len(data)
+                else:
+                    flush = True
+            if self.Parts and self.Since is None:
+                self.Since = time.time()
+                if self.Flusher is not None and self.Size < self.HighWater:
+                    self.Flusher.add(self)
+            if flush or self.Size >= self.HighWater:
+                self.send()
+    
+    def flush_if_older(self, t):
+        # called by the WriteFlusher. Does not wait for the lock held by the request thread, which is sending itself,
+        # or for the socket. The writer is removed from the flusher when everything is sent
+        if not self.Lock.acquire(blocking=False):
+            return
+        try:
+            if self.Since is not None and self.Since <= t:
+                try:    self.send_available()
+                except Exception as e:
+                    self.Error = e
+                    self.Parts = []
+                    self.Size = 0
+                    self.Since = None
+            if self.Since is None:
+                self.Flusher.remove(self)
+        finally:
+            self.Lock.release()
+            
+    def flush(self):
+        with self.Lock:
+            self.send()
+            
+    def consume(self, sent):
+        # removes sent bytes from the beginning of self.Parts
+        self.Size -= sent
+        while sent:
+            n = len(self.Parts[0])
+            if sent < n:
+                self.Parts[0] = memoryview(self.Parts[0])[sent:]
+                break
+            sent -= n
+            self.Parts.pop(0)
+        if not self.Parts:
+            self.Since = None
+
+    def send_available(self):
+        # sends as much as the socket accepts without blocking
+        while self.Parts and writable(self.Sock):
+            try:    sent = self.Sock.sendmsg(self.Parts[:self.IOV_MAX], [], MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            self.consume(sent)
+        
+    def send(self):
+        parts = self.Parts
+        if len(parts) == 1 or parts and not self.Vectored:
+            self.Sock.sendall(b''.join(parts) if len(parts) > 1 else parts[0])
+            self.Parts = []
+            self.Size = 0
+            self.Since = None
+            return
+        while self.Parts:
+            self.consume(self.Sock.sendmsg(self.Parts[:self.IOV_MAX]))
+        
+    def close(self):
+        # discards unsent data
+        if self.Flusher is not None:
+            self.Flusher.remove(self)
+        with self.Lock:
+            self.Parts = []
+            self.Since = None
+
+class FileWrapper(object):
+    
+    #
+    # wsgi.file_wrapper implementation. RequestProcessor sends the file with socket.sendfile(), which uses
+    # os.sendfile() for plain sockets, or with large reads for TLS sockets.
+    # Iteration is supported for middleware, which needs to see the content
+    #
+    
+    TLS_BLOCK = 256*1024
+    
+    def __init__(self, filelike, blksize=8192, offset=0, length=None):
+        self.File = filelike
+        self.BlockSize = blksize
+        self.Offset = offset
+        self.Length = length            # None - to the end of the file
+        if hasattr(filelike, "close"):
+            self.close = filelike.close
+            
+    def __iter__(self):
+        if self.Offset:
+            self.File.seek(self.Offset)
+        remaining = self.Length
+        while remaining is None or remaining > 0:
+            data = self.File.read(self.BlockSize if remaining is None else min(self.BlockSize, remaining))
+            if not data:    break
+            if remaining is not None:
+                remaining -= len(data)
+            yield data
+
+    def sendfile(self, sock):
+        # returns number of bytes sent
+        if not isinstance(sock, ssl.SSLSocket):
+            try:    self.File.fileno()
+            except (AttributeError, OSError, io.UnsupportedOperation):
+                pass
+            else:
+                return sock.sendfile(self.File, self.Offset, self.Length)
+        sent = 0
+        blksize = self.BlockSize
+        self.BlockSize = max(blksize, self.TLS_BLOCK)
+        try:
+            for data in self:
+                sock.sendall(data)
+                sent += len(data)
+        finally:
+            self.BlockSize = blksize
+        return sent
+
+class corked(object):
+    
+    # context, in which the TCP socket holds partial frames so that the response header goes out
+    # in the same segment as the beginning of a file sent with sendfile()
+    
+    def __init__(self, sock):
+        self.Sock = sock if hasattr(socket_module, "TCP_CORK") and not isinstance(sock, ssl.SSLSocket) else None
+        
+    def __enter__(self):
+        if self.Sock is not None:
+            try:    self.Sock.setsockopt(IPPROTO_TCP, socket_module.TCP_CORK, 1)
+            except: self.Sock = None
+        return self
+        
+    def __exit__(self, *params):
+        if self.Sock is not None:
+            try:    self.Sock.setsockopt(IPPROTO_TCP, socket_module.TCP_CORK, 0)
+            except: pass
+
+class WriteFlusher(PyThread):
+    
+    # sends out data buffered by ResponseWriters for longer than the flush interval
+    
+    def __init__(self, interval):
+        PyThread.__init__(self, name="[write flusher]", daemon=True)
+        self.Interval = interval
+        self.Writers = set()
+        
+    def add(self, writer):
+        with self:
+            self.Writers.add(writer)
+            self.wakeup()
+            
+    def remove(self, writer):
+        with self:
+            self.Writers.discard(writer)
+            
+    def run(self):
+        while True:
+            with self:
+                while not self.Writers:
+                    self.sleep()
+            time.sleep(self.Interval)
+            with self:
+                writers = list(self.Writers)
+            t = time.time() - self.Interval
+            for w in writers:
+                w.flush_if_older(t)         # removes the writer when it has nothing to flush
+
 class RequestProcessor(Task):
     
     def __init__(self, wsgi_app, request):
@@ -208,17 +673,22 @@ class RequestProcessor(Task):
         self.StatusCode = None
         self.ByteCount = 0
         self.Error = None
+        self.KeepAlive = False
+        self.Delimited = False
+        self.Chunked = False
 
     def run(self):       
         request = self.Request
+        keep_alive = False
         #print("Task: request:", request)
         try:
             env = request.wsgi_env() 
             header = request.HTTPHeader
             csock = request.CSock
 
-            if env["WebPie.headers"].get("Expect") == "100-continue":
-                csock.sendall(b'HTTP/1.1 100 Continue\n\n')
+            if header.get("Expect", "").lower() == "100-continue":
+                csock.sendall(b'HTTP/1.1 100 Continue\r\n\r\n')
+            writer = request.writer()
                     
             out = []
             
@@ -235,24 +705,41 @@ class RequestProcessor(Task):
             
 
             #print("RequestProcessor.run: out:", out)
-            if self.OutBuffer:      # from start_response
-                #print("RequestProcessor.run: OutBuffer:", self.OutBuffer)
-                csock.sendall(to_bytes(self.OutBuffer))
-                
             self.ByteCount = 0
-
-            for line in out:
-                line = to_bytes(line)
-                try:
-                    #print("sending line:", line)    
-                    csock.sendall(line)
-                    #print("HTTPServer: sent:", line)
-                except Exception as e:
-                    return self.error("error sending body: %s" % (e,))
-                self.ByteCount += len(line)
+            try:
+                if self.OutBuffer:      # from start_response, to be sent together with the beginning of the body
+                    #print("RequestProcessor.run: OutBuffer:", self.OutBuffer)
+                    writer.write(to_bytes(self.end_header(out)))
+                if isinstance(out, FileWrapper):
+                    with corked(csock):
+                        writer.flush()
+                        self.ByteCount = out.sendfile(csock)
+                elif self.Chunked:
+                    for line in out:
+                        line = to_bytes(line)
+                        if line:
+                            writer.write(b"%x\r\n" % (len(line),), line, b"\r\n")
+                            self.ByteCount += len(line)
+                        else:
+                            writer.write(line)      # flush
+                    writer.write(b"0\r\n\r\n")
+                else:
+                    for line in out:
+                        line = to_bytes(line)
+                        #print("sending line:", line)    
+                        writer.write(line)
+                        self.ByteCount += len(line)
+                writer.flush()
+            except Exception as e:
+                return self.error("error sending body: %s" % (e,))
+            finally:
+                writer.close()
+                if hasattr(out, "close"):
+                    out.close()
+            keep_alive = self.KeepAlive and request.drain_body()
         finally:
             #print("HTTPServer: closing request...")
-            request.close()
+            request.finish(keep_alive)
             self.OutBuffer = None
             self.WSGIApp = None
 
@@ -262,12 +749,34 @@ class RequestProcessor(Task):
     def start_response(self, status, headers):
         self.StatusCode = int(status.split(None, 1)[0])
         out = ["HTTP/1.1 " + status]
+        # the connection can persist only if the client can find the end of the response without EOF
+        delimited = self.StatusCode//100 == 1 or self.StatusCode in (204, 304) \
+                or self.Request.HTTPHeader.Method == "HEAD"
         for h,v in headers:
-            if h != "Connection":
-                out.append("%s: %s" % (h, v))
-        out.append("Connection: close")     # can not handle keep-alive
+            hl = h.lower()
+            if hl == "connection":
+                continue
+            if hl == "content-length" or hl == "transfer-encoding" and "chunked" in v.lower():
+                delimited = True
+            out.append("%s: %s" % (h, v))
+        self.Delimited = delimited
+        self.OutBuffer = out
+
+    def end_header(self, body):
+        # completes the header once the body object is known. The body of unknown length is delimited
+        # with Content-Length if it is a list, otherwise sent with chunked encoding to HTTP/1.1 clients
+        out = self.OutBuffer
+        if not self.Delimited:
+            if isinstance(body, (list, tuple)):
+                out.append("Content-Length: %d" % (sum(len(to_bytes(x)) for x in body),))
+                self.Delimited = True
+            elif self.Request.HTTPHeader.Protocol == "HTTP/1.1" and not isinstance(body, FileWrapper):
+                out.append("Transfer-Encoding: chunked")
+                self.Delimited = self.Chunked = True
+        self.KeepAlive = self.Delimited and self.Request.KeepAlive
+        out.append("Connection: keep-alive" if self.KeepAlive else "Connection: close")
         out.append(f"X-WebPie-Request-Id: {self.Request.Id}")
-        self.OutBuffer = "\r\n".join(out) + "\r\n\r\n"
+        return "\r\n".join(out) + "\r\n\r\n"
 
 class Service(Logged):
     
@@ -309,16 +818,41 @@ class Service(Logged):
 
 class Request(object):
     
-    def __init__(self, port, csock, caddr):
+    def __init__(self, port, csock, caddr, server=None, sequence=0, buffered=b''):
         self.Id = uid()
         self.ServerPort = port
         self.CSock = csock
         self.CAddr = caddr
+        self.Server = server
+        self.Sequence = sequence        # number of requests received earlier on the same connection
+        self.Buffered = buffered        # bytes received on the connection but not consumed by previous request
         self.HTTPHeader = None
         self.Body = b''
+        self.BodyFile = None
         self.SSLInfo = None     
         self.AppName = None
         self.Environ = {}
+        self.KeepAlive = False
+        
+    def writer(self):
+        server = self.Server
+        if server is None:
+            return ResponseWriter(self.CSock)
+        return ResponseWriter(self.CSock, server.WriteBuffer, server.writeFlusher())
+
+    def drain_body(self):
+        # make sure the request body is read completely so that the connection can be reused
+        if self.BodyFile is None:
+            return False
+        return self.BodyFile.drain()
+
+    def finish(self, keep_alive=False):
+        if keep_alive and self.Server is not None and self.CSock is not None:
+            self.Server.connection_continued(self)
+            self.CSock = None           # the socket now belongs to the next request
+            self.SSLInfo = None
+        else:
+            self.close()
         
     def close(self):
         if self.CSock is not None:
@@ -350,6 +884,7 @@ class Request(object):
         env["REQUEST_SCHEME"] = env["wsgi.url_scheme"] = "http"
         env["WebPie.request_id"] = self.Id
         env["WebPie.headers"] = header.Headers
+        env["wsgi.file_wrapper"] = FileWrapper
 
         if ssl_info != None:
             subject, issuer = self.x509_names(ssl_info)
@@ -375,7 +910,13 @@ class Request(object):
             else:
                 env["HTTP_%s" % (h.upper().replace("-","_"),)] = v
 
-        env["wsgi.input"] = BodyFile(self.Body, csock, body_length)
+        chunked = is_chunked(header.get("Transfer-Encoding"))
+        if chunked:
+            env.pop("CONTENT_LENGTH", None)         # Transfer-Encoding overrides Content-Length
+            env["wsgi.input_terminated"] = True
+        elif body_length is None and self.KeepAlive:
+            body_length = 0         # on a persistent connection, no Content-Length means no body
+        env["wsgi.input"] = self.BodyFile = BodyFile(self.Body, csock, body_length, chunked)
         return env
 
     def parseQuery(self, query):
@@ -421,13 +962,16 @@ class RequestReader(Task, Logged):
 
     MAXMSG = 100000
 
-    def __init__(self, dispatcher, request, socket_wrapper, timeout, logger):
+    HeaderTimeout = 15.0
+
+    def __init__(self, dispatcher, request, socket_wrapper, timeout, logger, header_timeout=HeaderTimeout):
         Task.__init__(self)
         self.Request = request       
         Logged.__init__(self, f"[RequestReader {request.Id} client:%s:%s]" % request.CAddr, logger=logger, debug=True)
         self.SocketWrapper = socket_wrapper
         self.Dispatcher = dispatcher
         self.Timeout = timeout
+        self.HeaderTimeout = header_timeout
         self.debug("created")
 
     def __str__(self):
@@ -464,10 +1008,15 @@ class RequestReader(Task, Logged):
             if not error:
                 #print("no error")
                 header = HTTPHeader()
-                request_received, body = header.recv(csock)
+                request_received, body = header.recv(csock, self.HeaderTimeout, request.Buffered)
                 csock.settimeout(saved_timeout) 
                 
-                if not request_received or not header.is_valid() or not header.is_client():
+                if not request_received and request.Sequence > 0 and not header.Buffer:
+                    # persistent connection closed by the client or idle for too long
+                    dispatch_status = "idle"
+                    header = None
+                    return None
+                elif not request_received or not header.is_valid() or not header.is_client():
                     # header not received - end
                     #print("request invalid header.Error=", header.Error)
                     #print("   request_received:", request_received)
@@ -483,33 +1032,169 @@ class RequestReader(Task, Logged):
                 else:
                     request.HTTPHeader = header
                     request.Body = body
+                    request.KeepAlive = self.Dispatcher.keepAliveAllowed(request)
                     self.debug("request received")
                     dispatched, service, dispatch_status = self.Dispatcher.dispatch(self.Request)
         finally:
             if not dispatched:
-                if header is not None and header.Complete:
-                    #print("dispatch status:", dispatch_status)
-                    if dispatch_status == "no match":
-                        request.send_response(404, "Service not found")
-                    elif dispatch_status == "service unavailable":
-                        request.send_response(503, "Service unavailable")
-                    elif dispatch_status == "invalid request":
-                        request.send_response(400, "Invalid request")
-                    else:
-                        request.send_response(500, "Request dispatch error " + dispatch_status)
-                    self.log('%s %s:%s :%s %s %s -> (%s)' % 
-                        (   request.Id, request.CAddr[0], request.CAddr[1], request.ServerPort, 
-                            header.Method, header.OriginalURI, dispatch_status
-                        )
-                    )
-                else:
-                    self.log('%s:%s :%s (request reading error)' % 
-                        (   request.CAddr[0], request.CAddr[1], request.ServerPort)
-                    )
-                request.close()
-                    
+                self.Dispatcher.requestFailed(request, header, dispatch_status)
             self.SocketWrapper = self.Dispatcher = self.Logger = None
 
+class PendingConnection(object):
+    
+    # state of a connection, which is waiting for the request header to be received by the ConnectionSelector
+    
+    def __init__(self, request, handshake, deadline):
+        self.Request = request
+        self.Header = HTTPHeader()
+        self.Handshake = handshake          # TLS handshake is still to be done
+        self.Deadline = deadline
+        self.SavedTimeout = request.CSock.gettimeout()
+        self.Events = EVENT_READ
+
+class ConnectionSelector(PyThread, Logged):
+    
+    #
+    # Receives request headers for all open connections in a single thread.
+    # Only completely received requests are dispatched to the services, so the number of threads
+    # depends on the number of active requests, not on the number of idle or slow clients
+    #
+    
+    RECV_SIZE = 16384
+    SELECT_INTERVAL = 1.0
+    
+    def __init__(self, server, logger=None):
+        PyThread.__init__(self, name=f"[selector {server.Port}]", daemon=True)
+        Logged.__init__(self, f"[selector {server.Port}]", logger=logger)
+        self.Server = server
+        self.Selector = selectors.DefaultSelector()
+        self.WakeUpIn, self.WakeUpOut = socketpair()
+        self.WakeUpIn.setblocking(False)
+        self.Selector.register(self.WakeUpIn, EVENT_READ, None)
+        self.Added = []
+        self.Stop = False
+        self.Draining = False
+        self.RecvBuffer = memoryview(bytearray(self.RECV_SIZE))     # shared by all connections
+        
+    def add(self, request, socket_wrapper, timeout):
+        # called by other threads
+        with self:
+            self.Added.append((request, socket_wrapper, time.time() + timeout))
+        try:    self.WakeUpOut.send(b'x')
+        except: pass
+        
+    def stop(self):
+        self.Stop = True
+        try:    self.WakeUpOut.send(b'x')
+        except: pass
+
+    def drain(self):
+        # close idle keep-alive connections, continue receiving requests on other connections
+        self.Draining = True
+        try:    self.WakeUpOut.send(b'x')
+        except: pass
+
+    def connectionCount(self):
+        with self:
+            return len(self.Added) + len(self.Selector.get_map()) - 1      # not counting the wake-up socket
+        
+    def register_added(self):
+        with self:
+            added, self.Added = self.Added, []
+        for request, socket_wrapper, deadline in added:
+            try:
+                if socket_wrapper is not None:
+                    request.CSock, request.SSLInfo = socket_wrapper.wrap(request.CSock, handshake=False)
+                conn = PendingConnection(request, socket_wrapper is not None, deadline)
+                request.CSock.setblocking(False)
+                if request.Buffered:
+                    received, error, body = conn.Header.consume(request.Buffered)
+                    if received or error:
+                        self.received(conn, body)
+                        continue
+                self.Selector.register(request.CSock, EVENT_READ, conn)
+            except Exception as e:
+                self.debug("Error registering connection: %s" % (e,))
+                self.Server.requestFailed(request, None, "error")
+            
+    def modify(self, conn, events):
+        if conn.Events != events:
+            self.Selector.modify(conn.Request.CSock, events, conn)
+            conn.Events = events
+            
+    def close(self, conn, status):
+        try:    self.Selector.unregister(conn.Request.CSock)
+        except (KeyError, ValueError):  pass        # already unregistered
+        self.Server.requestFailed(conn.Request, conn.Header, status)
+
+    def process(self, conn):
+        request = conn.Request
+        csock = request.CSock
+        if conn.Handshake:
+            try:    csock.do_handshake()
+            except ssl.SSLWantReadError:
+                return self.modify(conn, EVENT_READ)
+            except ssl.SSLWantWriteError:
+                return self.modify(conn, EVENT_WRITE)
+            conn.Handshake = False
+            self.modify(conn, EVENT_READ)
+        while True:
+            try:    n = csock.recv_into(self.RecvBuffer)
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return
+            if not n:
+                return self.close(conn, "idle" if request.Sequence > 0 and not conn.Header.Buffer else "eof")
+            received, error, body = conn.Header.consume(self.RecvBuffer[:n])
+            if received or error:
+                self.Selector.unregister(csock)
+                return self.received(conn, body)
+            if not (conn.Request.SSLInfo is not None and csock.pending()):
+                return
+
+    def received(self, conn, body):
+        request = conn.Request
+        header = conn.Header
+        request.CSock.settimeout(conn.SavedTimeout)
+        if header.Error or not header.is_valid() or not header.is_client():
+            self.debug("request invalid: %s" % (header.Error,))
+            return self.Server.requestFailed(request, header, "invalid request")
+        request.HTTPHeader = header
+        request.Body = body
+        request.KeepAlive = self.Server.keepAliveAllowed(request)
+        dispatched, service, dispatch_status = self.Server.dispatch(request)
+        if not dispatched:
+            self.Server.requestFailed(request, header, dispatch_status)
+
+    def expire(self):
+        now = time.time()
+        expired = [key.data for key in self.Selector.get_map().values() 
+                if key.data is not None and (key.data.Deadline < now 
+                    or self.Draining and key.data.Request.Sequence > 0 and not key.data.Header.Buffer)]
+        for conn in expired:
+            request = conn.Request
+            self.close(conn, "idle" if request.Sequence > 0 and not conn.Header.Buffer else "timeout")
+
+    def run(self):
+        while not self.Stop:
+            for key, events in self.Selector.select(self.SELECT_INTERVAL):
+                conn = key.data
+                if conn is None:
+                    try:    self.WakeUpIn.recv(4096)
+                    except BlockingIOError: pass
+                else:
+                    try:    self.process(conn)
+                    except Exception as e:
+                        self.debug("Error reading request: %s" % (e,))
+                        self.close(conn, "error")
+            self.register_added()
+            self.expire()
+        for key in list(self.Selector.get_map().values()):
+            if key.data is not None:
+                self.close(key.data, "idle")
+        self.Selector.close()
+        self.WakeUpIn.close()
+        self.WakeUpOut.close()
+
 class SSLSocketWrapper(object):
      
     def __init__(self, certfile, keyfile, verify, ca_file, password, allow_proxies=False):
@@ -538,21 +1223,38 @@ class SSLSocketWrapper(object):
         
         self.SSLContext.load_default_certs()
             
-    def wrap(self, sock):
-        ssl_socket = self.SSLContext.wrap_socket(sock, server_side=True)
+    def wrap(self, sock, handshake=True):
+        ssl_socket = self.SSLContext.wrap_socket(sock, server_side=True, do_handshake_on_connect=handshake)
         return ssl_socket, ssl_socket
 
+def listening_socket(port, backlog=1024, reuse_port=False):
+    # with reuse_port, several processes can bind their own sockets to the same port, and the kernel distributes
+    # new connections between them
+    sock = socket(AF_INET, SOCK_STREAM)
+    sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    if reuse_port:
+        if not hasattr(socket_module, "SO_REUSEPORT"):
+            raise ValueError("SO_REUSEPORT is not supported on this platform")
+        sock.setsockopt(SOL_SOCKET, socket_module.SO_REUSEPORT, 1)
+    sock.bind(('', port))
+    sock.listen(backlog)
+    return sock
+
 class HTTPServer(PyThread, Logged):
 
     def __init__(self, port, app=None, services=[], sock=None, logger=None, max_connections = 100,
-                timeout = 20.0,
+                timeout = 20.0, backlog = 1024, reuse_port = False,
                 enabled = True, max_queued = 100,
+                keep_alive = False, keepalive_timeout = 5.0, max_requests_per_connection = 100,
+                selector = False, write_buffer = 65536, flush_interval = 0.01,
                 logging = False, log_file = "-", debug=False,
                 certfile=None, keyfile=None, verify="none", ca_file=None, password=None, allow_proxies=False, **pythread_kv
                 ):
         PyThread.__init__(self, **pythread_kv)
         self.Port = port
         self.Sock = sock
+        self.Backlog = backlog
+        self.ReusePort = reuse_port
         assert self.Port is not None, "Port must be specified"
         if logger is None and logging:
             logger = Logger(log_file)
@@ -560,9 +1262,20 @@ class HTTPServer(PyThread, Logged):
         Logged.__init__(self, f"[server {self.Port}]", logger=logger, debug=debug)
         self.Logger = logger
         self.Timeout = timeout
+        self.KeepAlive = keep_alive
+        self.KeepAliveTimeout = keepalive_timeout
+        self.MaxRequestsPerConnection = max_requests_per_connection
+        self.WriteBuffer = write_buffer
+        self.FlushInterval = flush_interval
+        self.WriteFlusher = None
         max_connections =  max_connections
         queue_capacity = max_queued
         self.RequestReaderQueue = TaskQueue(max_connections, capacity=max_queued, delegate=self)
+        self.Selector = None
+        if selector:
+            # request headers are read by a single thread, RequestReaderQueue is not used
+            self.Selector = ConnectionSelector(self, logger=logger)
+            self.Selector.start()
         self.SocketWrapper = SSLSocketWrapper(certfile, keyfile, verify, ca_file, password,
                 allow_proxies=allow_proxies) if keyfile else None
         
@@ -575,6 +1288,8 @@ class HTTPServer(PyThread, Logged):
     def close(self):
         self.RequestReaderQueue.hold()
         self.Stop = True
+        if self.Selector is not None:
+            self.Selector.stop()
         try:    
             self.Sock.close()
         except Exception as e:
@@ -588,6 +1303,14 @@ class HTTPServer(PyThread, Logged):
         timeout = config.get("timeout", 20.0)
         max_connections = config.get("max_connections", 100)
         queue_capacity = config.get("queue_capacity", 100)
+        keep_alive = config.get("keep_alive", False)
+        keepalive_timeout = config.get("keepalive_timeout", 5.0)
+        max_requests_per_connection = config.get("max_requests_per_connection", 100)
+        selector = config.get("selector", False)
+        write_buffer = config.get("write_buffer", 65536)
+        flush_interval = config.get("flush_interval", 0.01)
+        backlog = config.get("backlog", 1024)
+        reuse_port = config.get("reuse_port", False)
 
         # TLS
         certfile = config.get("cert")
@@ -599,11 +1322,21 @@ class HTTPServer(PyThread, Logged):
         #print("HTTPServer.from_config: services:", services)
         
         return HTTPServer(port, services=services, logger=logger, max_connections=max_connections,
-                timeout = timeout, max_queued = queue_capacity, 
+                timeout = timeout, max_queued = queue_capacity, backlog = backlog, reuse_port = reuse_port,
+                keep_alive = keep_alive, keepalive_timeout = keepalive_timeout,
+                max_requests_per_connection = max_requests_per_connection,
+                selector = selector, write_buffer = write_buffer, flush_interval = flush_interval,
                 logging = logging, log_file=log_file, debug=debug,
                 certfile=certfile, keyfile=keyfile, verify=verify, ca_file=ca_file, password=password
         )
     
+    @synchronized
+    def writeFlusher(self):
+        if self.WriteBuffer and self.WriteFlusher is None:
+            self.WriteFlusher = WriteFlusher(self.FlushInterval)
+            self.WriteFlusher.start()
+        return self.WriteFlusher
+
     @synchronized
     def setServices(self, services):
         self.Services = services
@@ -611,13 +1344,32 @@ class HTTPServer(PyThread, Logged):
     def connectionCount(self):
         return len(self.Connections)    
 
+    def drain(self, timeout):
+        #
+        # graceful shutdown: stops accepting keep-alive requests, closes idle keep-alive connections and waits until
+        # requests on the connections already accepted are received and passed to the services.
+        # Returns number of connections left unprocessed after the timeout
+        #
+        self.Stop = True
+        deadline = time.time() + timeout
+        if self.Selector is not None:
+            self.Selector.drain()
+        while self.pendingConnections() and time.time() < deadline:
+            time.sleep(0.05)
+        left = self.pendingConnections()
+        self.close()
+        return left
+
+    def pendingConnections(self):
+        n = len(self.RequestReaderQueue)
+        if self.Selector is not None:
+            n += self.Selector.connectionCount()
+        return n
+
     def run(self):
         if self.Sock is None:
             # therwise use the socket supplied to the constructior
-            self.Sock = socket(AF_INET, SOCK_STREAM)
-            self.Sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-            self.Sock.bind(('', self.Port))
-            self.Sock.listen(10)
+            self.Sock = listening_socket(self.Port, self.Backlog, self.ReusePort)
         while not self.Stop:
             self.debug("--- accept loop port=%d start" % (self.Port,))
             csock = None
@@ -638,13 +1390,37 @@ class HTTPServer(PyThread, Logged):
         try:    self.Sock.close()
         except: pass
         self.Sock = None
+        if self.Selector is not None:
+            self.Selector.stop()
         self.RequestReaderQueue.join()
 
     def connection_accepted(self, csock, caddr):        # called externally by multiserver
-        request = Request(self.Port, csock, caddr)
+        request = Request(self.Port, csock, caddr, server=self)
         self.debug("connection %s accepted from %s:%s" % (request.Id, caddr[0], caddr[1]))
-        reader = RequestReader(self, request, self.SocketWrapper, self.Timeout, self)
-        self.RequestReaderQueue << reader
+        if self.Selector is not None:
+            self.Selector.add(request, self.SocketWrapper, RequestReader.HeaderTimeout)
+        else:
+            reader = RequestReader(self, request, self.SocketWrapper, self.Timeout, self)
+            self.RequestReaderQueue << reader
+
+    def connection_continued(self, previous):
+        # called by the RequestProcessor when the response to a keep-alive request has been sent
+        request = Request(self.Port, previous.CSock, previous.CAddr, server=self, 
+                sequence=previous.Sequence + 1, buffered=previous.BodyFile.leftover())
+        request.SSLInfo = previous.SSLInfo
+        self.debug("connection %s continued from %s as %s" % (previous.Id, request.Id, request.Sequence))
+        if self.Selector is not None:
+            self.Selector.add(request, None, self.KeepAliveTimeout)
+        else:
+            reader = RequestReader(self, request, None, self.Timeout, self, header_timeout=self.KeepAliveTimeout)
+            self.RequestReaderQueue << reader
+        
+    def keepAliveAllowed(self, request):
+        header = request.HTTPHeader
+        return self.KeepAlive and not self.Stop \
+            and request.Sequence + 1 < self.MaxRequestsPerConnection \
+            and (header.get("Transfer-Encoding") is None or is_chunked(header.get("Transfer-Encoding"))) \
+            and header.keep_alive()
         
     @synchronized
     def stop(self):
@@ -662,6 +1438,32 @@ class HTTPServer(PyThread, Logged):
         else:
             return False, None, "no match"
 
+    def requestFailed(self, request, header, dispatch_status):
+        # the request was not dispatched: respond if possible, log and close the connection
+        if header is not None and header.Complete:
+            #print("dispatch status:", dispatch_status)
+            try:
+                if dispatch_status == "no match":
+                    request.send_response(404, "Service not found")
+                elif dispatch_status == "service unavailable":
+                    request.send_response(503, "Service unavailable")
+                elif dispatch_status == "invalid request":
+                    request.send_response(400, "Invalid request")
+                else:
+                    request.send_response(500, "Request dispatch error " + str(dispatch_status))
+            except Exception as e:
+                self.debug("error sending response: %s" % (e,))
+            self.log('%s %s:%s :%s %s %s -> (%s)' % 
+                (   request.Id, request.CAddr[0], request.CAddr[1], request.ServerPort, 
+                    header.Method, header.OriginalURI, dispatch_status
+                )
+            )
+        elif dispatch_status != "idle":
+            self.log('%s:%s :%s (request reading error)' % 
+                (   request.CAddr[0], request.CAddr[1], request.ServerPort)
+            )
+        request.close()
+
     def taskFailed(self, queue, task, exc_type, exc, tb):
         traceback.print_exception(exc_type, exc, tb)
             
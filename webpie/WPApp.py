@@ -3,9 +3,11 @@ from .webob.multidict import MultiDict
 from .webob import Request as webob_request
 from .webob.exc import HTTPTemporaryRedirect, HTTPException, HTTPFound, HTTPForbidden, HTTPNotFound, HTTPBadRequest
 from . import Version as WebPieVersion
+from .static_cache import StaticFileCache, parse_ranges, content_range
+from .compression import Compressor
 from urllib.parse import unquote_plus, quote
     
-import os.path, os, stat, sys, traceback, fnmatch, datetime, inspect, json
+import os.path, os, stat, sys, traceback, fnmatch, datetime, inspect, json, asyncio, uuid, contextvars, dataclasses
 from threading import RLock
 
 PY2 = sys.version_info[0] == 2
@@ -34,6 +36,8 @@ except ImportError:
 
 _WebMethodSignature = "__WebPie:webmethod__"
 
+_CurrentRequest = contextvars.ContextVar("webpie_request", default=None)     # used by handlers in stateless mode
+
 _MIME_TYPES_BASE = {
         "gif":   "image/gif",
         "png":   "image/png",
@@ -66,7 +70,7 @@ def webmethod(permissions=None):
     #       ...
     #
     def decorator(method):
-        def decorated(handler, request, relpath, *params, **args):
+        def forbidden(handler, request, relpath):
             #if isinstance(permissions, str):
             #    permissions = [permissions]
             if permissions is not None:
@@ -80,7 +84,13 @@ def webmethod(permissions=None):
                         break
                 else:
                     return HTTPForbidden()
-            return method(handler, request, relpath, *params, **args)
+            return None
+        if inspect.iscoroutinefunction(method):
+            async def decorated(handler, request, relpath, *params, **args):
+                return forbidden(handler, request, relpath) or await method(handler, request, relpath, *params, **args)
+        else:
+            def decorated(handler, request, relpath, *params, **args):
+                return forbidden(handler, request, relpath) or method(handler, request, relpath, *params, **args)
         decorated.__doc__ = _WebMethodSignature
         return decorated
     return decorator
@@ -135,15 +145,146 @@ class HTTPResponseException(Exception):
     def __init__(self, response):
         self.value = response
 
+class AsyncAppIter(object):
+    #
+    # Response body produced by an async generator or other async iterable.
+    # The asyncio server iterates it asynchronously, WSGI servers iterate it synchronously
+    # in a private event loop
+    #
+    
+    def __init__(self, aiterable):
+        self.AIterable = aiterable
+        
+    async def generate(self):
+        async for part in self.AIterable:
+            yield to_bytes(part)
+
+    def __aiter__(self):
+        return self.generate()
+        
+    def __iter__(self):
+        loop = asyncio.new_event_loop()
+        agen = self.generate()
+        try:
+            while True:
+                try:    yield loop.run_until_complete(agen.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(agen.aclose())
+            loop.close()
+
+#
+# JSON responses
+#
+
+def json_default(obj):
+    # makes dataclasses, sets and other iterables serializable by json.dumps
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    elif isinstance(obj, (set, frozenset, tuple)) or isinstance(obj, Iterable) and not isinstance(obj, (str, bytes, dict)):
+        return list(obj)
+    raise TypeError("Object of type %s is not JSON serializable" % (type(obj).__name__,))
+
+def json_encode(obj):
+    # default JSON encoder. Any function, which converts an object to str or bytes, e.g. orjson.dumps,
+    # can be used instead, see WPApp json_encoder argument
+    return json.dumps(obj, separators=(",", ":"), default=json_default).encode("utf-8")
 
-def makeResponse(resp):
+class JSONStream(object):
+    #
+    # Response body: JSON array or NDJSON (one JSON document per line) built from an iterable or
+    # an async iterable of records, without building the whole text in memory.
+    # Encoded records are sent in batches of about BatchSize bytes
+    #
+    #   return JSONStream(records)                  # [record,record,...]
+    #   return JSONStream(records, ndjson=True)     # record\nrecord\n...
+    #
+
+    BatchSize = 65536
+
+    def __init__(self, records, ndjson=False, encoder=None):
+        self.Records = records
+        self.NDJSON = ndjson
+        self.Encoder = encoder              # set by makeResponse if None
+        self.ContentType = "application/x-ndjson" if ndjson else "text/json"
+
+    def is_async(self):
+        return hasattr(self.Records, "__aiter__")
+
+    def piece(self, record, first):
+        # encoded record with the separator
+        data = to_bytes((self.Encoder or json_encode)(record))
+        if self.NDJSON:
+            return data + b"\n"
+        return data if first else b"," + data
+
+    def __iter__(self):
+        batch, size, first = [] if self.NDJSON else [b"["], 0, True
+        for record in self.Records:
+            data = self.piece(record, first)
+            batch.append(data)
+            size += len(data)
+            first = False
+            if size >= self.BatchSize:
+                yield b"".join(batch)
+                batch, size = [], 0
+        if not self.NDJSON:
+            batch.append(b"]")
+        yield b"".join(batch)
+
+    async def generate(self):
+        batch, size, first = [] if self.NDJSON else [b"["], 0, True
+        async for record in self.Records:
+            data = self.piece(record, first)
+            batch.append(data)
+            size += len(data)
+            first = False
+            if size >= self.BatchSize:
+                yield b"".join(batch)
+                batch, size = [], 0
+        if not self.NDJSON:
+            batch.append(b"]")
+        yield b"".join(batch)
+
+    def __aiter__(self):
+        return self.generate()
+
+class WebMethodCall(object):
+    #
+    # Web method found by the URL router, ready to be called
+    #
+    
+    def __init__(self, method, request, relpath, args):
+        self.Method = method
+        self.Request = request
+        self.RelPath = relpath
+        self.Args = args
+        
+    def is_async(self):
+        m = self.Method
+        return inspect.iscoroutinefunction(m) or \
+            not inspect.isroutine(m) and inspect.iscoroutinefunction(getattr(m, "__call__", None))
+
+    def __call__(self):
+        return self.Method(self.Request, self.RelPath, **self.Args)
+
+def run_coroutine(x):
+    # used by the synchronous (WSGI) path to get the result of an async web method
+    return asyncio.run(x) if inspect.iscoroutine(x) else x
+
+
+def makeResponse(resp, json_encoder=None):
     #
     # acceptable responses:
     #
     # Response
     # text              -- ala Flask
     # status    
-    # dictionary -> JSON representation, content_type = "text/json"
+    # dictionary, dataclass -> JSON representation, content_type = "text/json"
+    # list of str or bytes -> body parts
+    # other list -> JSON representation
+    # JSONStream -> JSON array or NDJSON
     # (text, status)            
     # (text, "content_type")            
     # (text, {headers})            
@@ -170,10 +311,17 @@ def makeResponse(resp):
     for part in resp:
         
         if app_iter is None and text is None:
-            if isinstance(part, dict):
-                app_iter = [json.dumps(part).encode("utf-8")]
+            if isinstance(part, dict) or dataclasses.is_dataclass(part) and not isinstance(part, type) \
+                    or isinstance(part, list) and not all(isinstance(x, (str, bytes)) for x in part):
+                app_iter = [to_bytes((json_encoder or json_encode)(part))]
                 content_type = "text/json"
                 continue
+            elif isinstance(part, JSONStream):
+                if part.Encoder is None:
+                    part.Encoder = json_encoder
+                app_iter = AsyncAppIter(part) if part.is_async() else part
+                content_type = part.ContentType
+                continue
             elif PY2 and isinstance(part, (str, bytes, unicode)):
                 app_iter = [part]
                 continue
@@ -186,6 +334,9 @@ def makeResponse(resp):
             elif isinstance(part, list):
                 app_iter = [to_bytes(x) for x in part]
                 continue            
+            elif hasattr(part, "__aiter__"):
+                app_iter = AsyncAppIter(part)
+                continue            
             elif isinstance(part, Iterable):
                 app_iter = (to_bytes(x) for x in part)
                 continue            
@@ -210,30 +361,184 @@ def makeResponse(resp):
     if text is not None:  response.text = text
     return response
 
+class RouteTable(object):
+
+    #
+    # Routes of a WPHandler subclass: web methods and static responses found in the class and its bases.
+    # The table is built once per class, so that the URL is mapped to the web method with dictionary lookups
+    # instead of getattr() and permission checks on every request.
+    # Attributes assigned in the handler __init__, usually the child handlers, are found in the instance __dict__.
+    # Properties and other non-trivial class attributes are resolved per request as before.
+    # Used with WPApp(..., compile_routes=True). Differences from the getattr() routing: class attributes
+    # added or replaced after the table was built are not seen, and methods of classes defining __getattr__
+    # are always resolved with getattr()
+    #
+
+    NOTFOUND, METHOD, CALL, RESPONSE, TUPLE, HANDLER, DYNAMIC = range(7)
+    KindNames = ["not found", "method", "callable", "response", "response", "handler", "dynamic"]
+
+    GlobalLock = RLock()
+    Tables = {}                 # handler class -> RouteTable
+
+    @staticmethod
+    def table(handler_class):
+        table = RouteTable.Tables.get(handler_class)
+        if table is None:
+            with RouteTable.GlobalLock:
+                table = RouteTable.Tables.get(handler_class)
+                if table is None:
+                    table = RouteTable.Tables[handler_class] = RouteTable(handler_class)
+        return table
+
+    def __init__(self, handler_class):
+        self.HandlerClass = handler_class
+        self.Routes = {}                # word -> (kind, value)
+        for cls in reversed(handler_class.__mro__):
+            for word, value in cls.__dict__.items():
+                self.Routes[word] = self.compile(handler_class, word, value)
+        # with __getattr__, any word can be an attribute
+        self.Dynamic = any("__getattr__" in cls.__dict__ for cls in handler_class.__mro__)
+
+    @staticmethod
+    def route(handler, request, path, path_down, args):
+        # walks down the handler tree. Returns either the response or the WebMethodCall object
+        i, n = 0, len(path_down)
+        while True:
+            j = i
+            while i < n and not path_down[i]:
+                i += 1
+            table = handler._RouteTable
+            if i >= n or table is None:
+                # default method redirect or a handler, which is not using compiled routes
+                return handler._route_getattr(request, path, path_down[j:], args)
+            word = path_down[i]
+            i += 1
+            handler.Path = path or "/"
+            kind, value = table.lookup(handler, word)
+            if kind == RouteTable.HANDLER:
+                handler = value
+                path = path + "/" + word
+            elif kind == RouteTable.METHOD or kind == RouteTable.CALL:
+                return WebMethodCall(value, request, "/".join(path_down[i:]), args)
+            elif kind == RouteTable.RESPONSE:
+                return value
+            elif kind == RouteTable.TUPLE:
+                return makeResponse(value)
+            elif kind == RouteTable.NOTFOUND:
+                raise HTTPNotFound("invalid path: " + canonic_path("/".join([path]+path_down[j:])))
+            else:
+                return handler._route_getattr(request, path, path_down[j:], args)
+
+    @staticmethod
+    def compile(handler_class, word, value):
+        if isinstance(value, Response):
+            return RouteTable.RESPONSE, value
+        elif isinstance(value, tuple):
+            return RouteTable.TUPLE, value
+        elif isinstance(value, (staticmethod, classmethod)) or inspect.isfunction(value):
+            func = value.__func__ if isinstance(value, (staticmethod, classmethod)) else value
+            allowed = (not handler_class._Strict and not word.startswith('_')) \
+                or (handler_class._MethodNames is not None and word in handler_class._MethodNames) \
+                or func.__doc__ == _WebMethodSignature
+            return (RouteTable.METHOD, value.__get__) if allowed else (RouteTable.NOTFOUND, None)
+        else:
+            return RouteTable.DYNAMIC, value
+
+    def lookup(self, handler, word):
+        # returns (kind, value) for the word in the handler's URL space
+        d = handler.__dict__
+        if self.Dynamic or "_Strict" in d or "_MethodNames" in d:
+            return self.DYNAMIC, None
+        kind, value = self.Routes.get(word, (None, None))
+        if kind == self.DYNAMIC:
+            return kind, None
+        if word in d:
+            value = d[word]
+            if isinstance(value, WPHandler) and not callable(value):
+                return self.HANDLER, value
+            return self.DYNAMIC, None
+        if kind == self.METHOD:
+            return kind, value(handler, self.HandlerClass)
+        elif kind is not None:
+            return kind, value
+        value = handler._WebMethods.get(word)
+        if value is not None:
+            return self.CALL, value
+        return self.NOTFOUND, None
+
 class WPHandler(object):
 
     Version = ""
     
     _Strict = False
     _MethodNames = None
+    _Stateless = False
     
     DefaultMethod = "index"
     
     def __init__(self, request, app):
+        self._Stateless = getattr(app, "Stateless", False)
         self.Request = request
         self.Path = None
         self.App = app
         self.BeingDestroyed = False
-        try:    self.AppURL = request.application_url
-        except: self.AppURL = None
+        self._AppURL = None
+        if not self._Stateless:
+            try:    self._AppURL = request.application_url
+            except: pass
         #self.RouteMap = []
         self._WebMethods = {}
+        self._RouteTable = RouteTable.table(type(self)) if getattr(app, "CompileRoutes", False) else None
         if not self._Strict:
             self.addHandler(".env", self._env__)
             
     def addHandler(self, name, method):
         self._WebMethods[name] = method
 
+    def _get_request(self):
+        # handler trees shared by concurrent requests get the current request from the context
+        return _CurrentRequest.get() if self._Stateless else self._Request
+
+    def _set_request(self, request):
+        # shared handler trees do not keep the request they were created with
+        self._Request = None if self._Stateless else request
+
+    Request = property(_get_request, _set_request)
+
+    #
+    # In stateless mode, the handler path set by the routing and the application URL are per request too.
+    # The paths are kept in the request environ, keyed by the handler id
+    #
+
+    def _get_path(self):
+        if not self._Stateless:
+            return self._Path
+        request = _CurrentRequest.get()
+        if request is None:
+            return None
+        return request.environ.get("WebPie.handler_paths", {}).get(id(self))
+
+    def _set_path(self, path):
+        if not self._Stateless:
+            self._Path = path
+        else:
+            request = _CurrentRequest.get()
+            if request is not None:
+                request.environ.setdefault("WebPie.handler_paths", {})[id(self)] = path
+
+    Path = property(_get_path, _set_path)
+
+    def _get_app_url(self):
+        if not self._Stateless:
+            return self._AppURL
+        try:    return self.Request.application_url
+        except: return None
+
+    def _set_app_url(self, url):
+        self._AppURL = url
+
+    AppURL = property(_get_app_url, _set_app_url)
+
     def _app_lock(self):
         return self.App._app_lock()
 
@@ -387,6 +692,18 @@ class WPHandler(object):
         return "\n".join(lines) + "\n", "text/plain"
 
     def _handle_request(self, request, path, path_down, args):
+        out = self._route(request, path, path_down, args)
+        if isinstance(out, WebMethodCall):
+            out = out()
+        return out
+
+    def _route(self, request, path, path_down, args):
+        # returns either the response or the WebMethodCall object for the web method mapped to the path
+        if self._RouteTable is not None:
+            return RouteTable.route(self, request, path, path_down, args)
+        return self._route_getattr(request, path, path_down, args)
+
+    def _route_getattr(self, request, path, path_down, args):
         orig_path = canonic_path("/".join([path]+path_down))
         word = ""
         while path_down and not word:
@@ -432,21 +749,86 @@ class WPHandler(object):
             if not allowed:
                 raise HTTPNotFound("invalid path: " + orig_path)
             else:
-                return subhandler(request, relpath, **args)
+                return WebMethodCall(subhandler, request, relpath, args)
         elif isinstance(subhandler, WPHandler):
-            return subhandler._handle_request(request, path + "/" + word, path_down, args)
+            return subhandler._route(request, path + "/" + word, path_down, args)
         else:
             raise HTTPNotFound("invalid path: " + orig_path)
 
 class WPStaticHandler(WPHandler):
     
-    def __init__(self, request, app, root="static", default_file="index.html", cache_ttl=None):
+    def __init__(self, request, app, root="static", default_file="index.html", cache_ttl=None,
+                cache_size=16*1024*1024, max_cached_file=1024*1024, revalidate_interval=1.0, compress=True):
         WPHandler.__init__(self, request, app)
         self.DefaultFile = default_file
         if not (root.startswith(".") or root.startswith("/")):
             root = self.App.ScriptHome + "/" + root
         self.Root = root
         self.CacheTTL = cache_ttl
+        self.Cache = StaticFileCache.cache(root, max_size=cache_size, max_file_size=max_cached_file,
+                revalidate_interval=revalidate_interval, compress=compress)
+
+    @staticmethod
+    def mime_type(path):
+        ext = path.rsplit('.',1)[-1]
+        return _MIME_TYPES_BASE.get(ext, "text/plain")
+
+    def file_iter(self, request, path, offset=0, length=None):
+        # uses wsgi.file_wrapper, if available, so that the server can send the file with sendfile()
+        f = open(path, "rb")
+        file_wrapper = request.environ.get("wsgi.file_wrapper")
+        if file_wrapper is not None:
+            try:    return file_wrapper(f, 65536, offset, length)
+            except TypeError:
+                # standard file_wrapper(filelike, block_size) does not support ranges
+                pass
+        def read_iter(f, offset, length):
+            with f:
+                if offset:
+                    f.seek(offset)
+                while length is None or length > 0:
+                    data = f.read(65536 if length is None else min(65536, length))
+                    if not data:    break
+                    if length is not None:
+                        length -= len(data)
+                    yield data
+        return read_iter(f, offset, length)
+
+    def multirange_response(self, entry, content, length, ranges):
+        # multipart/byteranges response. Part headers are computed up front so that Content-Length is known
+        boundary = uuid.uuid4().hex
+        parts = [(start, stop, 
+                    to_bytes("--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n" % (
+                        boundary, entry.MimeType, content_range(start, stop, length))))
+                    for start, stop in ranges]
+        trailer = to_bytes("--%s--\r\n" % (boundary,))
+        total = sum(len(head) + stop - start + 2 for start, stop, head in parts) + len(trailer)
+        
+        def parts_iter(path, content):
+            f = open(path, "rb") if content is None else None
+            try:
+                for start, stop, head in parts:
+                    yield head
+                    if content is not None:
+                        yield content[start:stop]
+                    else:
+                        f.seek(start)
+                        remaining = stop - start
+                        while remaining > 0:
+                            data = f.read(min(65536, remaining))
+                            if not data:    break
+                            remaining -= len(data)
+                            yield data
+                    yield b"\r\n"
+                yield trailer
+            finally:
+                if f is not None:
+                    f.close()
+        
+        resp = Response(app_iter=parts_iter(entry.Path, content), content_length=total, 
+                content_type="multipart/byteranges; boundary=%s" % (boundary,))
+        resp.status = 206
+        return resp
 
     def __call__(self, request, relpath, **args):
         
@@ -456,45 +838,55 @@ class WPStaticHandler(WPHandler):
         if relpath == "index":
             self.redirect("./index.html")
             
-        home = self.Root
-        path = os.path.join(home, relpath)
-        
-        if not os.path.exists(path):
-            return Response("Not found", status=404)
-
-        if os.path.isdir(path) and self.DefaultFile:
-            path = os.path.join(path, self.DefaultFile)
-            
-        if not os.path.isfile(path):
-            #print "not a regular file"
+        path = os.path.join(self.Root, relpath.lstrip("/"))
+        entry = self.Cache.get(path, self.DefaultFile, self.mime_type)
+        if entry is None:
             return Response("Not found", status=404)
             
-        mtime = os.path.getmtime(path)
-        mtime = datetime.datetime.utcfromtimestamp(mtime)
-        
-        if "If-Modified-Since" in request.headers:
-            # <day-name>, <day> <month> <year> <hour>:<minute>:<second> GMT
-            dt_str = request.headers["If-Modified-Since"]
-            words = dt_str.split()
-            if len(words) == 6 and words[-1] == "GMT":
-                dt_str = " ".join(words[1:-1])      # keep only <day> <month> <year> <hour>:<minute>:<second>
-                dt = datetime.datetime.strptime(dt_str, '%d %b %Y %H:%M:%S')
-                if mtime < dt:
-                    return 304
-            
-        size = os.path.getsize(path)
-
-        ext = path.rsplit('.',1)[-1]
-        mime_type = _MIME_TYPES_BASE.get(ext, "text/plain")
-
-        def read_iter(f):
-            while True:
-                data = f.read(8192)
-                if not data:    break
-                yield data
-
-        resp = Response(app_iter = read_iter(open(path, "rb")), content_length=size, content_type = mime_type)
-        #resp.headers["Last-Modified"] = mtime.strftime("%a, %d %b %Y %H:%M:%S GMT")
+        encoding = None
+        if entry.Variants and "Accept-Encoding" in request.headers:
+            offers = request.accept_encoding.acceptable_offers(list(entry.Variants) + ["identity"])
+            if offers and offers[0][0] != "identity":
+                encoding = offers[0][0]
+            # if nothing is acceptable, including identity, the file is sent as is
+
+        if entry.not_modified(request.headers):
+            resp = Response(status=304)
+        else:
+            content = None
+            if entry.Content is not None:
+                content = entry.Variants[encoding] if encoding else entry.Content
+            length = entry.Size if content is None else len(content)
+            ranges = None
+            if request.method == "GET" and "Range" in request.headers and entry.if_range(request.headers, encoding):
+                ranges = parse_ranges(request.headers["Range"], length)
+            if ranges == []:
+                resp = Response(status=416)
+                resp.headers["Content-Range"] = "bytes */%d" % (length,)
+            elif ranges and len(ranges) == 1:
+                start, stop = ranges[0]
+                if content is not None:
+                    resp = Response(body=content[start:stop], content_type=entry.MimeType)
+                else:
+                    resp = Response(app_iter=self.file_iter(request, entry.Path, start, stop-start),
+                            content_length=stop-start, content_type=entry.MimeType)
+                resp.status = 206
+                resp.headers["Content-Range"] = content_range(start, stop, length)
+            elif ranges:
+                resp = self.multirange_response(entry, content, length, ranges)
+            elif content is not None:
+                resp = Response(body=content, content_type=entry.MimeType)
+            else:
+                # the file may grow after it was stat'ed, send no more than Content-Length
+                resp = Response(app_iter = self.file_iter(request, entry.Path, 0, entry.Size), content_length=entry.Size, 
+                        content_type = entry.MimeType)
+            if encoding and ranges != []:
+                resp.headers["Content-Encoding"] = encoding
+        resp.headers["Accept-Ranges"] = "bytes"
+        resp.headers["ETag"] = entry.etag(encoding)
+        resp.headers["Last-Modified"] = entry.LastModified
+        if entry.Variants:
+            resp.headers["Vary"] = "Accept-Encoding"
         if self.CacheTTL is not None:
             resp.cache_control.max_age = self.CacheTTL        
         return resp
@@ -504,7 +896,8 @@ class WPApp(object):
     Version = "Undefined"
 
     def __init__(self, root_class_or_handler, strict=False, prefix=None, replace_prefix="", 
-            environ={}, unquote_args=True):
+            environ={}, unquote_args=True, compile_routes=False, stateless=False, upload_limits=None,
+            compress=None, json_encoder=None):
 
         self.RootHandler = self.RootClass = None
         if inspect.isclass(root_class_or_handler):
@@ -521,7 +914,17 @@ class WPApp(object):
         self.HandlerParams = []
         self.HandlerArgs = {}
         self.Environ = environ
+        if upload_limits:
+            # limits for multipart/form-data parsing, see multipart.py
+            self.Environ = dict(environ, **{"webpie.upload_limits": upload_limits})
         self.UnquoteArgs = unquote_args
+        self.CompileRoutes = compile_routes     # opt-in: route requests with per-class RouteTable's instead of getattr()
+        self.Stateless = stateless              # create the handler tree once and share it between requests.
+                                                # The handlers get the request from the context
+        self.JSONEncoder = json_encoder         # object -> str or bytes, e.g. orjson.dumps. Default: json_encode
+        self.Compressor = None                  # compress=True or dict of Compressor options, see compression.py
+        if compress:
+            self.Compressor = Compressor(**(compress if isinstance(compress, dict) else {}))
         
     def match(self, uri):
         return not self.Prefix or uri.startswith(self.Prefix)
@@ -622,45 +1025,86 @@ class WPApp(object):
                         out[k] = v
         return out
 
-    def wsgi_call(self, root_handler, environ, start_response):
-        path = canonic_path(environ.get('PATH_INFO', ''))
-        #while "//" in path:
-        #    path.replace("//", "/")
-        path_down = path.split("/")
-        if not path_down[0]:
-            path_down = path_down[1:]
-        #while '' in path_down:
-        #    path_down.remove('')
-        args = self.parseQuery(environ.get("QUERY_STRING", ""))
-        request = Request(environ)
-        try:
-            if isinstance(root_handler, tuple):
-                response = makeResponse(root_handler)
-            elif isinstance(root_handler, Response):
-                response = root_handler
-            elif callable(root_handler):
-                response = root_handler(request, path, **args)
-            else:
-                response = root_handler._handle_request(request, "", path_down, args)
-        except HTTPException as val:
-            response = val
-        except HTTPResponseException as val:
-            #print 'caught:', type(val), val
-            response = val
-        except InvalidArgumentError as e:
-            response = HTTPBadRequest(str(e))
-        except Exception as e:
-            response = self.applicationErrorResponse(str(e), sys.exc_info())
+    def route(self, root_handler, request, path, args):
+        # returns either the response or the WebMethodCall object
+        if isinstance(root_handler, tuple):
+            return makeResponse(root_handler)
+        elif isinstance(root_handler, Response):
+            return root_handler
+        elif callable(root_handler):
+            return WebMethodCall(root_handler, request, path, args)
+        else:
+            path_down = path.split("/")
+            if not path_down[0]:
+                path_down = path_down[1:]
+            return root_handler._route(request, "", path_down, args)
+
+    def compileRoutes(self):
+        # builds route table for the root handler class. Tables for child handler classes are built
+        # when the class is first seen
+        if self.RootClass is not None and issubclass(self.RootClass, WPHandler):
+            RouteTable.table(self.RootClass)
+        elif isinstance(self.RootHandler, WPHandler):
+            RouteTable.table(type(self.RootHandler))
+
+    def exceptionResponse(self, exc):
+        # to be called from the except clause
+        if isinstance(exc, (HTTPException, HTTPResponseException)):
+            return exc
+        elif isinstance(exc, InvalidArgumentError):
+            return HTTPBadRequest(str(exc))
+        else:
+            return self.applicationErrorResponse(str(exc), sys.exc_info())
 
+    def finalResponse(self, root_handler, response):
         try:    
-            response = makeResponse(response)
+            response = makeResponse(response, self.JSONEncoder)
         except ValueError as e:
             response = self.applicationErrorResponse(str(e), sys.exc_info())
-        out = response(environ, start_response)
-        if isinstance(root_handler, WPHandler):
+        if isinstance(root_handler, WPHandler) and root_handler is not self.RootHandler:
             root_handler.destroy()
             root_handler._destroy()
-        return out
+        return response
+
+    def wsgi_call(self, root_handler, environ, start_response):
+        path = canonic_path(environ.get('PATH_INFO', ''))
+        args = self.parseQuery(environ.get("QUERY_STRING", ""))
+        request = Request(environ)
+        token = _CurrentRequest.set(request)
+        try:
+            try:
+                response = self.route(root_handler, request, path, args)
+                if isinstance(response, WebMethodCall):
+                    response = run_coroutine(response())
+            except Exception as e:
+                response = self.exceptionResponse(e)
+            return self.finalResponse(root_handler, response)(environ, start_response)
+        finally:
+            _CurrentRequest.reset(token)        # do not keep the request alive in the thread
+
+    async def async_wsgi_call(self, root_handler, environ):
+        # asynchronous version of wsgi_call. Returns the Response object.
+        # Async web methods run in the event loop, synchronous ones - in the loop's default executor
+        path = canonic_path(environ.get('PATH_INFO', ''))
+        args = self.parseQuery(environ.get("QUERY_STRING", ""))
+        request = Request(environ)
+        token = _CurrentRequest.set(request)
+        try:
+            try:
+                response = self.route(root_handler, request, path, args)
+                if isinstance(response, WebMethodCall):
+                    if response.is_async():
+                        response = response()
+                    else:
+                        context = contextvars.copy_context()
+                        response = await asyncio.get_running_loop().run_in_executor(None, context.run, response)
+                    if inspect.iscoroutine(response):
+                        response = await response
+            except Exception as e:
+                response = self.exceptionResponse(e)
+            return self.finalResponse(root_handler, response)
+        finally:
+            _CurrentRequest.reset(token)
 
     def scriptUri(self, request_or_environ):
         if isinstance(request_or_environ, Request):
@@ -680,7 +1124,8 @@ class WPApp(object):
             path = path[len(self.ReplacePrefix):]
         return canonic_path(self.ExternalAppRootPath + '/' + path)
 
-    def __call__(self, environ, start_response):
+    def prepare(self, environ):
+        # common part of WSGI and ASGI processing. Returns the Request or None if the path does not match the prefix
         path = environ.get('PATH_INFO', '')
         if not "WebPie.original_path" in environ:
             environ["WebPie.original_path"] = path
@@ -690,7 +1135,7 @@ class WPApp(object):
 
         path = self.convertPath(path)
         if path is None:
-            return HTTPNotFound()(environ, start_response)
+            return None
         
         #if (not path or path=="/") and self.DefaultPath is not None:
         #    #print ("redirecting to", self.DefaultPath)
@@ -706,14 +1151,41 @@ class WPApp(object):
                 self.ScriptHome = os.environ.get('WEBPIE_SCRIPT_HOME') or os.path.dirname(self.Script or sys.argv[0]) or "."
                 self.ExternalAppRootPath = canonic_path('/' + self.ScriptName + '/' + (self.Prefix or ""))
                 self.init()
+                if self.CompileRoutes:
+                    self.compileRoutes()
                 self.Initialized = True
 
         environ["WebPie.version"] = WebPieVersion
         environ["WebPie.path_prefix"] = self.Prefix or ""
         environ["WebPie.path_replace_prefix"] = self.ReplacePrefix or None
         environ["WebPie.app_root_path"] = self.appRootPath()
+        return req
+
+    def rootHandler(self, request):
+        # in stateless mode, the handler tree is created for the first request and then reused
+        if self.RootHandler is not None:
+            return self.RootHandler
+        if self.Stateless:
+            with self:
+                if self.RootHandler is None:
+                    token = _CurrentRequest.set(request)
+                    try:    self.RootHandler = self.RootClass(request, self, *self.HandlerParams, **self.HandlerArgs)
+                    finally:
+                        _CurrentRequest.reset(token)
+            return self.RootHandler
+        return self.RootClass(request, self, *self.HandlerParams, **self.HandlerArgs)
+
+    def __call__(self, environ, start_response):
+        if self.Compressor is not None:
+            return self.Compressor.wrap(self.callApp, environ, start_response)
+        return self.callApp(environ, start_response)
+
+    def callApp(self, environ, start_response):
+        req = self.prepare(environ)
+        if req is None:
+            return HTTPNotFound()(environ, start_response)
 
-        root_handler = self.RootHandler or self.RootClass(req, self, *self.HandlerParams, **self.HandlerArgs)
+        root_handler = self.rootHandler(req)
         #print("root_handler:", root_handler)
             
         try:
@@ -724,6 +1196,29 @@ class WPApp(object):
                 "Uncaught exception", sys.exc_info())
         return resp(environ, start_response)
         
+    async def async_call(self, environ):
+        # asynchronous analog of __call__. Returns the Response object
+        req = self.prepare(environ)
+        if req is None:
+            return HTTPNotFound()
+        root_handler = self.rootHandler(req)
+        try:
+            return await self.async_wsgi_call(root_handler, environ)
+        except:
+            return self.applicationErrorResponse("Uncaught exception", sys.exc_info())
+
+    async def asgi(self, scope, receive, send):
+        # ASGI application interface
+        from .aio import asgi_environ, asgi_send_response, asgi_lifespan
+        if scope["type"] == "lifespan":
+            return await asgi_lifespan(receive, send)
+        environ = await asgi_environ(scope, receive)
+        response = await self.async_call(environ)
+        if self.Compressor is not None:
+            compressor, app = self.Compressor, response
+            response = lambda environ, start_response: compressor.wrap(app, environ, start_response)
+        await asgi_send_response(response, environ, send)
+
     def init(self):
         # overraidable. will be called once after self.ScriptName, self.ScriptHome, self.Script are initialized
         # and app.externalPath() is ready to be used
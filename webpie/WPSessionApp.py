@@ -1,8 +1,10 @@
 from .webob import Response, Request
 import time, os, pickle, logging, sys
 from .WPApp import WPApp
-from threading import Thread, RLock
-import glob, uuid, hashlib
+from .session_storage import SessionBackend, SessionConflict, VersionKey, apply_update
+from .session_cookie import SessionCookieCodec
+from threading import Thread, RLock, get_ident
+import glob, uuid, hashlib, fcntl
 
 _hash_algorithm = None
 
@@ -14,7 +16,6 @@ def random_string():
 # Copyright (c) 2007-2010 Oliver Cope. All rights reserved.
 # See LICENSE.txt for terms of redistribution and use.
 
-import cgi
 import copy
 
 try:
@@ -41,6 +42,14 @@ def synchronized(method):
         return out
     return f
 
+def session_synchronized(method):
+    # the first argument of the method is the session id
+    def f(self, sid, *params, **args):
+        with self.sessionLock(sid):
+            out = method(self, sid, *params, **args)
+        return out
+    return f
+
 class Cookie(object):
     """
     Represents an HTTP cookie.
@@ -225,43 +234,39 @@ def parse_cookie_header(cookie_string, unquote=url_unquote):
 
 class CleanerThread(Thread):
 
-    def __init__(self, data_root,
-                        cleanup_frequency,
-                        session_timeout,
-                        lock         
-        ):
-        Thread.__init__(self)
-        self.DataRoot = data_root
+    def __init__(self, storage, cleanup_frequency):
+        Thread.__init__(self, daemon=True)
+        self.Storage = storage
         self.CleanUpFrequency = cleanup_frequency
-        self.SessionTimeout = session_timeout
-        self.Lock = lock
 
     def run(self):
+        try:    self.Storage.buildIndex()
+        except:
+            print("Error building session expiration index: %s %s" % (
+                    sys.exc_info()[0], sys.exc_info()[1])) 
         while True:
             time.sleep(self.CleanUpFrequency)
             #print "Cleaner(%s) run. Session timeout=%d..." % (self.DataRoot, self.SessionTimeout)
-            with self.Lock:
-                try:
-                    dirs = os.walk(self.DataRoot)
-                    for path, subdirs, files in dirs:
-                        for f in files:
-                            f = path + '/' + f
-                            st = os.stat(f)
-                            if st.st_atime < time.time() - self.SessionTimeout:
-                                try:    
-                                    #print "Deleting %s. Access time=%s now=%s..." % (f, st.st_atime, time.time())
-                                    os.unlink(f)
-                                except:
-                                    print("Can not delete file %s: %s %s" % (
-                                            f, sys.exc_info()[0], sys.exc_info()[1])) 
-                except:
-                    print("Error in clean-up thread: %s %s" % (
-                            sys.exc_info()[0], sys.exc_info()[1])) 
-
-class SessionStorage:
+            try:
+                self.Storage.cleanup()
+            except:
+                print("Error in clean-up thread: %s %s" % (
+                        sys.exc_info()[0], sys.exc_info()[1])) 
+
+class SessionStorage(SessionBackend):
+
+    #
+    # Default storage: one pickle file per session under the root directory.
+    #
+    # Session expiration index: <root>/.expiry/<bucket> files list sessions, as "<sid>", and bulk data items, 
+    # as "<sid>:<key>", which expire during the bucket time interval, unless they are accessed again.
+    # Data file modification time is the time of last access. The clean-up looks only at the expired buckets
+    #
 
     GlobalLock = RLock()
     Storages = {}               # root path -> storage object
+    CleanupBatch = 100          # index entries processed at once
+    NLocks = 64                 # per-session locks are striped over this many locks
 
     @staticmethod
     def storage(root_path, 
@@ -282,10 +287,16 @@ class SessionStorage:
         self.RootPath = root_path
         self.CleanUpFrequency = cleanup_frequency
         self.SessionTimeout = session_timeout
-        self.Lock = RLock()
-        self.CleanerThread = CleanerThread(root_path, self.CleanUpFrequency, self.SessionTimeout, self.Lock)
+        self.Locks = [RLock() for _ in range(self.NLocks)]
+        self.IndexPath = root_path + "/.expiry"
+        self.BucketSize = cleanup_frequency
+        self.Indexed = {}               # "sid" or "sid:key" -> last bucket it was written to by this process
+        self.CleanerThread = CleanerThread(self, self.CleanUpFrequency)
         self.CleanerThread.start()
         
+    def sessionLock(self, sid):
+        return self.Locks[hash(sid) % self.NLocks]
+
     def dataFilePath(self, sid):
         c1 = sid[-1]
         c2 = sid[-2]
@@ -297,7 +308,107 @@ class SessionStorage:
         return "%s/%s/%s/%s:%s.data" % (self.RootPath, c1, c2, 
                 sid, key)
 
-    @synchronized
+    #
+    # Expiration index
+    #
+
+    def bucket(self, t):
+        return int(t // self.BucketSize)
+
+    def filePath(self, item):
+        # item is "sid" or "sid:key"
+        sid, _, key = item.partition(":")
+        return self.bulkFilePath(sid, key) if key else self.dataFilePath(sid)
+
+    def indexSession(self, item, access_time=None, force=False):
+        bucket = self.bucket((access_time or time.time()) + self.SessionTimeout)
+        if not force and self.Indexed.get(item) == bucket:
+            return
+        if len(self.Indexed) > 100000:
+            self.Indexed.clear()
+        try:    os.makedirs(self.IndexPath)
+        except OSError: pass
+        with open("%s/%d" % (self.IndexPath, bucket), "a") as f:
+            f.write(item + "\n")
+        self.Indexed[item] = bucket
+
+    def buildIndex(self):
+        # indexes session files created before the index existed
+        marker = self.IndexPath + "/.built"
+        if os.path.isfile(marker):
+            return
+        try:    top = os.listdir(self.RootPath)
+        except FileNotFoundError:
+            top = []            # new storage, nothing to index
+        for c1 in top:
+            d1 = self.RootPath + "/" + c1
+            if len(c1) != 1 or not os.path.isdir(d1):   continue
+            for c2 in os.listdir(d1):
+                d2 = d1 + "/" + c2
+                if len(c2) != 1 or not os.path.isdir(d2):   continue
+                for fn in os.listdir(d2):
+                    if fn.endswith(".data") and Session.is_valid_id(fn[:-5].split(":", 1)[0]):
+                        try:    mtime = os.stat(d2 + "/" + fn).st_mtime
+                        except OSError: continue
+                        self.indexSession(fn[:-5], mtime)
+        os.makedirs(self.IndexPath, exist_ok=True)
+        open(marker, "w").close()
+
+    def expire(self, item, now):
+        # deletes the session or bulk data file if it expired, or moves it to the right bucket
+        path = self.filePath(item)
+        try:    mtime = os.stat(path).st_mtime
+        except OSError:
+            return
+        if mtime + self.SessionTimeout < now:
+            try:    os.unlink(path)
+            except OSError: pass
+            self.Indexed.pop(item, None)
+        else:
+            self.indexSession(item, mtime, force=True)
+
+    def cleanup(self):
+        # processes expired buckets in small batches, taking the lock for each batch
+        now = time.time()
+        current = self.bucket(now)
+        try:    names = os.listdir(self.IndexPath)
+        except OSError:
+            return
+        buckets = sorted(int(n) for n in names if n.isdigit())
+        for bucket in buckets:
+            if bucket >= current:
+                break
+            path = "%s/%d" % (self.IndexPath, bucket)
+            claimed = "%s.%d" % (path, os.getpid())
+            try:    os.rename(path, claimed)            # other processes using the same storage will skip it
+            except OSError: continue
+            self.cleanupBucket(claimed, now)
+        for name in names:
+            # buckets claimed by processes, which died before finishing the clean-up
+            if "." in name and name.split(".")[0].isdigit():
+                path = self.IndexPath + "/" + name
+                try:    
+                    if os.stat(path).st_mtime < now - 24*3600:
+                        self.cleanupBucket(path, now)
+                except OSError: pass
+
+    def cleanupBucket(self, claimed, now):
+        try:
+            with open(claimed, "r") as f:
+                items = list(set(l.strip() for l in f if l.strip()))
+            for i in range(0, len(items), self.CleanupBatch):
+                for item in items[i:i+self.CleanupBatch]:
+                    with self.sessionLock(item.split(":", 1)[0]):
+                        self.expire(item, now)
+                time.sleep(0)           # let other threads run
+        finally:
+            try:    os.unlink(claimed)
+            except OSError: pass
+
+    #
+    # Storage interface
+    #
+
     def sessionExists(self, sid):
         try:    os.stat(self.dataFilePath(sid))
         except OSError:
@@ -313,11 +424,14 @@ class SessionStorage:
             # picked up later :)
             pass
 
-        f = open(path, 'wb')
+        # write and rename so that readers never see partially written file
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), get_ident())
+        f = open(tmp, 'wb')
         try:
             pickle.dump(data, f)
         finally:
             f.close()
+        os.rename(tmp, path)
         #print "saveData(%s) done" % (path,)
 
 
@@ -335,28 +449,66 @@ class SessionStorage:
         finally:
             f.close()
 
-    @synchronized
+    def touch(self, item, path):
+        # extends the lifetime after the data is read, but not more often than once per half of the timeout
+        now = time.time()
+        try:
+            if os.stat(path).st_mtime < now - self.SessionTimeout/2:
+                os.utime(path)
+                self.indexSession(item, now)
+        except OSError:
+            pass
+
+    @session_synchronized
     def bulkLoad(self, sid, key, default=None):
-        return self.loadData(self.bulkFilePath(sid, key))
+        path = self.bulkFilePath(sid, key)
+        data = self.loadData(path)
+        if data is not None:
+            self.touch(sid + ":" + key, path)
+        return data
         
-    @synchronized
+    @session_synchronized
     def bulkSave(self, sid, key, value):
         self.saveData(self.bulkFilePath(sid, key), value)
+        self.indexSession(sid + ":" + key)
         
-    @synchronized
+    @session_synchronized
     def bulkDelete(self, sid, key):
         try:    os.unlink(self.bulkFilePath(sid, key))
         except: pass
         
-    @synchronized
+    @session_synchronized
     def load(self, sid):
-        return self.loadData(self.dataFilePath(sid))
+        path = self.dataFilePath(sid)
+        data = self.loadData(path)
+        if data is not None:
+            self.touch(sid, path)
+        return data
         
-    @synchronized
+    @session_synchronized
     def save(self, sid, data):
-        return self.saveData(self.dataFilePath(sid), data)
+        self.saveData(self.dataFilePath(sid), data)
+        self.indexSession(sid)
         
-    @synchronized
+    @session_synchronized
+    def update(self, sid, changed, deleted, version=None, replace=False):
+        # other processes using the same storage are locked out with flock() on the session directory lock file
+        path = self.dataFilePath(sid)
+        lock_path = os.path.dirname(path) + "/.lock"
+        try:    os.makedirs(os.path.dirname(path))
+        except OSError: pass
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                data = self.loadData(path) or {}
+                version = apply_update(sid, data, changed, deleted, version, replace)
+                self.saveData(path, data)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        self.indexSession(sid)
+        return version
+
+    @session_synchronized
     def delete(self, sid):
         try:    os.unlink(self.dataFilePath(sid))
         except: pass
@@ -386,34 +538,90 @@ class BulkProxy:
         return self.Session.bulkDelete(key)
         
 class Session:
-    def __init__(self, storage_path, session_id, session_timeout):
-        self.Storage = SessionStorage.storage(storage_path, 
-                session_timeout=session_timeout)
+
+    #
+    # The session is loaded from the storage when its data is first accessed, and a new session ID is generated
+    # only when the session needs to be saved or when the ID is asked for. Requests, which do not use the session,
+    # cost nothing. Only the changed and deleted keys are written back.
+    #
+    # The storage keeps the session version, incremented by each update. commit() and retry() use it
+    # to detect concurrent modifications. In optimistic mode, saveIfChanged() checks the version too, and if the
+    # session was modified by another request, merges the changed keys into the stored session and logs a warning
+    #
+
+    def __init__(self, storage, session_id, session_timeout, optimistic=False):
+        # storage is either the path to the session files directory or a storage object
+        self._Storage = storage
+        self.SessionTimeout = session_timeout
         self.is_new = session_id == None
         self.Data = None
-        self.SessionID = session_id or self.generateSessionID()
-        if not self.Storage.sessionExists(self.SessionID):
-            self.Data = {}
-            self.save()
-        self.Changed = False
+        self._SessionID = session_id
+        self.ChangedKeys = set()
+        self.DeletedKeys = set()
+        self.FullSave = False
+        self.Invalidated = False
+        self.Version = None
+        self.Optimistic = optimistic
                 
+    @property
+    def Storage(self):
+        # the file storage is created when first used, so that cookie sessions, which may never need it,
+        # do not start the cleaner thread and touch the disk
+        if isinstance(self._Storage, str):
+            self._Storage = SessionStorage.storage(self._Storage, session_timeout=self.SessionTimeout)
+        return self._Storage
+
     @staticmethod
     def is_valid_id(s):
         try:    int(s, 16)
         except: return False
         else:   return True
         
+    def get_changed(self):
+        return self.FullSave or bool(self.ChangedKeys or self.DeletedKeys)
+
+    def set_changed(self, changed):
+        # the application can set Changed = True to save the whole session, e.g. after modifying a mutable value
+        self.FullSave = changed
+        if not changed:
+            self.ChangedKeys.clear()
+            self.DeletedKeys.clear()
+
+    Changed = property(get_changed, set_changed)
+
+    def get_session_id(self):
+        if self._SessionID is None and not self.Invalidated:
+            self._SessionID = self.generateSessionID()
+        return self._SessionID
+
+    def set_session_id(self, sid):
+        self._SessionID = sid
+
+    SessionID = property(get_session_id, set_session_id)
+
     @property
     def session_id(self):           # just an alias for backward compatibility
         return self.SessionID
         
+    @property
+    def id_issued(self):
+        # True if a new session ID was, or will be generated when the session is saved, and has to be sent to the client
+        return self.is_new and not self.Invalidated and (self._SessionID is not None or self.Changed)
+
     def generateSessionID(self):
         return random_string()
         
+    def cookieValue(self):
+        # returns the session cookie value to send to the client or None
+        return self.SessionID if self.id_issued else None
+
     @property
     def data(self):
-        if self.Data is None:    
-            self.Data = self.load() or {}
+        if self.Data is None:
+            self.load()
+            if self.Data is None:
+                # new, unknown or expired session
+                self.Data = {}
         return self.Data
     
     def bulkRead(self, key, default=None):
@@ -429,18 +637,64 @@ class Session:
     def bulk(self):
         return BulkProxy(self)
         
-    def save(self):
-        self.Storage.save(self.SessionID, self.Data)
+    def save(self, check_version=False):
+        # replaces the whole stored session. The new version comes from the storage, so that a concurrent update
+        # is detected by the next version check
+        self.Version = self.Storage.update(self.SessionID, dict(self.data), [],
+                self.Version if check_version else None, replace=True)
         self.Changed = False
         #print "Session saved"
 
+    def storeChanges(self, check_version):
+        data = self.Data
+        self.Version = self.Storage.update(self.SessionID, 
+                {k: data[k] for k in self.ChangedKeys if k in data}, 
+                [k for k in self.DeletedKeys if k not in data],
+                self.Version if check_version else None)
+        self.Changed = False
+
     def saveIfChanged(self):
-        if self.Changed:
-            self.save()
-            self.Changed = False
+        if not self.Changed or self.Invalidated:
+            return
+        store = self.save if self.FullSave else self.storeChanges
+        if self.Optimistic:
+            try:    store(True)
+            except SessionConflict as e:
+                if self.FullSave:
+                    logging.warning("%s. Overwriting the stored session" % (e,))
+                else:
+                    logging.warning("%s. Merging changed keys: %s" % (e, sorted(map(str, self.ChangedKeys | self.DeletedKeys))))
+                store(False)
+        else:
+            store(False)
+
+    def commit(self):
+        # saves the changes now. Raises SessionConflict if the session was modified since it was loaded
+        if self.Changed and not self.Invalidated:
+            if self.FullSave:
+                self.save(True)
+            else:
+                self.storeChanges(True)
+
+    def retry(self, func, attempts=5):
+        # calls func(session) and commits the session changes. If the session was modified concurrently,
+        # reloads the session and repeats. Returns the value returned by func
+        for attempt in range(attempts):
+            if attempt:
+                self.load()
+                if self.Data is None:
+                    self.Data = {}
+            out = func(self)
+            try:
+                self.commit()
+                return out
+            except SessionConflict:
+                if attempt == attempts - 1:
+                    raise
         
     def load(self):
-        self.Data = self.Storage.load(self.SessionID)
+        self.Data = self.Storage.load(self._SessionID) if self._SessionID is not None else None
+        self.Version = self.Data.pop(VersionKey, 0) if self.Data is not None else 0
         self.Changed = False
         return self.Data
         
@@ -448,8 +702,10 @@ class Session:
         """
         invalidate and remove this session from the sessionmanager
         """
-        self.Storage.delete(self.SessionID)
+        if self._SessionID is not None:
+            self.Storage.delete(self._SessionID)
         self.SessionID = None
+        self.Invalidated = True
         self.Data = {}
 
     #
@@ -476,8 +732,10 @@ class Session:
         return iter(self.data.values())
 
     def update(self, other, **kwargs):
-        out = self.data.update(other, **kwargs)
-        self.Changed = True
+        other = dict(other, **kwargs)
+        out = self.data.update(other)
+        self.ChangedKeys.update(other.keys())
+        self.DeletedKeys.difference_update(other.keys())
         return out
 
     def values(self):
@@ -489,86 +747,198 @@ class Session:
     def __getitem__(self, key):
         return self.data[key]
 
+    def __contains__(self, key):
+        return key in self.data
+
     def __iter__(self):
         return self.data.__iter__()
 
     def __setitem__(self, key, val):
         out = self.data.__setitem__(key, val)
-        self.Changed = True
+        self.ChangedKeys.add(key)
+        self.DeletedKeys.discard(key)
         return out
 
     def __delitem__(self, key):
         out = self.data.__delitem__(key)
-        self.Changed = True
+        self.ChangedKeys.discard(key)
+        self.DeletedKeys.add(key)
         return out
     
+class CookieSession(Session):
+
+    #
+    # Session data is stored in the signed cookie, see session_cookie.py. The cookie value is built when the response
+    # is started, so the session should not be modified after that, e.g. by the response body generator.
+    # If the data can not be serialized or does not fit in the cookie, or if bulk data is saved, the session is moved
+    # to the server side storage and the cookie carries the session id instead
+    #
+
+    def __init__(self, codec, storage, cookie_value, session_timeout, optimistic=False):
+        Session.__init__(self, storage, None, session_timeout, optimistic)
+        self.Codec = codec
+        self.CookieValue = cookie_value
+        self.is_new = cookie_value is None
+        self.ServerSide = False
+        self.Issued = None
+        if cookie_value is not None:
+            try:    self.Issued = int(cookie_value.split(".")[1], 16)     # verified when the data is loaded
+            except: pass
+
+    def load(self):
+        if self.ServerSide:
+            return Session.load(self)
+        self.Data, issued = (None, None) if self.CookieValue is None else self.Codec.decode(self.CookieValue)
+        self.Issued = issued
+        self.Version = 0
+        self.Changed = False
+        return self.Data
+
+    def moveToServer(self):
+        if not self.ServerSide:
+            self.data
+            self.ServerSide = True
+            self.FullSave = True
+            self.is_new = True              # new session id will be issued
+
+    def cookieValue(self):
+        if self.Invalidated:
+            return None
+        if not self.ServerSide:
+            now = time.time()
+            refresh = self.Issued is not None and now > self.Issued + self.Codec.SessionTimeout/2
+            if not self.Changed and not refresh:
+                return None
+            data = self.data
+            if not data and self.is_new:
+                return None
+            value = self.Codec.encode(data, now)
+            if value is not None:
+                self.Changed = False
+                return value
+            self.moveToServer()
+        return Session.cookieValue(self)
+
+    def saveIfChanged(self):
+        if self.ServerSide:
+            Session.saveIfChanged(self)
+
+    def commit(self):
+        if self.ServerSide:
+            Session.commit(self)
+
+    def bulkRead(self, key, default=None):
+        return Session.bulkRead(self, key, default) if self.ServerSide else default
+
+    def bulkSave(self, key, value):
+        self.moveToServer()
+        return Session.bulkSave(self, key, value)
+
+    def bulkDelete(self, key):
+        if self.ServerSide:
+            Session.bulkDelete(self, key)
+
 class WPSessionApp(WPApp):
 
     def __init__(self, root_class,
             session_storage = "/tmp", cookie_name = 'webpie_session_id',
-            domain = None, cookie_path = None,  session_timeout = 3600  # seconds
+            domain = None, cookie_path = None,  session_timeout = 3600,  # seconds
+            optimistic = False, cookie_secret = None, encrypt_cookie = False, cookie_serializer = None,
+            max_cookie_size = 3800, **args
         ):
-        WPApp.__init__(self, root_class)
+        # session_storage: directory for session files or a storage object, see session_storage.py
+        # optimistic: check session version when saving the session, see Session
+        # cookie_secret: secret or list of secrets, the first one is current. If specified, the session data is
+        #   stored in the signed cookie, and session_storage is used only for sessions which do not fit in the cookie.
+        #   See CookieSession and session_cookie.py
+        WPApp.__init__(self, root_class, **args)
+        self.Optimistic = optimistic
+        self.CookieCodec = None
+        if cookie_secret:
+            self.CookieCodec = SessionCookieCodec(cookie_secret, session_timeout=session_timeout, 
+                    encrypt=encrypt_cookie, serializer=cookie_serializer, max_size=max_cookie_size)
         self.SessionStorage = session_storage
         self.CookieName = cookie_name
         self.CookieDomain = domain
         self.CookiePath = cookie_path
         self.SessionLifetime = session_timeout
         
-    def __call__(self, environ, start_response):
-        #
-        # get session id from cookie
-        # load session data
-        # call the WebPieApp
-        # store session data
-        # add cookie
-        #
-        
+    def startSession(self, environ):
         #
         # get session id from cookie
         #
         session_id = None
-        req = Request(environ)
-        cookies = parse_cookie_header(req.headers.get('Cookie', ''))
+        cookies = parse_cookie_header(environ.get('HTTP_COOKIE', ''))
         cookie = cookies.get(self.CookieName)
         if cookie and Session.is_valid_id(cookie.value):
             session_id = cookie.value
 
         #
-        # load session data
+        # the session data will be loaded when needed
         #
-        session = Session(self.SessionStorage, session_id, 
-                self.SessionLifetime)
+        if self.CookieCodec is not None and session_id is None:
+            cookie_value = cookie.value if cookie and self.CookieCodec.is_cookie_value(cookie.value) else None
+            session = CookieSession(self.CookieCodec, self.SessionStorage, cookie_value,
+                    self.SessionLifetime, self.Optimistic)
+        else:
+            session = Session(self.SessionStorage, session_id, 
+                    self.SessionLifetime, self.Optimistic)
         environ["webpie.session"] = session
+        return session
+
+    def sessionCookie(self, environ, session):
+        # returns the cookie to be sent to the client or None
+        if session.Invalidated and not session.is_new:
+            return expire_cookie(self.CookieName, path=self.cookiePath(environ), domain=self.CookieDomain)
+        value = session.cookieValue()
+        if value is None:
+            return None
+        return Cookie(
+            self.CookieName,
+            value,
+            path=self.cookiePath(environ),
+            domain=self.CookieDomain,
+            http_only=True
+        )
+
+    def cookiePath(self, environ):
+        _cookie_path = self.CookiePath
+        if _cookie_path is None:
+            _cookie_path = environ.get('SCRIPT_NAME')
+        if not _cookie_path:
+            _cookie_path = '/'
+        #print "SCRIPT_NAME=%s" % (environ.get('SCRIPT_NAME'),)
+        #print "_cookie_path=", _cookie_path
+        return _cookie_path
+        
+    def __call__(self, environ, start_response):
+        #
+        # get session id from cookie
+        # load session data
+        # call the WebPieApp
+        # store session data, if changed
+        # add cookie, if new session was created or the session was invalidated
+        #
+        session = self.startSession(environ)
 
-        def my_start_response(status, headers):
-            _cookie_path = self.CookiePath
-            if _cookie_path is None:
-                _cookie_path = environ.get('SCRIPT_NAME')
-            if not _cookie_path:
-                _cookie_path = '/'
-            #print "SCRIPT_NAME=%s" % (environ.get('SCRIPT_NAME'),)
-            #print "_cookie_path=", _cookie_path
-            cookie = Cookie(
-                self.CookieName,
-                session.SessionID,
-                path=_cookie_path,
-                domain=self.CookieDomain,
-                http_only=True
-            )
+        def my_start_response(status, headers, exc_info=None):
+            cookie = self.sessionCookie(environ, session)
             #print "Cookie: %s" % (cookie,)
-            return start_response(
-                status,
-                list(headers) + [("Set-Cookie", str(cookie))]
-            )
+            if cookie is not None:
+                headers = list(headers) + [("Set-Cookie", str(cookie))]
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
 
         #print "Calling WebPieApp, request: %s %s" % (environ.get("REQUEST_METHOD"), environ.get("REQUEST_URI"))
         output = WPApp.__call__(self, environ, my_start_response)
         #print "Changed: %s" % (self.Session.Changed,)
         session.saveIfChanged()
         return output
-        
-        
-        
-        
 
+    async def async_call(self, environ):
+        session = self.startSession(environ)
+        response = await WPApp.async_call(self, environ)
+        cookie = self.sessionCookie(environ, session)
+        if cookie is not None:
+            response.headers.add("Set-Cookie", str(cookie))
+        session.saveIfChanged()
+        return response
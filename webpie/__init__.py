@@ -1,5 +1,6 @@
-from .WPApp import WPApp, WPHandler, app_synchronized, webmethod, atomic, WPStaticHandler, Response
+from .WPApp import WPApp, WPHandler, app_synchronized, webmethod, atomic, WPStaticHandler, Response, JSONStream
 from .WPSessionApp import WPSessionApp
+from .session_storage import MemorySessionStorage, SQLiteSessionStorage, RemoteSessionStorage, SessionServer
 from .uid import uid, init as init_uid
 from .HTTPServer import run_server, HTTPServer, RequestProcessor
 from .logs import Logger, Logged
@@ -11,6 +12,7 @@ from .sanitizers import sanitize
 __version__ = Version
 
 __all__ = [ "WPApp", "WPHandler", "Response", 
-	"WPSessionApp", "HTTPServer", "app_synchronized", "webmethod", "WPStaticHandler",
+	"WPSessionApp", "MemorySessionStorage", "SQLiteSessionStorage", "RemoteSessionStorage", "SessionServer",
+	"HTTPServer", "app_synchronized", "webmethod", "WPStaticHandler", "JSONStream",
     "Logged", "Logger", "yaml_expand", "Version", "http_exceptions" 
 ]
@@ -0,0 +1,25 @@
+#
+# Usage: webpie <command> ...
+#
+# Commands:
+#   routes      - print URL routes of an application
+#
+
+import sys
+
+Usage = """webpie <command> ...
+Commands:
+    routes [-I <path>] <application file> [<application object name>]
+"""
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("routes",):
+        print(Usage)
+        sys.exit(2)
+    command, argv = sys.argv[1], sys.argv[2:]
+    if command == "routes":
+        from .routes import main as routes_main
+        routes_main(argv)
+
+if __name__ == "__main__":
+    main()
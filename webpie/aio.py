@@ -0,0 +1,344 @@
+import asyncio, sys, time, inspect, traceback
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from .HTTPServer import HTTPHeader
+from .uid import uid
+from .logs import Logged, Logger
+from .py3 import to_str, to_bytes
+
+#
+# ASGI <-> WSGI environ conversion
+#
+
+async def asgi_environ(scope, receive):
+    # builds WSGI-style environ from the ASGI scope. The request body is read completely
+    from io import BytesIO
+    body = []
+    more = True
+    while more:
+        msg = await receive()
+        if msg["type"] == "http.disconnect":
+            break
+        body.append(msg.get("body", b""))
+        more = msg.get("more_body", False)
+    body = b"".join(body)
+
+    server = scope.get("server") or ("", None)
+    client = scope.get("client") or ("", None)
+    env = dict(
+        REQUEST_METHOD = scope["method"].upper(),
+        PATH_INFO = scope["path"],
+        SCRIPT_NAME = scope.get("root_path", ""),
+        SCRIPT_FILENAME = "",
+        SERVER_PROTOCOL = "HTTP/" + scope.get("http_version", "1.1"),
+        QUERY_STRING = to_str(scope.get("query_string", b"")),
+        SERVER_NAME = server[0],
+        SERVER_PORT = str(server[1] or ""),
+        REMOTE_ADDR = client[0],
+        REMOTE_PORT = str(client[1] or ""),
+    )
+    env["REQUEST_SCHEME"] = env["wsgi.url_scheme"] = scope.get("scheme", "http")
+    env["wsgi.input"] = BytesIO(body)
+    env["wsgi.errors"] = sys.stderr
+    env["wsgi.version"] = (1, 0)
+    env["wsgi.multithread"] = True
+    env["wsgi.multiprocess"] = False
+    env["wsgi.run_once"] = False
+    env["WebPie.asgi_scope"] = scope
+    headers = {}
+    for h, v in scope.get("headers", []):
+        h, v = h.decode("latin-1"), v.decode("latin-1")
+        headers[h] = v
+        if h == "content-type":     env["CONTENT_TYPE"] = v
+        elif h == "content-length": env["CONTENT_LENGTH"] = v
+        else:
+            key = "HTTP_%s" % (h.upper().replace("-","_"),)
+            env[key] = env[key] + "," + v if key in env else v
+    env["WebPie.headers"] = headers
+    return env
+
+async def iterate_body(out):
+    # iterates the WSGI response body, which may be a list, a synchronous or an asynchronous iterable.
+    # Synchronous generators are advanced in the event loop's default executor so that they do not block the loop
+    if hasattr(out, "__aiter__"):
+        async for chunk in out:
+            yield to_bytes(chunk)
+    elif isinstance(out, (list, tuple)):
+        for chunk in out:
+            yield to_bytes(chunk)
+    else:
+        loop = asyncio.get_running_loop()
+        it = iter(out)
+        while True:
+            chunk = await loop.run_in_executor(None, next, it, None)
+            if chunk is None:   break
+            yield to_bytes(chunk)
+
+async def asgi_send_wsgi(out, started, send):
+    # sends WSGI output to the ASGI channel. "started" is the [status, headers] list filled by start_response,
+    # possibly during the first iteration of the body
+    chunks = iterate_body(out)
+    try:
+        first = b''
+        try:    first = await chunks.__anext__()
+        except StopAsyncIteration:
+            pass
+        status, headers = started
+        await send({
+            "type":     "http.response.start",
+            "status":   int(status.split(None, 1)[0]),
+            "headers":  [(h.lower().encode("latin-1"), str(v).encode("latin-1")) for h, v in headers]
+        })
+        if first:
+            await send({"type": "http.response.body", "body": first, "more_body": True})
+        async for chunk in chunks:
+            if chunk:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        await chunks.aclose()
+        if hasattr(out, "close"):
+            out.close()
+
+async def asgi_send_response(response, environ, send):
+    started = []
+    def start_response(status, headers, exc_info=None):
+        started[:] = [status, headers]
+    out = response(environ, start_response)
+    await asgi_send_wsgi(out, started, send)
+
+async def asgi_lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+class WSGIAdapter(object):
+
+    # ASGI interface to a WSGI application, which runs in the event loop's default executor
+
+    def __init__(self, wsgi_app):
+        self.WSGIApp = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await asgi_lifespan(receive, send)
+        environ = await asgi_environ(scope, receive)
+        started = []
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+        out = await asyncio.get_running_loop().run_in_executor(None, self.WSGIApp, environ, start_response)
+        await asgi_send_wsgi(out, started, send)
+
+def asgi_app(app):
+    # WPApp, ASGI application or WSGI application -> ASGI application
+    if hasattr(app, "asgi"):
+        return app.asgi
+    elif inspect.iscoroutinefunction(app) or inspect.iscoroutinefunction(getattr(app, "__call__", None)):
+        return app
+    else:
+        return WSGIAdapter(app)
+
+#
+# Server
+#
+
+class AsyncHTTPServer(Logged):
+
+    #
+    # HTTP/1.1 server built on asyncio streams. Each connection and each request is a coroutine,
+    # so idle and long-polling clients cost no threads. Synchronous handlers run in the thread pool
+    # of max_workers threads
+    #
+
+    MAX_HEADER = 100000
+    BODY_CHUNK = 65536
+    DISCONNECT_POLL = 1.0       # interval to check whether the client closed the connection while waiting for http.disconnect
+
+    def __init__(self, port, app, max_workers = 20, backlog = 1024,
+                timeout = 15.0, keepalive_timeout = 5.0, max_requests_per_connection = 100,
+                logger = None, logging = False, log_file = "-", debug = False):
+        self.Port = port
+        if logger is None and logging:
+            logger = Logger(log_file)
+        Logged.__init__(self, f"[async server {port}]", logger=logger, debug=debug)
+        self.App = asgi_app(app)
+        self.MaxWorkers = max_workers
+        self.Backlog = backlog
+        self.Timeout = timeout
+        self.KeepAliveTimeout = keepalive_timeout
+        self.MaxRequestsPerConnection = max_requests_per_connection
+        self.Server = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(self.MaxWorkers))
+        self.Server = await asyncio.start_server(self.connection, port=self.Port, backlog=self.Backlog,
+                limit=self.MAX_HEADER)
+        async with self.Server:
+            await self.Server.serve_forever()
+
+    def close(self):
+        if self.Server is not None:
+            self.Server.close()
+
+    async def connection(self, reader, writer):
+        caddr = writer.get_extra_info("peername") or ("-", "-")
+        sequence = 0
+        try:
+            while sequence < self.MaxRequestsPerConnection:
+                timeout = self.Timeout if sequence == 0 else self.KeepAliveTimeout
+                try:
+                    data = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    writer.write(b"HTTP/1.1 400 Request is too long\r\n\r\n")
+                    break
+                header = HTTPHeader()
+                header.consume(data)
+                if not header.is_valid() or not header.is_client():
+                    writer.write(b"HTTP/1.1 400 Invalid request\r\n\r\n")
+                    break
+                if not await self.request(header, reader, writer, caddr, sequence):
+                    break
+                sequence += 1
+        except Exception as e:
+            self.debug("connection error: %s" % (traceback.format_exc(),))
+        finally:
+            try:
+                writer.close()
+                await writer.wait_closed()
+            except:
+                pass
+
+    async def request(self, header, reader, writer, caddr, sequence):
+        # processes single request. Returns True if the connection can be reused
+        request_id = uid()
+        method = header.Method
+        server_addr = writer.get_extra_info("sockname") or ("", self.Port)
+        keep_alive = sequence + 1 < self.MaxRequestsPerConnection and header.keep_alive()
+        chunked_body = "chunked" in header.get("Transfer-Encoding", "").lower()
+        body_remaining = 0 if chunked_body else int(header.get("Content-Length", 0))
+        state = dict(status = None, byte_count = 0, chunked = False, keep_alive = keep_alive,
+                body_done = body_remaining == 0 and not chunked_body,      # the whole body was read from the connection
+                request_sent = False,                                       # the last http.request message was returned
+                finished = asyncio.Event())                                 # the response is complete
+
+        scope = {
+            "type":         "http",
+            "asgi":         {"version": "3.0"},
+            "http_version": header.Protocol.split("/", 1)[-1],
+            "method":       method,
+            "scheme":       "http",
+            "path":         unquote(header.path()),
+            "raw_path":     to_bytes(header.path()),
+            "query_string": to_bytes(header.query()),
+            "root_path":    "",
+            "headers":      [(h.lower().encode("latin-1"), v.encode("latin-1")) for h, v in header.Headers.allitems()],
+            "client":       caddr[:2],
+            "server":       server_addr[:2],
+        }
+
+        async def receive():
+            nonlocal body_remaining
+            if state["body_done"]:
+                if not state["request_sent"]:
+                    state["request_sent"] = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                # wait until the response is complete or the client closes the connection
+                finished = state["finished"]
+                while not finished.is_set() and not reader.at_eof() and not writer.is_closing():
+                    try:    await asyncio.wait_for(finished.wait(), self.DISCONNECT_POLL)
+                    except asyncio.TimeoutError:
+                        pass
+                return {"type": "http.disconnect"}
+            if chunked_body:
+                size = int((await reader.readline()).split(b";", 1)[0], 16)
+                if size == 0:
+                    while (await reader.readline()).strip():    # trailer
+                        pass
+                    state["body_done"] = state["request_sent"] = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                data = await reader.readexactly(size)
+                await reader.readline()
+                return {"type": "http.request", "body": data, "more_body": True}
+            data = await reader.read(min(self.BODY_CHUNK, body_remaining))
+            if not data:
+                raise ConnectionError("connection closed while reading request body")
+            body_remaining -= len(data)
+            state["body_done"] = state["request_sent"] = body_remaining == 0
+            return {"type": "http.request", "body": data, "more_body": not state["body_done"]}
+
+        async def send(msg):
+            if msg["type"] == "http.response.start":
+                status = state["status"] = msg["status"]
+                headers = [(to_str(h), to_str(v)) for h, v in msg.get("headers", [])]
+                delimited = status//100 == 1 or status in (204, 304) or method == "HEAD"
+                out = []
+                for h, v in headers:
+                    hl = h.lower()
+                    if hl == "connection":
+                        continue
+                    if hl == "content-length" or hl == "transfer-encoding" and "chunked" in v.lower():
+                        delimited = True
+                    out.append("%s: %s" % (h, v))
+                if not delimited and header.Protocol == "HTTP/1.1":
+                    out.append("Transfer-Encoding: chunked")
+                    state["chunked"] = True
+                    delimited = True
+                state["keep_alive"] = state["keep_alive"] and delimited
+                out.append("Connection: keep-alive" if state["keep_alive"] else "Connection: close")
+                out.append(f"X-WebPie-Request-Id: {request_id}")
+                writer.write(to_bytes("HTTP/1.1 %d %s\r\n%s\r\n\r\n" % (status, _reason(status), "\r\n".join(out))))
+            elif msg["type"] == "http.response.body":
+                body = msg.get("body", b"")
+                more = msg.get("more_body", False)
+                if method != "HEAD":
+                    if state["chunked"]:
+                        if body:
+                            writer.write(b"%x\r\n%s\r\n" % (len(body), body))
+                        if not more:
+                            writer.write(b"0\r\n\r\n")
+                    elif body:
+                        writer.write(body)
+                state["byte_count"] += len(body)
+                if not more:
+                    state["finished"].set()
+                await writer.drain()
+
+        try:
+            await self.App(scope, receive, send)
+        except Exception as e:
+            self.error("error in application: %s" % (traceback.format_exc(),))
+            if state["status"] is None:
+                writer.write(b"HTTP/1.1 500 Error\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\n")
+            return False
+        finally:
+            state["finished"].set()
+            self.log('%s %s:%s :%s %s %s -> %s %s' % (
+                        request_id, caddr[0], caddr[1], self.Port,
+                        method, header.OriginalURI, state["status"], state["byte_count"]
+                    )
+            )
+        if state["keep_alive"]:
+            # skip unread request body
+            while not state["body_done"]:
+                await receive()
+        return state["keep_alive"]
+
+def _reason(status):
+    from http import HTTPStatus
+    try:    return HTTPStatus(status).phrase
+    except ValueError:
+        return "Unknown"
+
+def run_async_server(port, app, **args):
+    AsyncHTTPServer(port, app, **args).run()
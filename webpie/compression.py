@@ -0,0 +1,169 @@
+#
+# Response compression
+#
+#   application = WPApp(Handler, compress=True)           # or compress=dict(level=..., min_size=...)
+#   application = Compressor(wsgi_app, level=5)             # any WSGI application
+#
+# The encoding is negotiated with the Accept-Encoding request header. Responses are compressed only if their
+# Content-Type is compressible, they are not encoded already, and their Content-Length, if known,
+# is at least min_size. Bodies which are lists are compressed at once, other iterables are compressed incrementally,
+# chunk by chunk. An empty chunk produced by the application flushes the compressor, so that the client
+# receives everything sent so far.
+# Responses to HEAD and range requests, and responses which advertise byte ranges (e.g. from WPStaticHandler, which
+# serves precompressed files itself) are not compressed
+#
+
+import zlib
+from .webob.acceptparse import create_accept_encoding_header
+from .static_cache import COMPRESSIBLE_TYPES
+from .py3 import to_bytes
+
+try:    import brotli
+except ImportError:
+    brotli = None
+
+class ZlibEncoder(object):
+
+    def __init__(self, level, wbits):
+        self.Compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self.Compressor.compress(data)
+
+    def flush(self):
+        return self.Compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.Compressor.flush(zlib.Z_FINISH)
+
+class BrotliEncoder(object):
+
+    def __init__(self, quality):
+        self.Compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self.Compressor.process(data)
+
+    def flush(self):
+        return self.Compressor.flush()
+
+    def finish(self):
+        return self.Compressor.finish()
+
+class CompressedBody(object):
+
+    def __init__(self, out, state):
+        self.Out = out
+        self.State = state          # state["encoder"] is set by start_response
+
+    def __iter__(self):
+        encoder = None
+        for chunk in self.Out:
+            encoder = encoder or self.State.get("encoder")
+            if encoder is None:
+                yield chunk
+            elif chunk:
+                data = encoder.compress(to_bytes(chunk))
+                if data:
+                    yield data
+            else:
+                yield encoder.flush()
+                yield b''
+        encoder = encoder or self.State.get("encoder")
+        if encoder is not None:
+            yield encoder.finish()
+
+    def close(self):
+        if hasattr(self.Out, "close"):
+            self.Out.close()
+
+class Compressor(object):
+
+    def __init__(self, app=None, level=6, brotli_quality=4, min_size=1024, types=COMPRESSIBLE_TYPES,
+                encodings=("br", "gzip", "deflate")):
+        self.App = app
+        self.Level = level
+        self.BrotliQuality = brotli_quality
+        self.MinSize = min_size
+        self.Types = tuple(types)
+        self.Encodings = [e for e in encodings if e != "br" or brotli is not None]
+
+    def encoder(self, encoding):
+        if encoding == "gzip":
+            return ZlibEncoder(self.Level, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            return ZlibEncoder(self.Level, zlib.MAX_WBITS)
+        elif encoding == "br":
+            return BrotliEncoder(self.BrotliQuality)
+
+    def negotiate(self, environ):
+        # returns the encoding to use or None
+        accept = environ.get("HTTP_ACCEPT_ENCODING")
+        if not accept or environ.get("REQUEST_METHOD") == "HEAD" or "HTTP_RANGE" in environ:
+            return None
+        accept = create_accept_encoding_header(accept)
+        offers = accept.acceptable_offers(self.Encodings)
+        if not offers:
+            return None
+        encoding, q = offers[0]
+        if "identity" in accept.header_value.lower():
+            identity = accept.acceptable_offers(["identity"])       # empty if identity;q=0
+            if identity and identity[0][1] > q:
+                return None         # explicitly preferred
+        return encoding
+
+    def compressible(self, status, headers):
+        if not status.startswith("200") and not status.startswith("203"):
+            return False
+        content_type = None
+        for h, v in headers:
+            h = h.lower()
+            if h == "content-type":
+                content_type = v.split(";", 1)[0].strip().lower()
+            elif h == "content-encoding" and v.strip().lower() != "identity" \
+                    or h == "accept-ranges" and v.strip().lower() == "bytes" \
+                    or h == "cache-control" and "no-transform" in v.lower():
+                return False
+            elif h == "content-length":
+                try:
+                    if int(v) < self.MinSize:
+                        return False
+                except ValueError:
+                    return False
+        return content_type is not None and content_type.startswith(self.Types)
+
+    def __call__(self, environ, start_response):
+        return self.wrap(self.App, environ, start_response)
+
+    def wrap(self, app, environ, start_response):
+        # calls the WSGI application and compresses its response
+        encoding = self.negotiate(environ)
+        state = {}
+
+        def compressing_start_response(status, headers, exc_info=None):
+            state["started"] = True
+            if self.compressible(status, headers):
+                # the response depends on Accept-Encoding even if it is not compressed for this client
+                vary = [v for h, v in headers if h.lower() == "vary"]
+                if not any("accept-encoding" in v.lower() or "*" in v for v in vary):
+                    headers = [(h, v) for h, v in headers if h.lower() != "vary"]
+                    headers.append(("Vary", ", ".join(vary + ["Accept-Encoding"])))
+                if encoding is not None:
+                    # strong entity tag of the compressed representation must differ from the original one
+                    headers = [(h, '%s-%s"' % (v.rstrip('"'), encoding)) if h.lower() == "etag" and v.startswith('"') else (h, v)
+                            for h, v in headers if h.lower() not in ("content-length", "content-encoding")]
+                    headers.append(("Content-Encoding", encoding))
+                    state["encoder"] = self.encoder(encoding)
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+
+        out = app(environ, compressing_start_response)
+        encoder = state.get("encoder")
+        if encoder is not None and isinstance(out, (list, tuple)):
+            try:
+                return [encoder.compress(b''.join(to_bytes(x) for x in out)) + encoder.finish()]
+            finally:
+                if hasattr(out, "close"):
+                    out.close()
+        if encoding is None or state.get("started") and encoder is None:
+            return out
+        return CompressedBody(out, state)
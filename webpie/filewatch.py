@@ -0,0 +1,291 @@
+#
+# File change notification, used by multiserver and router for config and touch_reload files
+#
+#   watcher = file_watcher()                # shared FileWatcher of the process
+#   watcher.watch(path, callback)           # callback(path) is called from the watcher thread when the file changes
+#   watcher.unwatch(path, callback)
+#
+# On Linux, the directories containing the files are watched with inotify, so that files replaced by editors or
+# deployment tools (written to a temporary file, then renamed) are noticed too. If the path goes through symbolic
+# links, the links and the file they point to are watched as well, so that replacing a link is noticed.
+# Files which can not be watched with inotify, e.g. because their directory does not exist, and all files on other
+# platforms are polled with os.stat() every poll_interval seconds.
+#
+# A notification means that the file may have changed. Callbacks are expected to check the file themselves,
+# e.g. by comparing its modification time with the one they saw before.
+#
+
+import os, os.path, struct, time, traceback, selectors
+from socket import socketpair
+from pythreader import PyThread, synchronized
+
+try:
+    import ctypes, ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError):
+    libc = None
+
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_NONBLOCK     = 0o4000
+IN_CLOEXEC      = 0o2000000
+
+# IN_MODIFY is not used: it is generated for each write, the file is complete on IN_CLOSE_WRITE
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+EventHeader = struct.Struct("iIII")         # wd, mask, cookie, len
+
+class Inotify(object):
+
+    def __init__(self):
+        self.FD = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.FD < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def fileno(self):
+        return self.FD
+
+    def add_watch(self, path, mask):
+        wd = libc.inotify_add_watch(self.FD, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def rm_watch(self, wd):
+        libc.inotify_rm_watch(self.FD, wd)
+
+    def read_events(self):
+        # returns list of (wd, mask, name)
+        events = []
+        while True:
+            try:    data = os.read(self.FD, 65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            i = 0
+            while i < len(data):
+                wd, mask, cookie, length = EventHeader.unpack_from(data, i)
+                i += EventHeader.size
+                name = os.fsdecode(data[i:i+length].rstrip(b"\0"))
+                i += length
+                events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        try:    os.close(self.FD)
+        except: pass
+
+def inotify_available():
+    return libc is not None and hasattr(libc, "inotify_init1")
+
+def link_entries(path):
+    # (directory, name) of the path, of the symbolic links it resolves through and of the file it points to
+    entries = set()
+    pending = [path]
+    while pending and len(entries) < 40:
+        p = pending.pop()
+        entries.add(os.path.split(p))
+        head = p
+        while head != os.path.dirname(head):
+            if os.path.islink(head):
+                entries.add(os.path.split(head))
+                target = os.path.join(os.path.dirname(head), os.readlink(head))
+                pending.append(os.path.normpath(target + p[len(head):]))
+                break
+            head = os.path.dirname(head)
+    return entries
+
+def stat_key(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        return None
+
+class FileWatcher(PyThread):
+
+    Settle = 0.02           # collect events generated by one update before calling the callbacks
+
+    def __init__(self, poll_interval=5.0, use_inotify=True):
+        PyThread.__init__(self, name="[file watcher]", daemon=True)
+        self.PollInterval = poll_interval
+        self.NextPoll = time.time() + poll_interval
+        self.Callbacks = {}             # path -> [callback, ...]
+        self.Polled = {}                # path -> stat_key, for the files not watched with inotify
+        self.Dirs = {}                  # directory -> inotify watch descriptor
+        self.WatchDirs = {}             # watch descriptor -> directory
+        self.Links = {}                 # path going through symlinks -> link_entries(path)
+        self.Stop = False
+        self.Selector = selectors.DefaultSelector()
+        self.WakeUpIn, self.WakeUpOut = socketpair()
+        self.WakeUpIn.setblocking(False)
+        self.Selector.register(self.WakeUpIn, selectors.EVENT_READ, None)
+        self.Inotify = None
+        if use_inotify and inotify_available():
+            try:    self.Inotify = Inotify()
+            except OSError:
+                pass
+            else:
+                self.Selector.register(self.Inotify, selectors.EVENT_READ, "inotify")
+
+    def uses_inotify(self):
+        return self.Inotify is not None
+
+    @synchronized
+    def watch(self, path, callback):
+        path = os.path.abspath(path)
+        callbacks = self.Callbacks.get(path)
+        if callbacks is None:
+            callbacks = self.Callbacks[path] = []
+            if not self.add_inotify(path):
+                self.Polled[path] = stat_key(path)
+        if callback not in callbacks:
+            callbacks.append(callback)
+        self.wake_up()
+
+    @synchronized
+    def unwatch(self, path, callback=None):
+        # inotify watches of directories are kept, events for files no longer watched are ignored
+        path = os.path.abspath(path)
+        callbacks = self.Callbacks.get(path, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+        if callback is None or not callbacks:
+            self.Callbacks.pop(path, None)
+            self.Polled.pop(path, None)
+            self.Links.pop(path, None)
+
+    def add_inotify(self, path):
+        if self.Inotify is None:
+            return False
+        entries = link_entries(path) if os.path.realpath(path) != path else {os.path.split(path)}
+        for d, _ in entries:
+            if d not in self.Dirs:
+                try:    wd = self.Inotify.add_watch(d, WATCH_MASK)
+                except OSError:
+                    return False
+                self.Dirs[d] = wd
+                self.WatchDirs[wd] = d
+        if len(entries) > 1:
+            self.Links[path] = entries
+        return True
+
+    @synchronized
+    def inotify_changes(self):
+        changed = set()
+        for wd, mask, name in self.Inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                changed |= set(self.Callbacks)
+                continue
+            d = self.WatchDirs.get(wd)
+            if d is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed or unmounted, poll its files from now on
+                del self.WatchDirs[wd]
+                del self.Dirs[d]
+                for path in self.Callbacks:
+                    if os.path.dirname(path) == d or any(ld == d for ld, _ in self.Links.get(path, ())):
+                        self.Links.pop(path, None)
+                        self.Polled[path] = stat_key(path)
+                        changed.add(path)
+                continue
+            path = os.path.join(d, name)
+            if path in self.Callbacks:
+                changed.add(path)
+            for link, entries in list(self.Links.items()):
+                if (d, name) in entries:
+                    changed.add(link)
+                    # the link may point to another directory now
+                    if not self.add_inotify(link):
+                        del self.Links[link]
+                        self.Polled[link] = stat_key(link)
+        return changed
+
+    @synchronized
+    def poll_changes(self):
+        changed = set()
+        for path, key in list(self.Polled.items()):
+            new_key = stat_key(path)
+            if new_key != key:
+                self.Polled[path] = new_key
+                changed.add(path)
+        self.NextPoll = time.time() + self.PollInterval
+        return changed
+
+    def notify(self, changed):
+        with self:
+            calls = [(path, cb) for path in changed for cb in self.Callbacks.get(path, [])]
+        for path, callback in calls:
+            try:    callback(path)
+            except:
+                traceback.print_exc()
+
+    def wake_up(self):
+        try:    self.WakeUpOut.send(b'x')
+        except: pass
+
+    def stop(self):
+        self.Stop = True
+        self.wake_up()
+
+    def run(self):
+        while not self.Stop:
+            timeout = max(0.0, self.NextPoll - time.time()) if self.Polled else None
+            changed = set()
+            for key, events in self.Selector.select(timeout):
+                if key.data is None:
+                    try:    self.WakeUpIn.recv(4096)
+                    except BlockingIOError: pass
+                else:
+                    changed |= self.inotify_changes()
+            if changed:
+                time.sleep(self.Settle)
+                changed |= self.inotify_changes()
+            if self.Polled and time.time() >= self.NextPoll:
+                changed |= self.poll_changes()
+            if changed:
+                self.notify(changed)
+        self.close()
+
+    def close(self):
+        try:    self.Selector.close()
+        except: pass
+        if self.Inotify is not None:
+            self.Inotify.close()
+        self.WakeUpIn.close()
+        self.WakeUpOut.close()
+
+#
+# One watcher per process. Worker processes forked by multiserver create their own
+#
+
+Watcher = None
+
+def file_watcher(poll_interval=5.0):
+    global Watcher
+    if Watcher is None:
+        Watcher = FileWatcher(poll_interval)
+        Watcher.start()
+    return Watcher
+
+def reset_after_fork():
+    # the watcher thread does not exist in the child process
+    global Watcher
+    if Watcher is not None:
+        Watcher.close()
+        Watcher = None
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,241 @@
+#
+# Streaming multipart/form-data parser
+#
+# The request body is read once, in chunks, directly from the input stream. Parts are returned one at a time
+# and their contents can be read as streams, so the memory used does not depend on the size of the upload.
+#
+#   for part in iterate_parts(request):
+#       if part.filename:
+#           part.save(open(...))           # or read it with part.read(n)
+#       else:
+#           value = part.text()
+#
+#   form = parse_form(request)              # MultiDict: field name -> str or Part with the file contents
+#
+# Limits can be passed as arguments or set for the application with WPApp(..., upload_limits={...}):
+#
+#   max_size        - total body size, bytes
+#   max_part_size   - size of one file part, bytes
+#   max_field_size  - size of one non-file field, which is kept in memory, bytes
+#   max_parts       - number of parts
+#   spool_size      - file parts larger than this are spooled to a temporary file instead of memory
+#
+
+import tempfile
+from email.parser import HeaderParser
+from email.message import Message
+from email.utils import collapse_rfc2231_value
+from .webob.exc import HTTPBadRequest, HTTPRequestEntityTooLarge
+from .webob.multidict import MultiDict
+
+Defaults = dict(
+    max_size        = None,
+    max_part_size   = None,
+    max_field_size  = 1024*1024,
+    max_parts       = 1000,
+    spool_size      = 1024*1024
+)
+
+class Part(object):
+
+    #
+    # One part of the multipart body. Has the same attributes as cgi.FieldStorage: name, filename, type,
+    # type_options, headers, file and value
+    #
+
+    def __init__(self, parser, headers):
+        self.Parser = parser
+        self.headers = headers
+        name = headers.get_param("name", header="content-disposition")
+        self.name = collapse_rfc2231_value(name) if name is not None else None
+        self.filename = headers.get_filename()
+        if "content-type" in headers:
+            self.type = headers.get_content_type()
+            self.type_options = dict(headers.get_params()[1:])
+        else:
+            self.type = "application/octet-stream" if self.filename is not None else "text/plain"
+            self.type_options = {}
+        self.size = 0
+        self.file = None                # set by save()
+        self.Done = False
+
+    def __repr__(self):
+        return "Part(%r, filename=%r, type=%r)" % (self.name, self.filename, self.type)
+
+    def read(self, n=-1):
+        # reads the part contents. After save(), reads the saved file
+        if self.file is not None:
+            return self.file.read(n)
+        if self.Done or self.Parser.Current is not self:
+            return b""
+        if n is None or n < 0:
+            out = []
+            data = self.read(self.Parser.ChunkSize)
+            while data:
+                out.append(data)
+                data = self.read(self.Parser.ChunkSize)
+            return b"".join(out)
+        data = self.Parser.read_data(n)
+        if not data:
+            self.Done = True
+        self.size += len(data)
+        limit = self.Parser.MaxPartSize if self.filename is not None else self.Parser.MaxFieldSize
+        if limit is not None and self.size > limit:
+            raise HTTPRequestEntityTooLarge("Multipart form part %s is too large" % (self.name,))
+        return data
+
+    def __iter__(self):
+        data = self.read(self.Parser.ChunkSize)
+        while data:
+            yield data
+            data = self.read(self.Parser.ChunkSize)
+
+    def save(self, sink=None):
+        # copies the rest of the part to the sink, a writable file object, or to a temporary file spooled to disk
+        # when it grows over spool_size. The file becomes part.file and is positioned at its beginning if it is seekable
+        if sink is None:
+            sink = tempfile.SpooledTemporaryFile(max_size=self.Parser.SpoolSize)
+        for data in self:
+            sink.write(data)
+        try:    sink.seek(0)
+        except: pass
+        self.file = sink
+        return sink
+
+    def text(self):
+        charset = self.type_options.get("charset", "utf-8")
+        try:    return self.read().decode(charset, "replace")
+        except LookupError:
+            raise HTTPBadRequest("Unknown charset %s in multipart form part" % (charset,))
+
+    @property
+    def value(self):
+        # contents of the saved file
+        if self.file is None:
+            self.save()
+        data = self.file.read()
+        self.file.seek(0)
+        return data
+
+class MultipartParser(object):
+
+    ChunkSize = 65536
+    MaxHeaderSize = 16*1024
+
+    def __init__(self, stream, boundary, max_size=None, max_part_size=None, max_field_size=1024*1024,
+                max_parts=1000, spool_size=1024*1024):
+        if isinstance(boundary, str):
+            boundary = boundary.encode("latin-1")
+        if not boundary or len(boundary) > 200:
+            raise HTTPBadRequest("Invalid multipart boundary")
+        self.Stream = stream
+        self.Delimiter = b"\r\n--" + boundary
+        self.Buffer = bytearray(b"\r\n")            # so that the first boundary looks like all others
+        self.EOF = False
+        self.BytesRead = 0
+        self.MaxSize = max_size
+        self.MaxPartSize = max_part_size
+        self.MaxFieldSize = max_field_size
+        self.MaxParts = max_parts
+        self.SpoolSize = spool_size
+        self.NParts = 0
+        self.Current = None
+        self.Done = False
+
+    def fill(self):
+        # reads next chunk of the body into the buffer. Returns False at EOF
+        if self.EOF:
+            return False
+        data = self.Stream.read(self.ChunkSize)
+        if not data:
+            self.EOF = True
+            return False
+        self.BytesRead += len(data)
+        if self.MaxSize is not None and self.BytesRead > self.MaxSize:
+            raise HTTPRequestEntityTooLarge("Request body is too large")
+        self.Buffer += data
+        return True
+
+    def read_data(self, n):
+        # returns up to n bytes of the current part, or b"" if the buffer starts with the delimiter
+        delimiter = self.Delimiter
+        while True:
+            i = self.Buffer.find(delimiter)
+            available = i if i >= 0 else len(self.Buffer) - len(delimiter) + 1
+            if i >= 0 or available > 0:
+                break
+            if not self.fill():
+                raise HTTPBadRequest("Unexpected end of multipart body")
+        n = min(n, available)
+        out = bytes(self.Buffer[:n])
+        del self.Buffer[:n]
+        return out
+
+    def next_part(self):
+        # skips the rest of the current part and reads headers of the next one. Returns None after the last part
+        if self.Done:
+            return None
+        if self.Current is not None:
+            self.Current.Done = True
+        while self.read_data(self.ChunkSize):       # rest of the part or the preamble
+            pass
+        while len(self.Buffer) < len(self.Delimiter) + 2:
+            if not self.fill():
+                raise HTTPBadRequest("Unexpected end of multipart body")
+        del self.Buffer[:len(self.Delimiter)]
+        if self.Buffer[:2] == b"--":
+            self.Done = True
+            self.Current = None
+            return None
+        while True:
+            i = self.Buffer.find(b"\r\n\r\n")
+            if i >= 0:
+                break
+            if len(self.Buffer) > self.MaxHeaderSize or not self.fill():
+                raise HTTPBadRequest("Invalid multipart part headers")
+        if i > self.MaxHeaderSize:
+            raise HTTPBadRequest("Multipart part headers are too long")
+        header = bytes(self.Buffer[:i+4])
+        del self.Buffer[:i+4]
+        self.NParts += 1
+        if self.MaxParts is not None and self.NParts > self.MaxParts:
+            raise HTTPRequestEntityTooLarge("Too many parts in multipart form")
+        header = header.split(b"\r\n", 1)[-1]          # skip transport padding after the boundary
+        self.Current = Part(self, HeaderParser().parsestr(header.decode("utf-8", "replace")))
+        return self.Current
+
+    def __iter__(self):
+        part = self.next_part()
+        while part is not None:
+            yield part
+            part = self.next_part()
+
+def boundary(content_type):
+    m = Message()
+    m["content-type"] = content_type
+    if m.get_content_type() != "multipart/form-data":
+        return None
+    return m.get_param("boundary")
+
+def iterate_parts(request, **limits):
+    # returns the parser, which yields the parts of the request body. Each part should be read before advancing to
+    # the next one, otherwise the rest of it is skipped
+    b = boundary(request.headers.get("Content-Type", ""))
+    if not b:
+        raise HTTPBadRequest("Not a multipart/form-data request")
+    params = dict(Defaults)
+    params.update(request.environ.get("webpie.upload_limits") or {})
+    params.update(limits)
+    return MultipartParser(request.body_file, collapse_rfc2231_value(b), **params)
+
+def parse_form(request, sink=None, **limits):
+    # reads the whole form. Non-file fields are decoded to str, file parts are saved and added as Part objects.
+    # sink(part) can return a writable file object to save the part to, or None to use a temporary file
+    form = MultiDict()
+    for part in iterate_parts(request, **limits):
+        if part.filename is None:
+            form.add(part.name, part.text())
+        else:
+            part.save(sink(part) if sink is not None else None)
+            form.add(part.name, part)
+    return form
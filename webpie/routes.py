@@ -0,0 +1,89 @@
+#
+# Prints the URL routes of a WebPie application
+#
+# Usage: webpie routes [-a] [-I <path>] <application file> [<application object name>]
+#
+#   The application file is loaded the same way multiserver loads it. The default application object name is "application"
+#   Methods and attributes defined by WPHandler itself are reachable in non-strict handlers too,
+#   but they are listed only with -a
+#
+
+import sys, os, getopt
+from .WPApp import WPApp, WPHandler, RouteTable, Request
+
+Usage = """webpie routes [-a] [-I <path>] <application file> [<application object name>]
+    -a              - include methods and attributes defined by WPHandler
+    -I <path>       - add path to sys.path, can be repeated
+"""
+
+def walk(handler, path, seen, hidden):
+    # yields (path, kind, description) for every route of the handler tree
+    if id(handler) in seen:
+        return
+    seen.add(id(handler))
+    table = RouteTable.table(type(handler))
+    words = set(handler.__dict__) | set(handler._WebMethods)
+    words |= set(w for w, (kind, _) in table.Routes.items() if kind not in (RouteTable.NOTFOUND, RouteTable.DYNAMIC))
+    for word in sorted(words - hidden):
+        kind, value = table.lookup(handler, word)
+        if kind == RouteTable.DYNAMIC:
+            # instance attribute, routed as before
+            value = handler.__dict__.get(word)
+            if not callable(value) or not isinstance(value, WPHandler) and (handler._Strict or word.startswith("_")):
+                continue
+            kind = RouteTable.CALL
+        elif kind == RouteTable.NOTFOUND:
+            continue
+        child_path = path + "/" + word
+        target = getattr(value, "__qualname__", None) or type(value).__qualname__
+        yield child_path, RouteTable.KindNames[kind], target
+        if kind == RouteTable.HANDLER:
+            yield from walk(value, child_path, seen, hidden)
+
+def load_application(fname, name):
+    g = {}
+    sys.path.insert(0, os.path.dirname(os.path.abspath(fname)))
+    exec(open(fname, "r").read(), g)
+    app = g.get(name)
+    if app is None:
+        raise ValueError(f'Application object "{name}" not found in {fname}')
+    if callable(app) and not isinstance(app, WPApp):
+        app = app()
+    return app
+
+def routes(app, show_all=False):
+    environ = Request.blank("/").environ
+    request = app.prepare(environ)
+    hidden = set()
+    if not show_all:
+        base = WPHandler(request, app)
+        hidden = set(WPHandler.__dict__) | set(base.__dict__) | set(base._WebMethods)
+    if app.RootClass is not None:
+        root = app.RootClass(request, app, *app.HandlerParams, **app.HandlerArgs)
+    else:
+        root = app.RootHandler
+    if not isinstance(root, WPHandler):
+        return [("/", "callable", getattr(root, "__qualname__", None) or type(root).__qualname__)]
+    return list(walk(root, "", set(), hidden))
+
+def main(argv = sys.argv[1:]):
+    opts, args = getopt.getopt(argv, "aI:h")
+    if not args or ("-h", "") in opts:
+        print(Usage)
+        sys.exit(2)
+    for k, v in opts:
+        if k == "-I":
+            sys.path.insert(0, v)
+    fname = args[0]
+    name = args[1] if len(args) > 1 else "application"
+    app = load_application(fname, name)
+    if not isinstance(app, WPApp):
+        print(f"{name} is not a WPApp object")
+        sys.exit(1)
+    out = routes(app, ("-a", "") in opts)
+    width = max([len(p) for p, _, _ in out] + [4])
+    for path, kind, target in out:
+        print("%-*s  %-9s %s" % (width, path, kind, target))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#
+# Client-side sessions: session data stored in a signed and, optionally, encrypted cookie
+#
+# Cookie value format:
+#
+#   <key id>.<time issued, hex>.<payload>.<signature>
+#
+#   key id      - identifies the secret used to sign the cookie, so that the secrets can be rotated:
+#                 new cookies are signed with the first secret, and cookies signed with any of the listed secrets
+#                 are accepted
+#   payload     - base64url encoded flag byte + serialized data. Flags: "j" - serialized, "z" - serialized and
+#                 zlib-compressed, "e" - encrypted with AES-GCM (requires the cryptography package)
+#   signature   - base64url encoded HMAC-SHA256 of the rest of the value
+#
+
+import hmac, hashlib, json, zlib, time, os
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+
+try:    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = None
+
+class JSONSerializer(object):
+
+    # compact JSON. Any object with the same dumps() and loads() methods, e.g. the msgpack module, can be used instead
+
+    @staticmethod
+    def dumps(data):
+        return json.dumps(data, separators=(",", ":")).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+def b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def b64decode(text):
+    return urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+class SessionCookieCodec(object):
+
+    COMPRESS_MIN = 128          # do not try to compress shorter data
+
+    def __init__(self, secrets, session_timeout=3600, encrypt=False, serializer=None, max_size=4000):
+        # secrets: secret string or list of secrets, the first one is used to sign new cookies
+        if isinstance(secrets, (str, bytes)):
+            secrets = [secrets]
+        if not secrets:
+            raise ValueError("At least one cookie secret is required")
+        if encrypt and AESGCM is None:
+            raise ValueError("Cookie encryption requires the cryptography package")
+        self.Keys = {}              # key id -> (signing key, encryption key)
+        self.CurrentKeyID = None
+        for secret in secrets:
+            if isinstance(secret, str):
+                secret = secret.encode("utf-8")
+            key_id = b64encode(hashlib.sha256(b"webpie-key-id" + secret).digest()[:4])
+            self.Keys[key_id] = (
+                hmac.new(secret, b"webpie-session-sign", hashlib.sha256).digest(),
+                hmac.new(secret, b"webpie-session-encrypt", hashlib.sha256).digest()
+            )
+            if self.CurrentKeyID is None:
+                self.CurrentKeyID = key_id
+        self.SessionTimeout = session_timeout
+        self.Encrypt = encrypt
+        self.Serializer = serializer or JSONSerializer
+        self.MaxSize = max_size
+
+    def sign(self, key_id, text):
+        return b64encode(hmac.new(self.Keys[key_id][0], text.encode("ascii"), hashlib.sha256).digest())
+
+    def encode(self, data, now=None):
+        # returns the cookie value or None if the data can not be serialized or the value is longer than max_size
+        try:    body = self.Serializer.dumps(data)
+        except (TypeError, ValueError):
+            return None
+        flag = b"j"
+        if len(body) >= self.COMPRESS_MIN:
+            compressed = zlib.compress(body)
+            if len(compressed) < len(body):
+                flag, body = b"z", compressed
+        key_id = self.CurrentKeyID
+        if self.Encrypt:
+            nonce = os.urandom(12)
+            body = nonce + AESGCM(self.Keys[key_id][1]).encrypt(nonce, flag + body, key_id.encode("ascii"))
+            flag = b"e"
+        text = "%s.%x.%s" % (key_id, int(now or time.time()), b64encode(flag + body))
+        value = text + "." + self.sign(key_id, text)
+        return value if len(value) <= self.MaxSize else None
+
+    def decode(self, value, now=None):
+        # returns (data, time issued) or (None, None) if the value is invalid, forged or expired
+        try:
+            text, signature = value.rsplit(".", 1)
+            key_id, issued, payload = text.split(".")
+            if key_id not in self.Keys or not hmac.compare_digest(signature, self.sign(key_id, text)):
+                return None, None
+            issued = int(issued, 16)
+            if issued + self.SessionTimeout < (now or time.time()):
+                return None, None
+            payload = b64decode(payload)
+            flag, body = payload[:1], payload[1:]
+            if flag == b"e":
+                if AESGCM is None:
+                    return None, None
+                payload = AESGCM(self.Keys[key_id][1]).decrypt(body[:12], body[12:], key_id.encode("ascii"))
+                flag, body = payload[:1], payload[1:]
+            if flag == b"z":
+                body = zlib.decompress(body)
+            elif flag != b"j":
+                return None, None
+            data = self.Serializer.loads(body)
+        except Exception:
+            return None, None
+        if not isinstance(data, dict):
+            return None, None
+        return data, issued
+
+    @staticmethod
+    def is_cookie_value(value):
+        return value.count(".") == 3
@@ -0,0 +1,429 @@
+import time, os, pickle, socket, struct, sqlite3, sys
+from collections import OrderedDict
+from threading import RLock, Thread, local
+
+#
+# Session storage backends. Any object with these methods can be passed to WPSessionApp as session_storage:
+#
+#   load(sid)                   -> session data dictionary or None if the session does not exist
+#   save(sid, data)
+#   update(sid, changed, deleted, version=None, replace=False)
+#                               - stores changed {key: value} and removes deleted [key], creates the session if needed.
+#                                 If replace is True, the stored data is replaced with changed instead.
+#                                 Returns the new session version. If version is not None and the stored version
+#                                 is different, raises SessionConflict
+#   delete(sid)
+#   sessionExists(sid)          -> True/False
+#   bulkLoad(sid, key)          -> value or None
+#   bulkSave(sid, key, value)
+#   bulkDelete(sid, key)
+#
+
+VersionKey = "__webpie_session_version__"      # the version is stored with the session data
+
+class SessionConflict(Exception):
+    
+    def __init__(self, sid, expected, stored):
+        Exception.__init__(self, sid, expected, stored)
+        self.SessionID = sid
+        self.Expected = expected
+        self.Stored = stored
+        
+    def __str__(self):
+        return "Session %s was modified concurrently: expected version %s, stored version %s" % (
+            self.SessionID, self.Expected, self.Stored)
+
+def apply_update(sid, data, changed, deleted, version, replace=False):
+    # applies changes to the session data dictionary in place, checking the version. Returns the new version
+    stored = data.get(VersionKey, 0)
+    if version is not None and version != stored:
+        raise SessionConflict(sid, version, stored)
+    if replace:
+        data.clear()
+    data.update(changed)
+    for k in deleted:
+        data.pop(k, None)
+    data[VersionKey] = stored + 1
+    return stored + 1
+
+class SessionBackend(object):
+
+    def load(self, sid):
+        raise NotImplementedError()
+
+    def save(self, sid, data):
+        raise NotImplementedError()
+
+    def update(self, sid, changed, deleted, version=None, replace=False):
+        # not atomic, override if the backend can do better
+        data = self.load(sid) or {}
+        version = apply_update(sid, data, changed, deleted, version, replace)
+        self.save(sid, data)
+        return version
+
+    def delete(self, sid):
+        raise NotImplementedError()
+
+    def sessionExists(self, sid):
+        return self.load(sid) is not None
+
+    def bulkLoad(self, sid, key, default=None):
+        raise NotImplementedError()
+
+    def bulkSave(self, sid, key, value):
+        raise NotImplementedError()
+
+    def bulkDelete(self, sid, key):
+        raise NotImplementedError()
+
+class MemorySessionStorage(SessionBackend):
+
+    #
+    # In-process LRU storage with session timeout. Sessions are not shared between processes,
+    # so use it with a single process server or with the RemoteSessionStorage
+    #
+
+    def __init__(self, max_sessions=100000, session_timeout=3600):
+        self.MaxSessions = max_sessions
+        self.SessionTimeout = session_timeout
+        self.Sessions = OrderedDict()           # sid -> (expiration time, data)
+        self.Bulk = {}                          # sid -> {key -> value}
+        self.Lock = RLock()
+
+    def get(self, sid):
+        # returns the session data dictionary, shared with the storage, or None
+        now = time.time()
+        with self.Lock:
+            entry = self.Sessions.get(sid)
+            if entry is None:
+                return None
+            expiration, data = entry
+            if expiration < now:
+                self.remove(sid)
+                return None
+            self.Sessions[sid] = (now + self.SessionTimeout, data)
+            self.Sessions.move_to_end(sid)
+            return data
+
+    def remove(self, sid):
+        self.Sessions.pop(sid, None)
+        self.Bulk.pop(sid, None)
+
+    def load(self, sid):
+        data = self.get(sid)
+        return None if data is None else dict(data)        # the session will modify its own copy
+
+    def store(self, sid, data):
+        # stores the data dictionary as is and evicts least recently used sessions over MaxSessions
+        with self.Lock:
+            self.Sessions[sid] = (time.time() + self.SessionTimeout, data)
+            self.Sessions.move_to_end(sid)
+            while len(self.Sessions) > self.MaxSessions:
+                old_sid, _ = self.Sessions.popitem(last=False)
+                self.Bulk.pop(old_sid, None)
+
+    def save(self, sid, data):
+        self.store(sid, dict(data))
+
+    def update(self, sid, changed, deleted, version=None, replace=False):
+        with self.Lock:
+            data = self.get(sid)
+            if data is None:
+                # new session
+                data = {}
+                version = apply_update(sid, data, changed, deleted, version, replace)
+                self.store(sid, data)
+                return version
+            return apply_update(sid, data, changed, deleted, version, replace)
+
+    def delete(self, sid):
+        with self.Lock:
+            self.remove(sid)
+
+    def sessionExists(self, sid):
+        return self.get(sid) is not None
+
+    def bulkLoad(self, sid, key, default=None):
+        with self.Lock:
+            return self.Bulk.get(sid, {}).get(key, default)
+
+    def bulkSave(self, sid, key, value):
+        with self.Lock:
+            if sid not in self.Sessions:
+                self.save(sid, {})
+            self.Bulk.setdefault(sid, {})[key] = value
+
+    def bulkDelete(self, sid, key):
+        with self.Lock:
+            self.Bulk.get(sid, {}).pop(key, None)
+
+class SQLiteSessionStorage(SessionBackend):
+
+    #
+    # Single-file SQLite database in WAL mode. Can be shared by several processes, e.g. multiserver subprocesses.
+    # Each thread uses its own connection. Expired sessions are deleted by the process, which
+    # saves a session more than cleanup_interval seconds after the previous clean-up
+    #
+
+    def __init__(self, path, session_timeout=3600, cleanup_interval=600):
+        self.Path = path
+        self.SessionTimeout = session_timeout
+        self.CleanupInterval = cleanup_interval
+        self.NextCleanup = time.time() + cleanup_interval
+        self.Local = local()
+        db = self.connection()
+        with db:
+            db.execute("""create table if not exists sessions (
+                        sid         text primary key,
+                        data        blob,
+                        expiration  real
+                    )""")
+            db.execute("create index if not exists sessions_expiration on sessions(expiration)")
+            db.execute("""create table if not exists bulk (
+                        sid         text,
+                        key         text,
+                        data        blob,
+                        expiration  real,
+                        primary key (sid, key)
+                    )""")
+            columns = [row[1] for row in db.execute("pragma table_info(bulk)")]
+            if "expiration" not in columns:
+                # database created by an older version
+                db.execute("alter table bulk add column expiration real")
+                db.execute("update bulk set expiration=?", (time.time() + session_timeout,))
+            db.execute("create index if not exists bulk_expiration on bulk(expiration)")
+
+    def connection(self):
+        # connections are not inherited by forked processes
+        db = getattr(self.Local, "DB", None)
+        if db is None or self.Local.PID != os.getpid():
+            db = sqlite3.connect(self.Path, timeout=30, isolation_level=None, check_same_thread=False)
+            db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=normal")
+            self.Local.DB = db
+            self.Local.PID = os.getpid()
+        return db
+
+    def load(self, sid):
+        now = time.time()
+        db = self.connection()
+        row = db.execute("select data, expiration from sessions where sid=? and expiration >= ?", (sid, now)).fetchone()
+        if row is None:
+            return None
+        data, expiration = row
+        if expiration < now + self.SessionTimeout/2:
+            # extend the session lifetime, but not on every read
+            db.execute("update sessions set expiration=? where sid=?", (now + self.SessionTimeout, sid))
+        return pickle.loads(data)
+
+    def save(self, sid, data):
+        now = time.time()
+        db = self.connection()
+        db.execute("insert or replace into sessions(sid, data, expiration) values(?, ?, ?)",
+                (sid, pickle.dumps(data), now + self.SessionTimeout))
+        if now > self.NextCleanup:
+            self.NextCleanup = now + self.CleanupInterval
+            self.cleanup(now)
+
+    def update(self, sid, changed, deleted, version=None, replace=False):
+        # read-modify-write in one transaction, so that concurrent updates of different keys are not lost
+        now = time.time()
+        db = self.connection()
+        with db:
+            db.execute("begin immediate")
+            row = db.execute("select data from sessions where sid=? and expiration >= ?", (sid, now)).fetchone()
+            data = pickle.loads(row[0]) if row is not None else {}
+            version = apply_update(sid, data, changed, deleted, version, replace)
+            db.execute("insert or replace into sessions(sid, data, expiration) values(?, ?, ?)",
+                    (sid, pickle.dumps(data), now + self.SessionTimeout))
+        return version
+
+    def cleanup(self, now=None):
+        now = now or time.time()
+        db = self.connection()
+        with db:
+            db.execute("begin")
+            db.execute("delete from bulk where expiration < ? or sid in (select sid from sessions where expiration < ?)", 
+                    (now, now))
+            db.execute("delete from sessions where expiration < ?", (now,))
+
+    def delete(self, sid):
+        db = self.connection()
+        with db:
+            db.execute("begin")
+            db.execute("delete from sessions where sid=?", (sid,))
+            db.execute("delete from bulk where sid=?", (sid,))
+
+    def sessionExists(self, sid):
+        return self.connection().execute("select 1 from sessions where sid=? and expiration >= ?",
+                (sid, time.time())).fetchone() is not None
+
+    def bulkLoad(self, sid, key, default=None):
+        # bulk data expires on its own, so that it is deleted even if the session row does not exist
+        now = time.time()
+        db = self.connection()
+        row = db.execute("select data, expiration from bulk where sid=? and key=? and expiration >= ?", 
+                (sid, key, now)).fetchone()
+        if row is None:
+            return default
+        data, expiration = row
+        if expiration < now + self.SessionTimeout/2:
+            db.execute("update bulk set expiration=? where sid=? and key=?", (now + self.SessionTimeout, sid, key))
+        return pickle.loads(data)
+
+    def bulkSave(self, sid, key, value):
+        self.connection().execute("insert or replace into bulk(sid, key, data, expiration) values(?, ?, ?, ?)",
+                (sid, key, pickle.dumps(value), time.time() + self.SessionTimeout))
+
+    def bulkDelete(self, sid, key):
+        self.connection().execute("delete from bulk where sid=? and key=?", (sid, key))
+
+#
+# Remote storage
+#
+# Protocol: the client sends requests and the server sends replies over a persistent connection.
+# Each request and reply is a 4-byte big endian length followed by pickled (method, args) tuple or
+# (ok, result) tuple respectively. The data is unpickled without checks, so the server must be reachable
+# only by trusted clients: listen on a Unix socket or on the loopback interface
+#
+
+def _send_frame(sock, obj):
+    data = pickle.dumps(obj)
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+def _recv_exactly(sock, n):
+    parts = []
+    while n > 0:
+        data = sock.recv(min(n, 1024*1024))
+        if not data:
+            raise EOFError("connection closed")
+        parts.append(data)
+        n -= len(data)
+    return b"".join(parts)
+
+def _recv_frame(sock):
+    n, = struct.unpack("!I", _recv_exactly(sock, 4))
+    return pickle.loads(_recv_exactly(sock, n))
+
+def _socket(address):
+    # address is either (host, port) tuple or Unix socket path
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+class SessionServer(Thread):
+
+    Methods = ("load", "save", "update", "delete", "sessionExists", "bulkLoad", "bulkSave", "bulkDelete")
+
+    def __init__(self, address, storage=None, daemon=True):
+        Thread.__init__(self, daemon=daemon)
+        self.Address = address
+        self.Storage = storage if storage is not None else MemorySessionStorage()
+        self.Sock = _socket(address)
+        if isinstance(address, str):
+            try:    os.unlink(address)
+            except OSError: pass
+        else:
+            self.Sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.Sock.bind(address)
+        self.Sock.listen(100)
+
+    def run(self):
+        while True:
+            csock, caddr = self.Sock.accept()
+            Thread(target=self.serve, args=(csock,), daemon=True).start()
+
+    def serve(self, sock):
+        try:
+            while True:
+                try:    method, args = _recv_frame(sock)
+                except EOFError:
+                    break
+                if method not in self.Methods:
+                    _send_frame(sock, (False, "unknown method %s" % (method,)))
+                    continue
+                try:    result = (True, getattr(self.Storage, method)(*args))
+                except SessionConflict as e:
+                    result = (False, e)
+                except Exception as e:
+                    result = (False, "%s: %s" % (e.__class__.__name__, e))
+                _send_frame(sock, result)
+        finally:
+            sock.close()
+
+class RemoteSessionStorage(SessionBackend):
+
+    #
+    # Client for the SessionServer. Each thread uses its own connection
+    #
+
+    def __init__(self, address, timeout=10.0):
+        self.Address = address
+        self.Timeout = timeout
+        self.Local = local()
+
+    def call(self, method, *args):
+        for attempt in (1, 2):
+            sock = getattr(self.Local, "Sock", None)
+            if sock is None or self.Local.PID != os.getpid():
+                sock = _socket(self.Address)
+                sock.settimeout(self.Timeout)
+                sock.connect(self.Address)
+                self.Local.Sock = sock
+                self.Local.PID = os.getpid()
+            try:
+                _send_frame(sock, (method, args))
+                ok, result = _recv_frame(sock)
+                break
+            except (OSError, EOFError):
+                # reconnect once, e.g. after the server restart
+                self.Local.Sock = None
+                sock.close()
+                if attempt == 2:
+                    raise
+        if not ok:
+            if isinstance(result, SessionConflict):
+                raise result
+            raise RuntimeError("Session server error: %s" % (result,))
+        return result
+
+    def load(self, sid):
+        return self.call("load", sid)
+
+    def save(self, sid, data):
+        return self.call("save", sid, data)
+
+    def update(self, sid, changed, deleted, version=None, replace=False):
+        return self.call("update", sid, changed, deleted, version, replace)
+
+    def delete(self, sid):
+        return self.call("delete", sid)
+
+    def sessionExists(self, sid):
+        return self.call("sessionExists", sid)
+
+    def bulkLoad(self, sid, key, default=None):
+        return self.call("bulkLoad", sid, key, default)
+
+    def bulkSave(self, sid, key, value):
+        return self.call("bulkSave", sid, key, value)
+
+    def bulkDelete(self, sid, key):
+        return self.call("bulkDelete", sid, key)
+
+if __name__ == "__main__":
+    #
+    # Usage: python -m webpie.session_storage (<port>|<Unix socket path>) [<max sessions> [<session timeout>]]
+    #
+    if not sys.argv[1:]:
+        print("Usage: python -m webpie.session_storage (<port>|<Unix socket path>) [<max sessions> [<session timeout>]]")
+        sys.exit(2)
+    address = sys.argv[1]
+    address = ("127.0.0.1", int(address)) if address.isdigit() else address
+    max_sessions = int(sys.argv[2]) if sys.argv[2:] else 100000
+    session_timeout = int(sys.argv[3]) if sys.argv[3:] else 3600
+    server = SessionServer(address, MemorySessionStorage(max_sessions, session_timeout), daemon=False)
+    server.start()
+    server.join()
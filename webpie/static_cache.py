@@ -0,0 +1,220 @@
+import os, stat, time, hashlib, gzip
+from collections import OrderedDict
+from threading import RLock
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from .webob.byterange import ContentRange
+
+try:    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+
+MAX_RANGES = 16         # more ranges than this in one request are coalesced into one
+
+def parse_ranges(header, length):
+    # parses Range header value "bytes=0-99,200-,-50" into a list of (start, stop) pairs, stop non-inclusive.
+    # Returns None if the header is not a valid byte ranges set and must be ignored,
+    # or [] if none of the ranges is satisfiable
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for r in spec.split(","):
+        r = r.strip()
+        if not r:   continue
+        first, dash, last = r.partition("-")
+        first, last = first.strip(), last.strip()
+        if not dash or not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+            return None
+        if not first:
+            # suffix range: last N bytes
+            n = int(last)
+            if n > 0 and length > 0:
+                ranges.append((max(0, length - n), length))
+            continue
+        start = int(first)
+        stop = int(last) + 1 if last else length
+        if last and stop <= start:
+            return None
+        if start < length:
+            ranges.append((start, min(stop, length)))
+    if len(ranges) > 1:
+        # overlapping ranges or too many ranges are merged
+        ordered = sorted(ranges)
+        if len(ranges) > MAX_RANGES or any(b[0] < a[1] for a, b in zip(ordered[:-1], ordered[1:])):
+            merged = [ordered[0]]
+            for start, stop in ordered[1:]:
+                if start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+                else:
+                    merged.append((start, stop))
+            ranges = merged if len(merged) <= MAX_RANGES else [(ordered[0][0], max(s for _, s in ordered))]
+    return ranges
+
+def content_range(start, stop, length):
+    return str(ContentRange(start, stop, length))
+
+class CachedFile(object):
+
+    #
+    # Static file metadata and, for small files, content with precompressed variants
+    #
+
+    OVERHEAD = 256          # approximate memory used by a metadata-only entry
+    GzipLevel = 6           # the variants are built on the request thread when the file is loaded,
+    BrotliQuality = 5       # so the levels are moderate: gzip 9 and brotli 11 are many times slower for little gain
+
+    def __init__(self, path, st, mime_type, content=None):
+        self.Path = path                # resolved path, e.g. with default file name added
+        self.MTime = st.st_mtime
+        self.Size = st.st_size
+        self.Inode = (st.st_dev, st.st_ino)
+        self.MimeType = mime_type
+        self.LastModified = formatdate(st.st_mtime, usegmt=True)
+        self.Content = content
+        self.Variants = {}              # encoding -> compressed content
+        if content is not None:
+            self.ETag = '"%s"' % (hashlib.sha1(content).hexdigest()[:20],)
+        else:
+            self.ETag = '"%x-%x"' % (st.st_size, st.st_mtime_ns)
+        self.CheckedAt = time.time()
+
+    @property
+    def memory_size(self):
+        return self.OVERHEAD + (len(self.Content) if self.Content is not None else 0) \
+                + sum(len(v) for v in self.Variants.values())
+
+    def same_file(self, st):
+        return st.st_mtime == self.MTime and st.st_size == self.Size and (st.st_dev, st.st_ino) == self.Inode
+
+    def compress(self, min_size):
+        if self.Content is None or len(self.Content) < min_size \
+                    or not any(self.MimeType.startswith(t) for t in COMPRESSIBLE_TYPES):
+            return
+        compressed = gzip.compress(self.Content, self.GzipLevel, mtime=0)
+        if len(compressed) < len(self.Content):
+            self.Variants["gzip"] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(self.Content, quality=self.BrotliQuality)
+            if len(compressed) < len(self.Content):
+                self.Variants["br"] = compressed
+
+    def etag(self, encoding=None):
+        # each representation has its own strong entity tag
+        return self.ETag if not encoding else '%s-%s"' % (self.ETag[:-1], encoding)
+
+    def if_range(self, headers, encoding=None):
+        # checks If-Range request header. Returns True if the Range header should be honored
+        value = headers.get("If-Range")
+        if value is None:
+            return True
+        value = value.strip()
+        if value.startswith('"'):
+            return value == self.etag(encoding)
+        return value == self.LastModified        # dates must match exactly
+
+    def not_modified(self, headers):
+        # checks If-None-Match and If-Modified-Since request headers
+        inm = headers.get("If-None-Match")
+        if inm is not None:
+            tags = [t.strip() for t in inm.split(",")]
+            if "*" in tags:
+                return True
+            etags = [self.etag(e) for e in [None] + list(self.Variants)]
+            return any(t in etags or t.startswith("W/") and t[2:] in etags for t in tags)
+        ims = headers.get("If-Modified-Since")
+        if ims is not None:
+            if ims == self.LastModified:        # the browser echoes Last-Modified back, no need to parse
+                return True
+            t = parsedate_tz(ims)
+            return t is not None and int(self.MTime) <= mktime_tz(t)
+        return False
+
+class StaticFileCache(object):
+
+    #
+    # LRU cache of static files, bounded by the total size of cached content.
+    # Entries are revalidated with one stat() call when they are older than revalidate_interval.
+    # Files larger than max_file_size are cached as metadata only
+    #
+
+    GlobalLock = RLock()
+    Caches = {}                 # (root, parameters) -> cache object
+
+    @staticmethod
+    def cache(root, **params):
+        # handlers serving the same root with the same parameters share the cache
+        key = (root, tuple(sorted(params.items())))
+        with StaticFileCache.GlobalLock:
+            if key not in StaticFileCache.Caches:
+                StaticFileCache.Caches[key] = StaticFileCache(**params)
+            return StaticFileCache.Caches[key]
+
+    def __init__(self, max_size=16*1024*1024, max_file_size=1024*1024, revalidate_interval=1.0,
+                compress=True, compress_min_size=512):
+        self.MaxSize = max_size
+        self.MaxFileSize = max_file_size
+        self.RevalidateInterval = revalidate_interval
+        self.Compress = compress
+        self.CompressMinSize = compress_min_size
+        self.Entries = OrderedDict()        # requested path -> CachedFile
+        self.Size = 0
+        self.Lock = RLock()
+
+    def stat(self, path, default_file):
+        # returns (resolved path, stat) or (None, None)
+        try:
+            st = os.stat(path)
+            if stat.S_ISDIR(st.st_mode) and default_file:
+                path = os.path.join(path, default_file)
+                st = os.stat(path)
+        except OSError:
+            return None, None
+        if not stat.S_ISREG(st.st_mode):
+            return None, None
+        return path, st
+
+    def remove(self, path):
+        entry = self.Entries.pop(path, None)
+        if entry is not None:
+            self.Size -= entry.memory_size
+
+    def get(self, path, default_file, mime_type_func):
+        # returns CachedFile or None if the file is not found
+        now = time.time()
+        with self.Lock:
+            entry = self.Entries.get(path)
+            if entry is not None and now < entry.CheckedAt + self.RevalidateInterval:
+                self.Entries.move_to_end(path)
+                return entry
+
+        resolved, st = self.stat(path, default_file)
+        with self.Lock:
+            if resolved is None:
+                self.remove(path)
+                return None
+            if entry is not None and entry.Path == resolved and entry.same_file(st):
+                entry.CheckedAt = now
+                self.Entries.move_to_end(path)
+                return entry
+
+        content = None
+        if st.st_size <= self.MaxFileSize:
+            try:
+                with open(resolved, "rb") as f:
+                    content = f.read()
+            except OSError:
+                return None
+        entry = CachedFile(resolved, st, mime_type_func(resolved), content)
+        if self.Compress:
+            entry.compress(self.CompressMinSize)
+
+        with self.Lock:
+            self.remove(path)
+            self.Entries[path] = entry
+            self.Size += entry.memory_size
+            while self.Size > self.MaxSize and self.Entries:
+                _, evicted = self.Entries.popitem(last=False)
+                self.Size -= evicted.memory_size
+        return entry
@@ -2,7 +2,10 @@
 
 import sys
 import types
-from cgi import parse_header
+try:
+    from cgi import parse_header
+except ImportError:         # the cgi module was removed in Python 3.13
+    parse_header = None
 
 # True if we are running on Python 3.
 PY3 = sys.version_info[0] == 3
@@ -141,9 +144,13 @@ else:
 
 
 if PY3:
-    import cgi
     import tempfile
-    from cgi import FieldStorage as _cgi_FieldStorage
+    try:
+        import cgi
+        from cgi import FieldStorage as _cgi_FieldStorage
+    except ImportError:     # Python 3.13, multipart/form-data is parsed by webpie.multipart
+        cgi = None
+        _cgi_FieldStorage = object
 
     # Various different FieldStorage work-arounds required on Python 3.x
     class cgi_FieldStorage(_cgi_FieldStorage): # pragma: no cover
@@ -212,21 +212,7 @@ class BaseRequest(object):
         elif content_type != 'multipart/form-data':
             return r
 
-        fs_environ = self.environ.copy()
-        fs_environ.setdefault('CONTENT_LENGTH', '0')
-        fs_environ['QUERY_STRING'] = ''
-        if PY2:
-            fs = cgi_FieldStorage(fp=self.body_file,
-                                  environ=fs_environ,
-                                  keep_blank_values=True)
-        else:
-            fs = cgi_FieldStorage(fp=self.body_file,
-                                  environ=fs_environ,
-                                  keep_blank_values=True,
-                                  encoding=charset,
-                                  errors=errors)
-
-        fout = t.transcode_fs(fs, r._content_type_raw)
+        fout = t.transcode_multipart(self, r._content_type_raw)
 
         # this order is important, because setting body_file
         # resets content_length
@@ -253,8 +239,10 @@ class BaseRequest(object):
         r = self.body_file_raw
         clen = self.content_length
 
-        if not self.is_body_seekable and clen is not None:
-            # we need to wrap input in LimitedLengthFile
+        if not self.is_body_seekable and clen is not None \
+                and not getattr(r, 'length_limited', False):
+            # we need to wrap input in LimitedLengthFile, unless the server's
+            # input stream already stops at Content-Length (webpie BodyFile)
             # but we have to cache the instance as well
             # otherwise this would stop working
             # (.remaining counter would reset between calls):
@@ -773,27 +761,24 @@ class BaseRequest(object):
                           % content_type)
         self._check_charset()
 
+        if content_type == 'multipart/form-data':
+            # parsed in one pass directly from the input stream, see webpie/multipart.py
+            from ..multipart import parse_form
+            if self.is_body_seekable:
+                self.body_file_raw.seek(0)
+            vars = parse_form(self)
+            env['webob._parsed_post_vars'] = (vars, self.body_file_raw)
+            return vars
+
         self.make_body_seekable()
         self.body_file_raw.seek(0)
 
-        fs_environ = env.copy()
-        # FieldStorage assumes a missing CONTENT_LENGTH, but a
-        # default of 0 is better:
-        fs_environ.setdefault('CONTENT_LENGTH', '0')
-        fs_environ['QUERY_STRING'] = ''
-        if PY2:
-            fs = cgi_FieldStorage(
-                fp=self.body_file,
-                environ=fs_environ,
-                keep_blank_values=True)
-        else:
-            fs = cgi_FieldStorage(
-                fp=self.body_file,
-                environ=fs_environ,
-                keep_blank_values=True,
-                encoding='utf8')
-
-        vars = MultiDict.from_fieldstorage(fs)
+        vars = MultiDict()
+        if content_type == 'application/x-www-form-urlencoded':
+            # parsed without cgi.FieldStorage, which is not available in Python 3.13
+            body = self.body.decode('utf8', 'replace')
+            for name, value in urlparse.parse_qsl(body, keep_blank_values=True, encoding='utf8', errors='replace'):
+                vars.add(name, value)
         env['webob._parsed_post_vars'] = (vars, self.body_file_raw)
         return vars
 
@@ -949,6 +934,25 @@ class BaseRequest(object):
             fileobj = None
             input = self.body_file
 
+            if self.content_length is not None and hasattr(input, 'readinto'):
+                # Read through one reused buffer straight into the BytesIO
+                # or the temporary file, without intermediate bytes objects
+                fileobj = io.BytesIO() if todo <= tempfile_limit \
+                    else self.make_tempfile()
+                buf = memoryview(bytearray(min(todo, 65536) or 1))
+                while todo > 0:
+                    n = input.readinto(buf[:min(todo, len(buf))])
+                    if not n:
+                        raise DisconnectionError(
+                            "Client disconnected (%s more bytes were expected)" % todo
+                        )
+                    fileobj.write(buf[:n])
+                    todo -= n
+                fileobj.seek(0)
+                self.body_file_raw = fileobj
+                self.is_body_seekable = True
+                return
+
             while todo > 0:
                 data = input.read(min(todo, 65535))
 
@@ -1712,26 +1716,17 @@ class Transcoder(object):
 
         return url_encode(q)
 
-    def transcode_fs(self, fs, content_type):
-        # transcode FieldStorage
-        if PY2:
-            def decode(b):
-                if b is not None:
-                    return b.decode(self.charset, self.errors)
-                else:
-                    return b
-        else:
-            def decode(b):
-                return b
+    def transcode_multipart(self, request, content_type):
+        # transcode multipart/form-data body, see webpie/multipart.py
+        from ..multipart import iterate_parts
 
         data = []
-        for field in fs.list or ():
-            field.name = decode(field.name)
-            if field.filename:
-                field.filename = decode(field.filename)
-                data.append((field.name, field))
+        for part in iterate_parts(request):
+            if part.filename:
+                part.save()
+                data.append((part.name, part))
             else:
-                data.append((field.name, decode(field.value)))
+                data.append((part.name, part.read().decode(self.charset, self.errors)))
 
         # TODO: transcode big requests to temp file
         content_type, fout = _encode_multipart(